@@ -20,7 +20,14 @@ This module contains the microservice code for
     models
 """
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from app.caches import make_cache
+from app.dbpool import PooledSQLAlchemy
+from app.compression import Compression
+from app.logs import RequestIds
+from app.metrics import RequestMetrics
+from app.querybudget import QueryBudget
+from app.writebehind import WriteBehind
+from app.inventory import Inventory
 
 # These next lines are positional:
 # 1) We need to create the Flask app
@@ -30,9 +37,30 @@ from flask_sqlalchemy import SQLAlchemy
 app = Flask(__name__)
 # Load the confguration
 app.config.from_object('config')
-print('Database URI {}'.format(app.config['SQLALCHEMY_DATABASE_URI']))
 
-# Initialize SQLAlchemy
-db = SQLAlchemy(app)
+# Initialize SQLAlchemy, the engine is only created when it is first used
+db = PooledSQLAlchemy(app)
+
+# Initialize the Item cache
+cache = make_cache(app.config)
+
+# Give every request an id for its log records
+request_ids = RequestIds(app)
+
+# Initialize the request metrics (recorded only if METRICS_ENABLED)
+metrics = RequestMetrics(app)
+
+# Coalesce the count changes of Items (only if WRITE_BEHIND_ENABLED), before
+# the query budget so the pending deltas a request writes first are not counted
+write_behind = WriteBehind(app, db)
+
+# Initialize the per route query budget (checked only if QUERY_BUDGET_ENABLED)
+query_budget = QueryBudget(app, db)
+
+# Compress large responses for clients that accept it
+compression = Compression(app)
+
+# Availability of every sku from the inventory (only if INVENTORY_SOURCE is set)
+inventory = Inventory(app)
 
 from app import server, models
@@ -0,0 +1,54 @@
+"""
+Background module
+
+This module runs the periodic work of the service off the request path
+    Worker: a daemon thread that calls a function every interval until it
+        is stopped, started on first use so every forked worker gets its own
+"""
+import threading
+
+
+class Worker(object):
+    """ Calls run every interval() seconds in a daemon thread until stopped """
+
+    def __init__(self, name, run, interval):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def is_alive(self):
+        """ Returns True if the thread is running """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, now=False):
+        """ Starts the thread unless it is already running
+
+        With now the thread calls run at once instead of after an interval.
+        """
+        # a forked process inherits the Thread object but not the thread
+        if self.is_alive():
+            return
+        with self._lock:
+            if self.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._loop, args=(now,), name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stops the thread and waits for the call it is in to finish """
+        with self._lock:
+            self._stopped.set()
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def _loop(self, now):
+        if now:
+            self.run()
+        while not self._stopped.wait(self.interval()):
+            self.run()
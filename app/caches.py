@@ -0,0 +1,292 @@
+"""
+Caches module
+
+This module contains the caches that keep serialized Items so that
+repeated reads don't go to the database
+    LRUCache: in process cache with LRU eviction and a time to live
+    SharedCache: cache kept in a memcached style store shared by instances
+    LocalClient: in process stand-in for a memcached client
+    NullCache: cache that never stores anything
+"""
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Seconds an Item stays cached when ITEM_CACHE_TTL is not set
+MEMORY_CACHE_TTL = 1
+SHARED_CACHE_TTL = 30
+
+# What a deleted key holds until adds may fill it again
+DELETED = object()
+DELETED_MARKER = '!deleted'
+
+
+class Cache(object):
+    """ Interface that every Item cache implements """
+
+    def __init__(self):
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Sets the hit, miss and eviction counters back to zero """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value stored under key or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores value under key """
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """ Stores value under key unless the key is stored or was just deleted
+
+        Returns True if the value was stored. Reads fill the cache with add,
+        so a value read before a change can't replace its invalidation.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes key from the cache, holding it off adds for a few seconds """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every key from the cache """
+        raise NotImplementedError
+
+    def size(self):
+        """ Returns the number of keys stored or None if it is not known """
+        return None
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters """
+        lookups = self.hits + self.misses
+        return {'backend': self.__class__.__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'size': self.size()}
+
+
+class NullCache(Cache):
+    """ Cache that never stores anything, used when caching is disabled """
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, value):
+        return False
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def size(self):
+        return 0
+
+
+class LRUCache(Cache):
+    """ In process cache that evicts the least recently used key when full
+
+    Args:
+        maxsize(int): the largest number of keys kept
+        ttl(float): the number of seconds a key stays fresh
+        hold(float): the number of seconds a deleted key refuses adds
+        clock(callable): returns the current time in seconds
+    """
+
+    def __init__(self, maxsize=1024, ttl=30, hold=2, clock=time.time):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hold = hold
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < self.clock():
+                self.misses += 1
+                self.evictions += 1
+                return None
+            if value is DELETED:
+                self._entries[key] = entry
+                self.misses += 1
+                return None
+            # re-insert the key so it becomes the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, self.ttl)
+
+    def add(self, key, value):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= self.clock():
+                return False
+            self._store(key, value, self.ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            if self.hold:
+                self._store(key, DELETED, self.hold)
+            else:
+                self._entries.pop(key, None)
+
+    def _store(self, key, value, ttl):
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock() + ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self):
+        return len(self._entries)
+
+
+class SharedCache(Cache):
+    """ Cache kept in a store shared by every instance of the service
+
+    The client must provide get(key), set(key, value, time), add(key,
+    value, time) and delete(key) like python-memcached does. Values are
+    stored as JSON, a deleted key as a marker that is not. Clearing bumps a
+    generation number that is part of every key, so the old keys are never
+    read again and expire on their own.
+
+    Args:
+        client: the memcached style client
+        prefix(string): prepended to every key
+        ttl(int): the number of seconds a key stays fresh
+        hold(int): the number of seconds a deleted key refuses adds
+    """
+
+    def __init__(self, client, prefix='shopcarts', ttl=30, hold=2):
+        super(SharedCache, self).__init__()
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hold = hold
+
+    def _key(self, key):
+        generation = self.client.get(self.prefix + ':generation') or 0
+        return '{}:{}:{}'.format(self.prefix, generation, key)
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        if value is None or value == DELETED_MARKER:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self._key(key), json.dumps(value), self.ttl)
+
+    def add(self, key, value):
+        return bool(self.client.add(self._key(key), json.dumps(value), self.ttl))
+
+    def delete(self, key):
+        if self.hold:
+            self.client.set(self._key(key), DELETED_MARKER, self.hold)
+        else:
+            self.client.delete(self._key(key))
+
+    def clear(self):
+        generation = self.client.get(self.prefix + ':generation') or 0
+        self.client.set(self.prefix + ':generation', int(generation) + 1, 0)
+
+
+class LocalClient(object):
+    """ In process stand-in for a memcached client, used for development and tests """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires < self.clock():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, time=0):
+        with self._lock:
+            self._values[key] = (self.clock() + time if time else 0, value)
+        return True
+
+    def add(self, key, value, time=0):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and not (entry[0] and entry[0] < self.clock()):
+                return False
+            self._values[key] = (self.clock() + time if time else 0, value)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+        return True
+
+
+def make_cache(config):
+    """ Creates the Item cache described by the app configuration
+
+    ITEM_CACHE_BACKEND selects the cache: memory (the default), memcached,
+    local (a SharedCache over LocalClient) or none. A write only invalidates
+    the memory cache of its own process, the others serve the old Item
+    until it expires, so unless ITEM_CACHE_TTL is set that is after
+    MEMORY_CACHE_TTL seconds there and SHARED_CACHE_TTL in a shared cache.
+    """
+    backend = config.get('ITEM_CACHE_BACKEND', 'memory')
+    ttl = config.get('ITEM_CACHE_TTL')
+    shared_ttl = SHARED_CACHE_TTL if ttl is None else ttl
+    if ttl is None:
+        ttl = MEMORY_CACHE_TTL
+    hold = config.get('ITEM_CACHE_HOLD', 2)
+    if backend == 'none':
+        return NullCache()
+    if backend == 'local':
+        return SharedCache(LocalClient(), ttl=shared_ttl, hold=hold)
+    if backend == 'memcached':
+        try:
+            import memcache
+        except ImportError:
+            logger.warning('python-memcached is not installed, using the memory cache')
+        else:
+            servers = config.get('ITEM_CACHE_SERVERS', '127.0.0.1:11211').split(',')
+            return SharedCache(memcache.Client(servers), ttl=shared_ttl, hold=hold)
+    return LRUCache(maxsize=config.get('ITEM_CACHE_SIZE', 1024), ttl=ttl, hold=hold)
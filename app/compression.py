@@ -0,0 +1,105 @@
+"""
+Compression module
+
+This module compresses responses for clients that accept it
+    Compression: negotiates br, gzip or deflate from Accept-Encoding and
+        compresses JSON and text responses larger than a threshold, and
+        streamed responses chunk by chunk
+
+Set COMPRESSION_ENABLED to turn it on (the default). COMPRESSION_MIN_SIZE
+is the smallest body in bytes worth compressing and COMPRESSION_LEVEL the
+zlib level. br is only offered when the brotli package is installed.
+"""
+import zlib
+import logging
+from flask import request
+from app.metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# The mimetypes worth compressing
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/msgpack', 'text/plain', 'text/html',
+                          'application/javascript')
+
+
+def compressor(encoding, level):
+    """ Returns a zlib compressor for gzip or deflate """
+    # gzip wraps the deflate stream in a gzip header, deflate in a zlib one
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def compress(data, encoding, level):
+    """ Returns data compressed with the given content coding """
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    engine = compressor(encoding, level)
+    return engine.compress(data) + engine.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    """ Yields the chunks compressed, flushing after each so clients see them as they come """
+    engine = compressor(encoding, level)
+    for chunk in chunks:
+        data = engine.compress(chunk) + engine.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield engine.flush()
+
+
+class Compression(object):
+    """ Compresses the responses of the app when COMPRESSION_ENABLED is set """
+
+    def __init__(self, app=None):
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Registers the response hook """
+        self.app = app
+        app.config.setdefault('COMPRESSION_ENABLED', True)
+        app.config.setdefault('COMPRESSION_MIN_SIZE', 1024)
+        app.config.setdefault('COMPRESSION_LEVEL', 6)
+        app.after_request(self._after_request)
+
+    @staticmethod
+    def encodings(streamed=False):
+        """ Returns the content codings this service can use, most preferred first """
+        if brotli is not None and not streamed:
+            return ['br', 'gzip', 'deflate']
+        return ['gzip', 'deflate']
+
+    def _after_request(self, response):
+        if not self.app.config['COMPRESSION_ENABLED']:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 304) or \
+                response.mimetype not in COMPRESSIBLE_MIMETYPES or \
+                'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        streamed = response.is_streamed
+        encoding = request.accept_encodings.best_match(self.encodings(streamed))
+        if encoding is None:
+            return response
+        level = self.app.config['COMPRESSION_LEVEL']
+        if streamed:
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.app.config['COMPRESSION_MIN_SIZE']:
+                return response
+            with timed('compress'):
+                response.set_data(compress(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        # the compressed bytes are a different representation of the same version
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,152 @@
+"""
+Database Pool module
+
+This module contains the connection pool used for MySQL
+    PoolStats: checkout counters and timings for a pool
+    InstrumentedQueuePool: QueuePool that records PoolStats and can
+        ping connections before handing them out
+    PooledSQLAlchemy: Flask-SQLAlchemy that configures the pool from
+        the app configuration
+"""
+import time
+import threading
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Pool options that only apply to a QueuePool
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pre_ping')
+
+
+class PoolStats(object):
+    """ Counters and timings for connection checkouts """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.disconnects = 0
+        self.checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+
+    def record_checkout(self, seconds, waited):
+        """ Records a checkout that took seconds and maybe had to wait """
+        with self._lock:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+            self.checkout_seconds += seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds, seconds)
+
+    def record_timeout(self):
+        """ Records a checkout that gave up waiting for a connection """
+        with self._lock:
+            self.waits += 1
+            self.timeouts += 1
+
+    def record_disconnect(self):
+        """ Records a stale connection found by the pre-ping """
+        with self._lock:
+            self.disconnects += 1
+
+    def as_dict(self):
+        """ Returns the counters as a dictionary """
+        with self._lock:
+            return {'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts,
+                    'disconnects': self.disconnects,
+                    'mean_checkout_ms': (1000.0 * self.checkout_seconds / self.checkouts
+                                         if self.checkouts else 0.0),
+                    'max_checkout_ms': 1000.0 * self.max_checkout_seconds}
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that records checkout statistics
+
+    Args:
+        pre_ping(bool): test every connection with SELECT 1 on checkout
+            and replace it if the server has closed it
+        stats(PoolStats): where to record the statistics
+    """
+
+    def __init__(self, creator, pre_ping=False, stats=None, **kw):
+        # a recreated pool shares the listeners of the one it replaces
+        fresh = kw.get('_dispatch') is None
+        super(InstrumentedQueuePool, self).__init__(creator, **kw)
+        self.pre_ping = pre_ping
+        self.stats = stats or PoolStats()
+        if pre_ping and fresh:
+            event.listen(self, 'checkout', self._ping)
+
+    def _ping(self, dbapi_connection, connection_record, connection_proxy):
+        """ Raises DisconnectionError so the pool retries with a new connection """
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except Exception:
+            self.stats.record_disconnect()
+            raise exc.DisconnectionError()
+
+    def _do_get(self):
+        waited = (self._max_overflow > -1 and self._overflow >= self._max_overflow and
+                  self._pool.empty())
+        started = time.time()
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record_checkout(time.time() - started, waited)
+        return connection
+
+    def recreate(self):
+        self.logger.info('Pool recreating')
+        return self.__class__(self._creator, pool_size=self._pool.maxsize,
+                              max_overflow=self._max_overflow,
+                              timeout=self._timeout,
+                              recycle=self._recycle, echo=self.echo,
+                              logging_name=self._orig_logging_name,
+                              use_threadlocal=self._use_threadlocal,
+                              reset_on_return=self._reset_on_return,
+                              _dispatch=self.dispatch,
+                              dialect=self._dialect,
+                              pre_ping=self.pre_ping,
+                              stats=self.stats)
+
+
+def pool_status(pool):
+    """ Returns the connection usage and statistics of a pool """
+    status = {'class': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        status.update({'size': pool.size(),
+                       'checked_in': pool.checkedin(),
+                       'in_use': pool.checkedout(),
+                       'overflow': pool.overflow()})
+    if isinstance(pool, InstrumentedQueuePool):
+        status['pre_ping'] = pool.pre_ping
+        status.update(pool.stats.as_dict())
+    return status
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy that uses an InstrumentedQueuePool for server databases
+
+    SQLite keeps the pool Flask-SQLAlchemy picks for it, so the queue pool
+    settings are dropped for it.
+    """
+
+    def apply_pool_defaults(self, app, options):
+        super(PooledSQLAlchemy, self).apply_pool_defaults(app, options)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING') is not None:
+            options['pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            for option in QUEUE_POOL_OPTIONS:
+                options.pop(option, None)
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if 'poolclass' not in options:
+            options['poolclass'] = InstrumentedQueuePool
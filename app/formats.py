@@ -0,0 +1,80 @@
+"""
+Formats module
+
+This module negotiates the wire format of request and response bodies
+    JSON: application/json, always available
+    MessagePack: application/msgpack, when msgpack 0.5.2 or later is installed
+
+Requests are decoded by their Content-Type and responses are encoded in
+the type the client prefers in its Accept header, JSON by default.
+"""
+import logging
+from flask import request, Response, jsonify, make_response
+from werkzeug.exceptions import UnsupportedMediaType
+from app.models import DataValidationError
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:
+    logger.warning('msgpack is not installed, only JSON bodies are accepted')
+    msgpack = None
+else:
+    # unpack decodes strings with raw=False, which older releases don't take
+    if msgpack.version < (0, 5, 2):
+        logger.warning('msgpack %s is older than 0.5.2, only JSON bodies are accepted',
+                       '.'.join(str(part) for part in msgpack.version))
+        msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# x-msgpack is what older clients send
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack')
+
+
+def wants_msgpack():
+    """ Returns True if the client prefers MessagePack responses and they can be made """
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match((JSON_MIMETYPE,) + MSGPACK_MIMETYPES,
+                                               default=JSON_MIMETYPE)
+    return best in MSGPACK_MIMETYPES
+
+
+def pack(data):
+    """ Encodes data as MessagePack """
+    # str and unicode are both packed as strings so Python 2 keys stay text
+    return msgpack.packb(data, use_bin_type=False)
+
+
+def unpack(data):
+    """ Decodes MessagePack data, with strings as unicode """
+    return msgpack.unpackb(data, raw=False)
+
+
+def get_body():
+    """ Returns the decoded request body
+
+    MessagePack bodies are decoded by their Content-Type, everything else
+    like request.get_json() does, which is None if it is not JSON.
+    """
+    if request.mimetype in MSGPACK_MIMETYPES:
+        if msgpack is None:
+            raise UnsupportedMediaType('MessagePack is not supported by this service')
+        try:
+            return unpack(request.get_data())
+        except Exception:
+            raise DataValidationError('Invalid request: body is not valid MessagePack')
+    return request.get_json()
+
+
+def body_response(data, code, headers=None):
+    """ Returns a response with data encoded in the format the client asked for """
+    if wants_msgpack():
+        response = Response(pack(data), status=code, headers=headers,
+                            mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = make_response(jsonify(data), code, headers or {})
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,274 @@
+"""
+Inventory module
+
+This module keeps a snapshot of which skus are in stock, so responses can
+say whether an Item is available without asking the database
+    Inventory: holds the sku to availability map in memory and refreshes it
+        from the inventory source in a background thread
+    FileSource: reads the inventory from a JSON file
+    SQLiteSource: reads the inventory from a table in a SQLite file
+    NullSource: an inventory that knows no sku
+
+Set INVENTORY_SOURCE to file or sqlite and INVENTORY_PATH to its file to
+turn it on (none, the default, leaves is_available as clients set it).
+The snapshot is read again every INVENTORY_REFRESH_INTERVAL seconds. When
+it is older than INVENTORY_MAX_STALENESS seconds, because the source
+could not be read, Items fall back to their stored is_available. The
+summary groups the Items by sku and takes their availability from the
+snapshot. The is_available filter reads the skus of the Items it filters
+first and sends the database only those the snapshot knows, so its cost
+follows the cart, not the inventory; when they are more than
+INVENTORY_MAX_FILTER_SKUS, the filter uses the stored column.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+from sqlalchemy import or_, and_
+from app.background import Worker
+
+logger = logging.getLogger(__name__)
+
+
+def in_stock(value):
+    """ Returns the availability of an inventory entry, a flag or a quantity on hand """
+    if isinstance(value, bool) or value is None:
+        return bool(value)
+    return value > 0
+
+
+class NullSource(object):
+    """ Interface that every inventory source implements, knows no sku """
+
+    def load(self):
+        """ Returns a dictionary of the availability of every sku
+
+        Returns None when the inventory has not changed since the last load.
+        """
+        return {}
+
+
+class FileSource(NullSource):
+    """ Reads a JSON object of sku to true, false or the quantity on hand """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+
+    def load(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._mtime:
+            return None
+        with open(self.path) as handle:
+            data = json.load(handle)
+        self._mtime = mtime
+        return dict((sku, in_stock(value)) for sku, value in data.items())
+
+
+class SQLiteSource(NullSource):
+    """ Reads the sku and quantity columns of a table in a SQLite file """
+
+    def __init__(self, path, table='inventory'):
+        self.path = path
+        self.table = table
+
+    def load(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute('SELECT sku, quantity FROM "{}"'.format(self.table))
+            return dict((sku, in_stock(quantity)) for sku, quantity in rows)
+        finally:
+            conn.close()
+
+
+def make_source(config):
+    """ Creates the inventory source described by the app configuration
+
+    INVENTORY_SOURCE selects it: file, sqlite or none (the default).
+    """
+    backend = config.get('INVENTORY_SOURCE', 'none')
+    path = config.get('INVENTORY_PATH')
+    if backend == 'file' and path:
+        return FileSource(path)
+    if backend == 'sqlite' and path:
+        return SQLiteSource(path, config.get('INVENTORY_TABLE', 'inventory'))
+    if backend != 'none':
+        logger.warning('Unknown inventory source %s or no INVENTORY_PATH, not using one',
+                       backend)
+    return None
+
+
+class Inventory(object):
+    """ The availability of every sku, refreshed in the background """
+
+    def __init__(self, app=None, source=None):
+        self.app = app
+        self.source = source
+        self.snapshot = {}
+        self.digest = None
+        self.loaded = None
+        self.generation = 0
+        self.refreshes = 0
+        self.failures = 0
+        self._worker = Worker('inventory-refresh', self.refresh,
+                              lambda: self.app.config['INVENTORY_REFRESH_INTERVAL'])
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app, source)
+
+    def init_app(self, app, source=None):
+        """ Creates the source from the configuration unless one is given """
+        self.app = app
+        app.config.setdefault('INVENTORY_SOURCE', 'none')
+        app.config.setdefault('INVENTORY_REFRESH_INTERVAL', 30.0)
+        app.config.setdefault('INVENTORY_MAX_STALENESS', 300.0)
+        app.config.setdefault('INVENTORY_MAX_FILTER_SKUS', 100)
+        self.source = source or make_source(app.config)
+
+    def reset_stats(self):
+        """ Sets the hit, miss and stale counters back to zero """
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @property
+    def enabled(self):
+        """ True if there is an inventory source """
+        return self.source is not None
+
+    def refresh(self):
+        """ Reads the inventory source into a new snapshot
+
+        Returns True if the snapshot changed. A source that fails keeps the
+        last snapshot, which ages until the source can be read again.
+        """
+        try:
+            snapshot = self.source.load()
+        except Exception:
+            self.failures += 1
+            logger.exception('Reading the inventory failed, keeping the last snapshot')
+            return False
+        self.refreshes += 1
+        self.loaded = time.time()
+        if snapshot is None or snapshot == self.snapshot:
+            return False
+        # replaced whole, so readers never see a half loaded map
+        items = sorted(snapshot.items())
+        self.digest = hashlib.md5(json.dumps(items)).hexdigest()[:12]
+        self.snapshot = snapshot
+        self.generation += 1
+        return True
+
+    def current(self):
+        """ Returns the snapshot, or None if there is none fresh enough to use """
+        if not self.enabled:
+            return None
+        self._worker.start(now=self.loaded is None)
+        if self.loaded is None or \
+                time.time() - self.loaded > self.app.config['INVENTORY_MAX_STALENESS']:
+            self.stale += 1
+            return None
+        return self.snapshot
+
+    def version(self):
+        """ Returns a digest of the snapshot, the same in every worker that loaded it """
+        return self.digest if self.current() is not None else None
+
+    def available_filter(self, query, sku, is_available, wanted):
+        """ Returns the criterion of Items whose availability, as responses show it, is wanted
+
+        The skus of the Items in query are read first and only those the
+        snapshot knows are sent back, the others are matched on the stored
+        column. More than INVENTORY_MAX_FILTER_SKUS of them would make a
+        slow query, then every Item is matched on the stored column.
+
+        Args:
+            query(Query): the Items to filter
+            sku(Column): the sku column
+            is_available(Column): the stored availability column
+            wanted(bool): the availability to match
+        """
+        snapshot = self.current()
+        if snapshot is None:
+            return is_available == wanted
+        known = [row[0] for row in query.with_entities(sku).distinct() if row[0] in snapshot]
+        if not known:
+            return is_available == wanted
+        if len(known) > self.app.config['INVENTORY_MAX_FILTER_SKUS']:
+            return is_available == wanted
+        matching = [value for value in known if snapshot[value] == wanted]
+        unknown = and_(~sku.in_(known), is_available == wanted)
+        return or_(sku.in_(matching), unknown) if matching else unknown
+
+    def available(self, sku, stored):
+        """ Returns the availability of a sku, the stored one if the snapshot lacks it """
+        snapshot = self.current()
+        if snapshot is None:
+            return stored
+        return snapshot.get(sku, stored)
+
+    def annotate(self, item):
+        """ Sets is_available of a serialized Item from the snapshot
+
+        Returns True if the snapshot knew the sku of the Item.
+        """
+        snapshot = self.current()
+        if snapshot is None:
+            return False
+        available = snapshot.get(item['sku'])
+        if available is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        item['is_available'] = available
+        return True
+
+    def annotate_rows(self, rows, sku_index, available_index):
+        """ Returns Item row tuples with is_available taken from the snapshot
+
+        Args:
+            rows: Item row tuples
+            sku_index(int): the position of the sku in a row
+            available_index(int): the position of is_available in a row
+        """
+        snapshot = self.current()
+        if snapshot is None:
+            return rows
+        return self._annotate_rows(snapshot, rows, sku_index, available_index)
+
+    def _annotate_rows(self, snapshot, rows, sku_index, available_index):
+        # counted in locals and added once, the list loop runs per row
+        hits = misses = 0
+        try:
+            for row in rows:
+                available = snapshot.get(row[sku_index])
+                if available is None:
+                    misses += 1
+                else:
+                    hits += 1
+                    row = row[:available_index] + (available,) + row[available_index + 1:]
+                yield row
+        finally:
+            self.hits += hits
+            self.misses += misses
+
+    def stop(self):
+        """ Stops the refresh thread """
+        self._worker.stop()
+
+    def stats(self):
+        """ Returns the snapshot size and age and the hit, miss and stale counters """
+        lookups = self.hits + self.misses
+        return {'source': self.source.__class__.__name__ if self.enabled else None,
+                'skus': len(self.snapshot),
+                'age_seconds': time.time() - self.loaded if self.loaded else None,
+                'generation': self.generation,
+                'digest': self.digest,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
@@ -0,0 +1,283 @@
+"""
+Logs module
+
+This module keeps logging off the request path
+    QueueHandler: puts log records on a queue instead of writing them
+    QueueListener: writes the queued records to the real handlers from a
+        background thread
+    JSONFormatter: formats a record as one JSON object per line
+    RequestIdFilter: tags every record with the id of its request
+    SamplingFilter: samples and rate limits chatty messages per call site
+    RequestIds: gives every request an id, taken from X-Request-ID or new
+
+Set LOG_FORMAT to json (the default) or text. LOG_ASYNC writes through the
+queue (the default) and LOG_QUEUE_SIZE bounds it, records that don't fit
+are dropped and counted. LOG_SAMPLE_RATE (0 to 1) and LOG_RATE_LIMIT (per
+call site and second, 0 for none) apply to the INFO and DEBUG messages of
+the loggers in LOG_SAMPLED_LOGGERS.
+"""
+import sys
+import json
+import time
+import uuid
+import Queue
+import random
+import atexit
+import logging
+import threading
+from flask import g, request, has_request_context
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(module)s [%(request_id)s]: %(message)s'
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+
+class QueueHandler(logging.Handler):
+    """ Puts log records on a queue for a QueueListener to write """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+        self.setFormatter(logging.Formatter())
+
+    def prepare(self, record):
+        """ Merges the message and its arguments so the record can cross threads """
+        # the arguments may be ORM objects that are not safe to read later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """ Writes the records of a queue to handlers from a background thread """
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        """ Starts the writer thread unless it is already running """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Writes the records still queued and stops the writer thread """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def handle(self, record):
+        """ Passes a record to every handler that accepts its level """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a JSON object on a single line """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname,
+                 'logger': record.name, 'module': record.module,
+                 'message': record.getMessage(),
+                 'request_id': getattr(record, 'request_id', None)}
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + \
+            '.{:03d}Z'.format(int(record.msecs))
+
+
+class RequestIdFilter(logging.Filter):
+    """ Tags records with the id of the request that logged them, or - """
+
+    def filter(self, record):
+        # records from the queue were tagged in the thread that logged them
+        if getattr(record, 'request_id', None) is None:
+            request_id = None
+            if has_request_context():
+                request_id = getattr(g, 'request_id', None)
+            record.request_id = request_id or '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ Samples and rate limits the messages below WARNING per call site
+
+    A call site is the file and line a message is logged from. sample_rate
+    is the share of its messages kept and rate_limit the most kept every
+    second. The next message kept from a call site carries the number
+    left out in its suppressed attribute.
+    """
+
+    def __init__(self, sample_rate=1.0, rate_limit=0, level=logging.WARNING):
+        logging.Filter.__init__(self)
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.level = level
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.time()
+        with self._lock:
+            window = self._sites.get(site)
+            if window is None:
+                window = self._sites[site] = [now, 0, 0]    # started, kept, suppressed
+            elif now - window[0] >= 1.0:
+                window[0], window[1] = now, 0
+            keep = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+            if keep and self.rate_limit and window[1] >= self.rate_limit:
+                keep = False
+            if not keep:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+class RequestIds(object):
+    """ Gives every request of the app an id and returns it in X-Request-ID """
+
+    def __init__(self, app=None):
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Registers the request hooks """
+        self.app = app
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    @staticmethod
+    def _before_request():
+        # trust an id from the caller so a request can be followed across services
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')[:64]
+        g.request_id = request_id or uuid.uuid4().hex
+
+    @staticmethod
+    def _after_request(response):
+        request_id = getattr(g, 'request_id', None)
+        if request_id:
+            response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+
+
+class AsyncLogging(object):
+    """ The logging setup of the service: where records go and how they are filtered """
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.sampling = None
+        self._atexit = False
+
+    def configure(self, app, log_level=logging.INFO):
+        """ Replaces the handlers of the root logger and the app logger
+
+        Records are formatted as LOG_FORMAT and written to STDOUT, through
+        the queue when LOG_ASYNC is set.
+        """
+        config = app.config
+        self.stop()
+        self.listener = None
+        output = logging.StreamHandler(sys.stdout)
+        if config.get('LOG_FORMAT', 'json') == 'json':
+            output.setFormatter(JSONFormatter())
+        else:
+            output.setFormatter(logging.Formatter(TEXT_FORMAT))
+        output.addFilter(RequestIdFilter())
+        output.setLevel(log_level)
+
+        handler = output
+        if config.get('LOG_ASYNC', True):
+            queue = Queue.Queue(config.get('LOG_QUEUE_SIZE', 10000))
+            handler = QueueHandler(queue)
+            # the request id has to be read in the thread that logs
+            handler.addFilter(RequestIdFilter())
+            handler.setLevel(log_level)
+            self.listener = QueueListener(queue, output)
+            self.listener.start()
+            if not self._atexit:
+                atexit.register(self.stop)
+                self._atexit = True
+        self.handler = handler
+
+        for logger in (logging.getLogger(), app.logger):
+            for old_handler in list(logger.handlers):
+                logger.removeHandler(old_handler)
+            logger.addHandler(handler)
+            logger.setLevel(log_level)
+
+        self.sampling = SamplingFilter(config.get('LOG_SAMPLE_RATE', 1.0),
+                                       config.get('LOG_RATE_LIMIT', 0))
+        for name in config.get('LOG_SAMPLED_LOGGERS', ()):
+            sampled = logging.getLogger(name)
+            for old_filter in [f for f in sampled.filters if isinstance(f, SamplingFilter)]:
+                sampled.removeFilter(old_filter)
+            sampled.addFilter(self.sampling)
+
+    def after_fork(self):
+        """ Starts a writer thread in a forked worker, which only inherits the queue """
+        if self.listener is None:
+            return
+        # the lock of the inherited queue may have been held by the parent's thread
+        queue = Queue.Queue(self.handler.queue.maxsize)
+        self.handler.queue = self.listener.queue = queue
+        self.listener._thread = None
+        self.listener.start()
+
+    def stop(self):
+        """ Writes the records still queued """
+        if self.listener is not None:
+            self.listener.stop()
+
+    def stats(self):
+        """ Returns the records dropped by a full queue and left out by sampling """
+        return {'queued': self.handler.queue.qsize() if self.listener is not None else 0,
+                'dropped': self.handler.dropped if self.listener is not None else 0,
+                'suppressed': self.sampling.suppressed if self.sampling is not None else 0}
+
+
+# The logging setup of this process
+async_logging = AsyncLogging()
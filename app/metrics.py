@@ -0,0 +1,236 @@
+"""
+Metrics module
+
+This module contains the opt-in request instrumentation
+    Histogram: Prometheus style histogram
+    Registry: the histograms of the service rendered as Prometheus text
+    RequestMetrics: times every request, its SQL queries and the splits
+        marked with timed() and timed_rows(), and samples requests into
+        cProfile dumps
+
+Set METRICS_ENABLED to turn it on. PROFILE_SAMPLE_RATE (0 to 1) and
+PROFILE_DIR control the cProfile sampling.
+"""
+import os
+import time
+import random
+import cProfile
+import threading
+from functools import wraps
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Buckets in seconds for request, query and split durations
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Buckets for the number of SQL queries a request makes
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    """ Cumulative histogram with a sum and a count like Prometheus uses """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ Adds a value to the histogram """
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class Registry(object):
+    """ Histograms keyed by metric name and labels """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def observe(self, name, help_text, buckets, labels, value):
+        """ Adds value to the histogram name with the given labels """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics.setdefault(name, (help_text, buckets, {}))
+            histogram = metric[2].get(key)
+            if histogram is None:
+                histogram = metric[2][key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def clear(self):
+        """ Forgets every observation """
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self):
+        """ Returns every histogram in the Prometheus text format """
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                help_text, buckets, histograms = self._metrics[name]
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} histogram'.format(name))
+                for key in sorted(histograms):
+                    histogram = histograms[key]
+                    labels = ','.join('{}="{}"'.format(label, value) for label, value in key)
+                    for bound, count in zip(buckets, histogram.counts):
+                        lines.append('{}_bucket{{{}}} {}'.format(
+                            name, _join(labels, 'le="{}"'.format(bound)), count))
+                    lines.append('{}_bucket{{{}}} {}'.format(
+                        name, _join(labels, 'le="+Inf"'), histogram.count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram.sum))
+                    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _join(labels, extra):
+    return '{},{}'.format(labels, extra) if labels else extra
+
+
+def current_timings():
+    """ Returns the timings of the request being handled or None """
+    if not has_request_context():
+        return None
+    return getattr(g, 'request_timings', None)
+
+
+class timed(object):
+    """ Adds the time spent in a block or function to a split of the request
+
+    Use it as a context manager or as a decorator:
+
+        with timed('serialize'):
+            ...
+    """
+
+    def __init__(self, split):
+        self.split = split
+        self.started = None
+
+    def __enter__(self):
+        timings = current_timings()
+        # a split nested in itself (a handler calling a handler) is timed once
+        if timings is not None and self.split not in timings['active']:
+            timings['active'].add(self.split)
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timings = current_timings()
+        if timings is not None and self.started is not None:
+            timings['active'].discard(self.split)
+            splits = timings['splits']
+            splits[self.split] = splits.get(self.split, 0.0) + time.time() - self.started
+
+    def __call__(self, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(self.split):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def timed_rows(rows, split='fetch'):
+    """ Yields the rows of a lazy query, adding the time each takes to arrive to split
+
+    The time is taken out of the splits the rows are consumed in, so a
+    query that runs while its rows are serialized is counted as fetching.
+    """
+    timings = current_timings()
+    if timings is None:
+        for row in rows:
+            yield row
+        return
+    rows = iter(rows)
+    splits = timings['splits']
+    while True:
+        started = time.time()
+        try:
+            row = next(rows)
+        finally:
+            elapsed = time.time() - started
+            splits[split] = splits.get(split, 0.0) + elapsed
+            for active in timings['active']:
+                splits[active] = splits.get(active, 0.0) - elapsed
+        yield row
+
+
+class RequestMetrics(object):
+    """ Records per route timings for the app when METRICS_ENABLED is set """
+
+    def __init__(self, app=None):
+        self.registry = Registry()
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Registers the request hooks and the SQL query listeners """
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_DIR', '/tmp')
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_request(self):
+        if not self.app.config['METRICS_ENABLED']:
+            return
+        g.request_timings = {'started': time.time(), 'db_queries': 0,
+                             'db_seconds': 0.0, 'splits': {}, 'active': set(),
+                             'profiler': None}
+        if random.random() < self.app.config['PROFILE_SAMPLE_RATE']:
+            profiler = cProfile.Profile()
+            g.request_timings['profiler'] = profiler
+            profiler.enable()
+
+    def _after_request(self, response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        route = request.endpoint or 'unknown'
+        profiler = timings['profiler']
+        if profiler is not None:
+            profiler.disable()
+            self._dump_profile(profiler, route)
+        elapsed = time.time() - timings['started']
+        labels = {'route': route, 'method': request.method, 'status': response.status_code}
+        self.registry.observe('shopcarts_request_duration_seconds',
+                              'Wall time to handle a request', DURATION_BUCKETS, labels, elapsed)
+        self.registry.observe('shopcarts_request_db_queries',
+                              'SQL queries made by a request', QUERY_COUNT_BUCKETS,
+                              {'route': route}, timings['db_queries'])
+        self.registry.observe('shopcarts_request_db_duration_seconds',
+                              'Time a request spent running SQL queries', DURATION_BUCKETS,
+                              {'route': route}, timings['db_seconds'])
+        for split, seconds in timings['splits'].items():
+            self.registry.observe('shopcarts_request_split_duration_seconds',
+                                  'Time a request spent in a marked split', DURATION_BUCKETS,
+                                  {'route': route, 'split': split}, seconds)
+        g.request_timings = None
+        return response
+
+    def _dump_profile(self, profiler, route):
+        path = os.path.join(self.app.config['PROFILE_DIR'], 'shopcarts-{}-{}-{}.prof'.format(
+            route, int(time.time() * 1000), os.getpid()))
+        profiler.dump_stats(path)
+        self.app.logger.info('Request profile written to %s', path)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_timings() is not None:
+            conn.info.setdefault('query_started', []).append(time.time())
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings = current_timings()
+        started = conn.info.get('query_started')
+        if timings is not None and started:
+            timings['db_queries'] += 1
+            timings['db_seconds'] += time.time() - started.pop()
@@ -1,7 +1,12 @@
 import os
+import re
 import json
 import logging
-from . import db
+import sqlite3
+from datetime import datetime
+from sqlalchemy import func, text, bindparam, event, DDL, table, column, or_, and_, case, desc
+from sqlalchemy.orm.exc import StaleDataError
+from . import db, cache, inventory
 
 ######################################################################
 # Custom Exceptions
@@ -14,13 +19,42 @@ class Item(db.Model):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    sku = db.Column(db.String(63))
+    sku = db.Column(db.String(63), index=True)
     count = db.Column(db.Integer)
     price = db.Column(db.Float)
     name = db.Column(db.String(63))
     link = db.Column(db.String(63))
     brand_name = db.Column(db.String(63))
     is_available = db.Column(db.Boolean())
+    # The customer whose cart holds the Item, None for Items created
+    # through the /shopcarts/items routes that no customer owns
+    customer_id = db.Column(db.Integer)
+    # Bumped by SQLAlchemy on every update, used for ETags
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # The keys of a serialized Item, in the order Item.rows returns them
+    SERIALIZED_FIELDS = ('id', 'sku', 'name', 'brand_name', 'price', 'count',
+                         'is_available', 'link', 'customer_id')
+
+    # The orders an Item list can be in, a - in front reverses it
+    SORTS = ('id', 'price', '-price', 'name', '-name', 'count', '-count')
+
+    # Composite indexes for the filters that list_items combines
+    __table_args__ = (
+        # One index per sort, ending with the id that breaks ties, so a
+        # sorted page is read in index order and its cursor is a seek
+        db.Index('ix_item_price_id', 'price', 'id'),
+        db.Index('ix_item_name_id', 'name', 'id'),
+        db.Index('ix_item_count_id', 'count', 'id'),
+        db.Index('ix_item_brand_name_price', 'brand_name', 'price'),
+        db.Index('ix_item_is_available_price', 'is_available', 'price'),
+        # Every lookup in a customer's cart starts with customer_id, and a
+        # sku is in a cart at most once (Items of no customer may repeat it)
+        db.Index('ix_item_customer_id_sku', 'customer_id', 'sku', unique=True),
+    )
 
     def __repr__(self):
         return '<Item %r>' % (self.name)
@@ -29,14 +63,249 @@ class Item(db.Model):
         """
         Saves a Item to the data store
         """
-        if not self.id:
+        inserted = not self.id
+        if inserted:
             db.session.add(self)
         db.session.commit()
+        key = str(self.id)
+        # nothing can have cached an Item before it was inserted
+        if not inserted:
+            cache.delete(key)
 
     def delete(self):
         """ Removes a Item from the data store """
+        item_id = self.id
         db.session.delete(self)
         db.session.commit()
+        cache.delete(str(item_id))
+
+    @staticmethod
+    def increment_count(item_id, delta, version=None, customer_id=None):
+        """ Adds delta to the count of an Item with a single atomic UPDATE
+
+        The count never goes below zero, so a decrement that would take it
+        there changes nothing.
+
+        Args:
+            item_id(int): the id of the Item to change
+            delta(int): the amount to add to the count, negative to take away
+            version(int): only change the Item if it is still at this version
+            customer_id(int): only change the Item if it is in this customer's cart
+
+        Returns:
+            int: 1 if the Item was changed, 0 if it was not
+        """
+        Item.logger.info('Processing count increment of %s for id %s ...', delta, item_id)
+        count = func.coalesce(Item.count, 0)
+        query = Item.query.filter(Item.id == item_id, count + delta >= 0)
+        if version is not None:
+            query = query.filter(Item.version == version)
+        if customer_id is not None:
+            query = query.filter(Item.customer_id == customer_id)
+        changed = query.update({Item.count: count + delta,
+                                Item.version: Item.version + 1,
+                                Item.updated: datetime.utcnow()},
+                               synchronize_session=False)
+        db.session.commit()
+        cache.delete(str(item_id))
+        return changed
+
+    @staticmethod
+    def apply_count_deltas(deltas):
+        """ Adds the count deltas of many Items in a single transaction
+
+        One UPDATE statement is sent with a parameter set per Item, so the
+        driver can run it as a batch. Each Item gets one new version however
+        many deltas were added up for it, and no count goes below zero: the
+        Items a negative delta would take there, because another process
+        lowered their count since it was buffered, are set to zero and logged.
+
+        Args:
+            deltas(dict): the amount to add to the count of each Item, by id
+
+        Returns:
+            int: the number of Items that were changed
+        """
+        if not deltas:
+            return 0
+        Item.logger.info('Processing count deltas for %s items ...', len(deltas))
+        items = Item.__table__
+        decrements = [item_id for item_id, delta in deltas.items() if delta < 0]
+        if decrements:
+            stored = db.session.query(Item.id, Item.count).filter(Item.id.in_(decrements)) \
+                .with_for_update().all()
+            clamped = sorted(item_id for item_id, count in stored
+                             if (count or 0) + deltas[item_id] < 0)
+            if clamped:
+                Item.logger.warning('Count deltas took Items %s below zero, set to zero',
+                                    clamped)
+        count = func.coalesce(items.c.count, 0) + bindparam('delta')
+        statement = items.update().where(items.c.id == bindparam('item_id')).values(
+            count=case([(count < 0, 0)], else_=count),
+            version=items.c.version + 1, updated=datetime.utcnow())
+        result = db.session.execute(statement, [{'item_id': item_id, 'delta': delta}
+                                                for item_id, delta in deltas.items()])
+        db.session.commit()
+        for item_id in deltas:
+            cache.delete(str(item_id))
+        return result.rowcount
+
+    @staticmethod
+    def add_to_cart(customer_id, data):
+        """ Adds an Item to a customer's cart, merging it with the Item of the same sku
+
+        A new Item is inserted, or the count of the one already in the cart
+        with that sku is increased, by a single atomic statement: INSERT ...
+        ON DUPLICATE KEY UPDATE on MySQL and INSERT ... ON CONFLICT DO UPDATE
+        on SQLite and PostgreSQL. The other fields of an Item already in the
+        cart are kept.
+
+        Args:
+            customer_id(int): the customer whose cart to add to
+            data(dict): the Item, its count is the quantity to add
+
+        Returns:
+            Item: the Item in the cart after the change
+        """
+        Item.logger.info('Processing add to cart of customer %s ...', customer_id)
+        item = Item().deserialize(data)
+        # a null sku is left out of the unique index, so it would never merge
+        if not isinstance(item.sku, basestring) or not item.sku.strip():
+            raise DataValidationError('Invalid item: sku is required to add to a cart')
+        if not isinstance(item.count, (int, long)) or isinstance(item.count, bool) or \
+                item.count < 1:
+            raise DataValidationError('Invalid item: count must be a positive integer')
+        item.customer_id = customer_id
+        values = dict((name, getattr(item, name)) for name in UPSERT_COLUMNS)
+        values.update(version=1, updated=datetime.utcnow())
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'mysql':
+            suffix = ('ON DUPLICATE KEY UPDATE count = COALESCE(count, 0) + VALUES(count), '
+                      'version = version + 1, updated = VALUES(updated)')
+        elif dialect == 'postgresql' or (dialect == 'sqlite' and
+                                         sqlite3.sqlite_version_info >= (3, 24, 0)):
+            suffix = ('ON CONFLICT (customer_id, sku) DO UPDATE SET '
+                      'count = COALESCE({0}.count, 0) + excluded.count, '
+                      'version = {0}.version + 1, updated = excluded.updated'
+                      .format(Item.__tablename__))
+        else:
+            suffix = None
+
+        if suffix:
+            statement = text(UPSERT_STATEMENT.format(
+                table=Item.__tablename__, columns=', '.join(UPSERT_COLUMNS),
+                values=', :'.join(UPSERT_COLUMNS), suffix=suffix))
+            # typed parameters so the dates and booleans are stored like the ORM does
+            statement = statement.bindparams(*[bindparam(name, type_=column.type)
+                                               for name, column in Item.__table__.c.items()
+                                               if name in values])
+            db.session.execute(statement, values)
+        else:
+            # No upsert statement, so change the count and insert only if no row had it
+            changed = Item.query.filter_by(customer_id=customer_id, sku=item.sku).update(
+                {Item.count: func.coalesce(Item.count, 0) + item.count,
+                 Item.version: Item.version + 1,
+                 Item.updated: values['updated']}, synchronize_session=False)
+            if not changed:
+                db.session.add(item)
+        db.session.commit()
+        item = Item.query.filter_by(customer_id=customer_id, sku=item.sku).one()
+        cache.delete(str(item.id))
+        return item
+
+    @staticmethod
+    def save_all(items):
+        """ Inserts a list of new Items in a single transaction
+
+        The Items are sent as multi-row INSERT statements of up to
+        INSERT_CHUNK_SIZE rows and their ids are set from what the database
+        reports, so they never have to be read back. The Items are not
+        added to the session.
+
+        Args:
+            items(list): new Items without an id
+        """
+        if not items:
+            return
+        Item.logger.info('Processing insert of %s items ...', len(items))
+        now = datetime.utcnow()
+        for item in items:
+            item.version, item.updated = 1, now
+        for first in range(0, len(items), INSERT_CHUNK_SIZE):
+            chunk = items[first:first + INSERT_CHUNK_SIZE]
+            for item, item_id in zip(chunk, insert_rows(chunk)):
+                item.id = item_id
+        db.session.commit()
+
+    @staticmethod
+    def update_all(items):
+        """ Updates a list of Items with one UPDATE statement in a single transaction
+
+        The statement is sent with a parameter set per Item, each only
+        changing the Item if it is still at the version the Item carries.
+        The Items are not added to the session, their version is bumped.
+
+        Args:
+            items(list): Items with the id and version of the stored rows
+
+        Raises:
+            StaleDataError: when another request changed or removed one of them
+        """
+        if not items:
+            return
+        Item.logger.info('Processing update of %s items ...', len(items))
+        columns = Item.__table__.c
+        now = datetime.utcnow()
+        statement = Item.__table__.update().where(and_(
+            columns.id == bindparam('_id'), columns.version == bindparam('_version')
+        )).values(dict((name, bindparam(name)) for name in UPSERT_COLUMNS),
+                  version=columns.version + 1, updated=now)
+        result = db.session.execute(statement, [
+            dict(((name, getattr(item, name)) for name in UPSERT_COLUMNS),
+                 _id=item.id, _version=item.version) for item in items])
+        if result.rowcount != len(items):
+            db.session.rollback()
+            raise StaleDataError('{} of {} items were changed by another request'.format(
+                len(items) - result.rowcount, len(items)))
+        db.session.commit()
+        for item in items:
+            item.version, item.updated = item.version + 1, now
+            cache.delete(str(item.id))
+
+    @staticmethod
+    def delete_many(item_ids):
+        """ Removes the Items with the given ids in a single statement
+
+        Args:
+            item_ids(list): the ids of the Items to remove
+
+        Returns:
+            int: the number of Items that were removed
+        """
+        if not item_ids:
+            return 0
+        count = Item.query.filter(Item.id.in_(item_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        for item_id in item_ids:
+            cache.delete(str(item_id))
+        return count
+
+    @staticmethod
+    def remove_all(**filters):
+        """ Removes every Item matching the filters in a single statement
+
+        Args:
+            filters: any of the filters accepted by find_by_filters, with no
+                filters every Item is removed
+
+        Returns:
+            int: the number of Items that were removed
+        """
+        Item.logger.info('Removing all Items matching %s', filters)
+        count = Item.find_by_filters(**filters).delete(synchronize_session=False)
+        db.session.commit()
+        cache.clear()
+        return count
 
     def serialize(self):
         """ Serializes a Item into a dictionary """
@@ -47,7 +316,8 @@ class Item(db.Model):
                 "price": self.price,
                 "count": self.count,
                 "is_available": self.is_available,
-                "link": self.link
+                "link": self.link,
+                "customer_id": self.customer_id
                 }
 
     def deserialize(self, data):
@@ -77,6 +347,7 @@ class Item(db.Model):
         """ Initializes the database session """
         Item.logger.info('Initializing database')
         db.create_all()  # make our sqlalchemy tables
+        cache.clear()
 
     @staticmethod
     def all():
@@ -84,18 +355,230 @@ class Item(db.Model):
         Item.logger.info('Processing all Items')
         return Item.query.all()
 
+    @staticmethod
+    def rows(query=None, after_id=None, limit=None, chunk_size=None, sort='id', after=None):
+        """ Returns the serialized columns of Items as row tuples in a sort order
+
+        No Item objects are built, so this is the cheap way to read Items
+        that are only going to be serialized. The columns are in the order
+        of SERIALIZED_FIELDS.
+
+        Rows are ordered by the sort field and then by id, both reversed for
+        a sort starting with -, and pages are read with keyset pagination:
+        the next page starts after the (value, id) of the last row of the
+        one before instead of skipping rows with an OFFSET.
+
+        Args:
+            query(Query): the Item query to read (defaults to all Items)
+            after_id(int): only return Items with an id greater than this one,
+                when sorting by id
+            limit(int): the maximum number of rows to return
+            chunk_size(int): fetch rows from the database this many at a time
+                and return an iterator instead of a list
+            sort(string): one of SORTS, id by default
+            after(tuple): the (value, id) of the sort field of the row to
+                start after, when sorting by another field
+        """
+        Item.logger.info('Processing row query sorted by %s after %s ...', sort,
+                         after_id if after is None else after)
+        if sort not in Item.SORTS:
+            raise DataValidationError('Invalid sort: must be one of ' + ', '.join(Item.SORTS))
+        if query is None:
+            query = Item.query
+        query = query.with_entities(*[getattr(Item, field) for field in Item.SERIALIZED_FIELDS])
+        field = getattr(Item, sort.lstrip('-'))
+        descending = sort.startswith('-')
+        unsorted = query
+        if after_id is not None:
+            query = query.filter(Item.id > after_id)
+        if after is not None and field is not Item.id:
+            query = query.filter(keyset_after(field, descending, *after))
+        if field is Item.id:
+            query = query.order_by(Item.id)
+        elif descending:
+            query = query.order_by(field.desc(), Item.id.desc())
+        else:
+            query = query.order_by(field, Item.id)
+        if limit is not None:
+            query = query.limit(limit)
+        if chunk_size is not None:
+            return query.yield_per(chunk_size)
+        rows = query.all()
+        if descending and after is not None and after[0] is not None and \
+                (limit is None or len(rows) < limit):
+            # the page reached the end of the Items with a value, the ones
+            # without come last and are read with a second seek
+            rest = unsorted.filter(field.is_(None)).order_by(Item.id.desc())
+            if limit is not None:
+                rest = rest.limit(limit - len(rows))
+            rows += rest.all()
+        return rows
+
     @staticmethod
     def find(item_id):
         """ Finds a Item by its ID """
         Item.logger.info('Processing lookup for id %s ...', item_id)
         return Item.query.get(item_id)
 
+    @staticmethod
+    def find_versioned(item_id):
+        """ Returns the version and serialized Item by its ID, reading through the cache
+
+        Returns (None, None) if there is no Item with that ID
+        """
+        key = str(item_id)
+        entry = cache.get(key)
+        if entry is None:
+            item = Item.find(item_id)
+            if not item:
+                return None, None
+            entry = [item.version, item.serialize()]
+            # add, not set: an Item changed since it was read was deleted
+            # from the cache, and that holds off the stale copy
+            cache.add(key, entry)
+        return entry[0], dict(entry[1])
+
+    @staticmethod
+    def collection_version(query=None):
+        """ Returns a summary of the Items in a query that changes whenever they do
+
+        The row count, the highest id, the sum of the versions and the
+        latest update time are read with one aggregate query, so no Item
+        has to be loaded. Any insert, update or delete changes at least
+        one of them.
+
+        Args:
+            query(Query): the Item query to summarize (defaults to all Items)
+        """
+        if query is None:
+            query = Item.query
+        return query.with_entities(func.count(Item.id), func.max(Item.id),
+                                   func.sum(Item.version), func.max(Item.updated)).one()
+
+    @staticmethod
+    def totals(query=None):
+        """ Returns the number of Items and their total count with one aggregate query
+
+        Args:
+            query(Query): the Item query to total (defaults to all Items)
+        """
+        if query is None:
+            query = Item.query
+        items, quantity = query.with_entities(func.count(Item.id),
+                                              func.coalesce(func.sum(Item.count), 0)).one()
+        return items, int(quantity)
+
+    @staticmethod
+    def summarize(query=None):
+        """ Returns the totals of the Items in a query from a single GROUP BY query
+
+        The Items are grouped by brand, sku and stored availability in the
+        database and only those groups are added up here, so no Item is
+        loaded. The availability of each group is taken from the inventory.
+
+        Args:
+            query(Query): the Item query to summarize (defaults to all Items)
+
+        Returns:
+            dict: items, quantity and subtotal for all of the Items, per brand
+                and for the available and unavailable ones
+        """
+        Item.logger.info('Processing summary query ...')
+        if query is None:
+            query = Item.query
+        quantity = func.coalesce(Item.count, 0)
+        groups = query.with_entities(Item.brand_name, Item.sku, Item.is_available,
+                                     func.count(Item.id), func.sum(quantity),
+                                     func.sum(quantity * func.coalesce(Item.price, 0), type_=db.Float)) \
+                      .group_by(Item.brand_name, Item.sku, Item.is_available).all()
+
+        def totals():
+            return {'items': 0, 'quantity': 0, 'subtotal': 0.0}
+
+        summary = totals()
+        brands = {}
+        availability = {'available': totals(), 'unavailable': totals()}
+        for brand_name, sku, is_available, items, count, subtotal in groups:
+            if brand_name not in brands:
+                brands[brand_name] = dict(totals(), brand_name=brand_name)
+            available = 'available' if inventory.available(sku, is_available) else 'unavailable'
+            for group in (summary, brands[brand_name], availability[available]):
+                group['items'] += items
+                group['quantity'] += int(count or 0)
+                group['subtotal'] += float(subtotal or 0)
+        for group in [summary] + brands.values() + availability.values():
+            group['subtotal'] = round(group['subtotal'], 2)
+        summary['brands'] = sorted(brands.values(), key=lambda group: group['brand_name'])
+        summary['availability'] = availability
+        return summary
+
+    @staticmethod
+    def find_many(item_ids, customer_id=None):
+        """ Finds the Items with the given ids in a single query
+
+        Args:
+            item_ids(list): the ids of the Items you want to find
+            customer_id(int): only find the Items in this customer's cart
+
+        Returns:
+            dict: the Items that were found keyed by their id
+        """
+        Item.logger.info('Processing lookup for %s ids ...', len(item_ids))
+        if not item_ids:
+            return {}
+        query = Item.query.filter(Item.id.in_(item_ids))
+        if customer_id is not None:
+            query = query.filter(Item.customer_id == customer_id)
+        return dict((item.id, item) for item in query)
+
     @staticmethod
     def find_or_404(item_id):
         """ Find a Item by its id """
         Item.logger.info('Processing lookup or 404 for id %s ...', item_id)
         return Item.query.get_or_404(item_id)
 
+    @staticmethod
+    def find_by_filters(sku=None, name=None, brand_name=None, price=None,
+                        min_price=None, max_price=None, is_available=None, customer_id=None):
+        """ Returns all Items matching every filter that is given
+
+        All of the filters are combined into a single query so any subset
+        of them can be used together.
+
+        Args:
+            sku(string): the sku of the Items you want to match
+            name(string): the name of the Items you want to match
+            brand_name(string): the brand_name of the Items you want to match
+            price(float): the max price of the Items, same as find_by_price
+            min_price(float): the lowest price of the Items you want to match
+            max_price(float): the highest price of the Items you want to match
+            is_available(boolean): true for items that are available
+            customer_id(int): only match the Items in this customer's cart
+        """
+        Item.logger.info('Processing filter query for sku=%s name=%s brand_name=%s '
+                         'price=%s min_price=%s max_price=%s is_available=%s '
+                         'customer_id=%s ...', sku, name, brand_name, price, min_price,
+                         max_price, is_available, customer_id)
+        query = Item.query
+        if customer_id is not None:
+            query = query.filter(Item.customer_id == customer_id)
+        if sku is not None:
+            query = query.filter(Item.sku == sku)
+        if name is not None:
+            query = query.filter(Item.name == name)
+        if brand_name is not None:
+            query = query.filter(Item.brand_name == brand_name)
+        if price is not None:
+            query = query.filter(Item.price <= price)
+        if min_price is not None:
+            query = query.filter(Item.price >= min_price)
+        if max_price is not None:
+            query = query.filter(Item.price <= max_price)
+        if is_available is not None:
+            # last, so the skus it reads are those of the other filters
+            query = Item.filter_availability(query, is_available)
+        return query
+
     @staticmethod
     def find_by_name(name):
         """ Returns all Items with the given name
@@ -134,7 +617,16 @@ class Item(db.Model):
             is_available(boolean): true for items that are available
         """
         Item.logger.info('Processing available query for %s ...', is_available)
-        return Item.query.filter(Item.is_available == is_available)
+        return Item.filter_availability(Item.query, is_available)
+
+    @staticmethod
+    def filter_availability(query, is_available):
+        """ Returns the Items of a query whose availability, as responses show it, matches
+
+        That is the inventory's availability of the sku where it has one.
+        """
+        return query.filter(inventory.available_filter(query, Item.sku, Item.is_available,
+                                                       is_available))
 
     @staticmethod
     def find_by_brand(brand_name):
@@ -145,3 +637,220 @@ class Item(db.Model):
         """
         Item.logger.info('Processing brand_name query for %s ...', brand_name)
         return Item.query.filter(Item.brand_name == brand_name)
+
+    @staticmethod
+    def search(phrase, query=None, limit=None, offset=0, max_results=None):
+        """ Returns the rows of the Items whose name, brand or sku match a search, best first
+
+        Every word of the phrase has to start a word of the name, the brand
+        or the sku. MySQL uses its FULLTEXT index and SQLite its FTS5 index,
+        both kept up to date by the database itself, and rank the matches by
+        relevance. Other databases fall back to LIKE and rank the Items with
+        the first word in their name first. The columns are in the order
+        of SERIALIZED_FIELDS.
+
+        Ranking every match of a common word is what makes a search slow, so
+        only the first max_results matches in index order are ranked and
+        paged through. A more specific search finds the others.
+
+        Args:
+            phrase(string): the words to search for
+            query(Query): the Item query to search in (defaults to all Items)
+            limit(int): the maximum number of rows to return
+            offset(int): the number of best matches to skip
+            max_results(int): the most matches to rank (SEARCH_MAX_RESULTS)
+        """
+        Item.logger.info('Processing search for %s ...', phrase)
+        terms = search_terms(phrase)
+        if not terms:
+            raise DataValidationError('Invalid search: q must contain a letter or a digit')
+        if query is None:
+            query = Item.query
+        backend = search_backend(db.session.get_bind().dialect.name)
+        descending = False
+        if backend == 'fulltext':
+            # in boolean mode + makes a word required and * matches it as a prefix
+            match = text('MATCH ({0}.name, {0}.brand_name, {0}.sku) AGAINST '
+                         '(:search IN BOOLEAN MODE)'.format(Item.__tablename__)) \
+                .bindparams(search=' '.join('+{}*'.format(term) for term in terms))
+            query = query.filter(match)
+            score, descending = func.coalesce(match, 0), True
+        elif backend == 'fts5':
+            index = table(SEARCH_TABLE, column('rowid'), column('rank'))
+            match = text('{} MATCH :search'.format(SEARCH_TABLE)) \
+                .bindparams(search=' '.join('"{}"*'.format(term) for term in terms))
+            query = query.join(index, index.c.rowid == Item.id).filter(match)
+            score = index.c.rank
+        else:
+            def starts_word(field, term):
+                return or_(field.ilike(term + '%'), field.ilike('% ' + term + '%'))
+            for term in terms:
+                query = query.filter(or_(starts_word(Item.name, term),
+                                         starts_word(Item.brand_name, term),
+                                         Item.sku.ilike(term + '%')))
+            score = case([(starts_word(Item.name, terms[0]), 0),
+                          (starts_word(Item.brand_name, terms[0]), 1)], else_=2)
+
+        # the scores are only worked out for the matches the inner query keeps
+        matches = query.with_entities(Item.id.label('id'), score.label('score')) \
+                       .limit(max_results or SEARCH_MAX_RESULTS).subquery()
+        order = desc(matches.c.score) if descending else matches.c.score
+        query = Item.query.with_entities(*[getattr(Item, field)
+                                           for field in Item.SERIALIZED_FIELDS]) \
+                    .join(matches, matches.c.id == Item.id).order_by(order, Item.id)
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+
+def keyset_after(field, descending, value, item_id):
+    """ Returns the condition for the rows after (value, item_id) in the order of field
+
+    The leading >= or <= on the field lets the database seek to the cursor
+    in the index of the sort. The databases sort NULLs first, so an
+    ascending order reads the Items without a value before the others, and
+    a descending one reads them last, which Item.rows does separately.
+    """
+    if value is None:
+        if descending:
+            return and_(field.is_(None), Item.id < item_id)
+        return or_(and_(field.is_(None), Item.id > item_id), field.isnot(None))
+    if descending:
+        return and_(field <= value, or_(field < value, Item.id < item_id))
+    return and_(field >= value, or_(field > value, Item.id > item_id))
+
+
+# The columns written by Item.add_to_cart, save_all and update_all
+UPSERT_COLUMNS = ('sku', 'count', 'price', 'name', 'link', 'brand_name', 'is_available',
+                  'customer_id')
+UPSERT_STATEMENT = 'INSERT INTO {table} ({columns}, version, updated) ' \
+                   'VALUES (:{values}, :version, :updated) {suffix}'
+
+# The most Items in one multi-row INSERT, well below the bound parameter
+# limits of the databases
+INSERT_CHUNK_SIZE = 50
+
+
+def insert_rows(items):
+    """ Inserts new Items with one multi-row INSERT and returns their ids
+
+    PostgreSQL returns the ids. SQLite gives a statement its rowids one
+    after the other and reports the last one, MySQL reports the first and
+    gives consecutive ids to a multi-row INSERT unless InnoDB interleaves
+    them (innodb_autoinc_lock_mode 2), then each Item is inserted by itself.
+    """
+    columns = Item.__table__.c
+    names = UPSERT_COLUMNS + ('version', 'updated')
+    rows = [dict((name, getattr(item, name)) for name in names) for item in items]
+    bind = db.session.get_bind()
+    dialect = bind.dialect.name
+    statement = Item.__table__.insert()
+    if dialect == 'postgresql':
+        result = db.session.execute(statement.values(rows).returning(columns.id))
+        return [row[0] for row in result]
+    if dialect == 'sqlite' or (dialect == 'mysql' and not mysql_interleaves_ids(bind)):
+        result = db.session.execute(statement.values(rows))
+        first = result.lastrowid - len(rows) + 1 if dialect == 'sqlite' else result.lastrowid
+        return range(first, first + len(rows))
+    return [db.session.execute(statement.values(row)).inserted_primary_key[0] for row in rows]
+
+
+# Whether innodb_autoinc_lock_mode is 2, by the URL of each MySQL server
+_MYSQL_LOCK_MODES = {}
+
+
+def mysql_interleaves_ids(bind):
+    """ Returns True if the MySQL server may interleave the ids of concurrent inserts """
+    url = str(bind.url)
+    if url not in _MYSQL_LOCK_MODES:
+        mode = db.session.execute(text('SELECT @@innodb_autoinc_lock_mode')).scalar()
+        _MYSQL_LOCK_MODES[url] = int(mode) == 2
+    return _MYSQL_LOCK_MODES[url]
+
+
+######################################################################
+# Search index
+######################################################################
+# At most this many words of a search are used
+SEARCH_MAX_TERMS = 8
+# At most this many matches of a search are ranked
+SEARCH_MAX_RESULTS = 1000
+# The SQLite FTS5 table that indexes the name, brand and sku of the Items
+SEARCH_TABLE = 'item_search'
+
+
+# Whether the SQLite library has FTS5, None until the first search or create_all
+SQLITE_FTS5 = None
+
+
+def sqlite_has_fts5():
+    """ Returns True if the SQLite library was built with FTS5, checking it once """
+    global SQLITE_FTS5
+    if SQLITE_FTS5 is None:
+        connection = sqlite3.connect(':memory:')
+        try:
+            connection.execute('CREATE VIRTUAL TABLE fts5_check USING fts5(text)')
+            SQLITE_FTS5 = True
+        except sqlite3.OperationalError:
+            SQLITE_FTS5 = False
+        finally:
+            connection.close()
+    return SQLITE_FTS5
+
+
+def search_terms(phrase):
+    """ Returns the lowercase words of a search phrase, split like the indexes split text """
+    return re.findall(r'[^\W_]+', (phrase or '').lower(), re.UNICODE)[:SEARCH_MAX_TERMS]
+
+
+def search_backend(dialect):
+    """ Returns the search index of a database dialect: fulltext, fts5 or like """
+    if dialect == 'mysql':
+        return 'fulltext'
+    if dialect == 'sqlite' and sqlite_has_fts5():
+        return 'fts5'
+    return 'like'
+
+
+def _uses_search_index(backend):
+    def check(ddl, target, bind, **kwargs):
+        return search_backend(bind.dialect.name) == backend
+    return check
+
+# The FTS5 table only stores the index, the text stays in the item table.
+# Triggers keep it up to date with every statement, including the bulk
+# deletes and upserts that bypass the ORM, and count changes never touch it.
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE {search} USING fts5(name, brand_name, sku, "
+    "content='{table}', content_rowid='id', prefix='1 2 3')",
+    # a name match counts the most, then the brand and then the sku
+    "INSERT INTO {search}({search}, rank) VALUES ('rank', 'bm25(10.0, 5.0, 2.0)')",
+    "CREATE TRIGGER {search}_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {search}(rowid, name, brand_name, sku) "
+    "VALUES (new.id, new.name, new.brand_name, new.sku); END",
+    "CREATE TRIGGER {search}_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {search}({search}, rowid, name, brand_name, sku) "
+    "VALUES ('delete', old.id, old.name, old.brand_name, old.sku); END",
+    "CREATE TRIGGER {search}_update AFTER UPDATE OF name, brand_name, sku ON {table} BEGIN "
+    "INSERT INTO {search}({search}, rowid, name, brand_name, sku) "
+    "VALUES ('delete', old.id, old.name, old.brand_name, old.sku); "
+    "INSERT INTO {search}(rowid, name, brand_name, sku) "
+    "VALUES (new.id, new.name, new.brand_name, new.sku); END",
+)
+MYSQL_SEARCH_DDL = (
+    'ALTER TABLE {table} ADD FULLTEXT INDEX ix_{table}_search (name, brand_name, sku)',
+)
+
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(Item.__table__, 'after_create',
+                 DDL(statement.format(search=SEARCH_TABLE, table=Item.__tablename__))
+                 .execute_if(callable_=_uses_search_index('fts5')))
+for statement in MYSQL_SEARCH_DDL:
+    event.listen(Item.__table__, 'after_create',
+                 DDL(statement.format(table=Item.__tablename__))
+                 .execute_if(callable_=_uses_search_index('fulltext')))
+event.listen(Item.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS {}'.format(SEARCH_TABLE))
+             .execute_if(callable_=_uses_search_index('fts5')))
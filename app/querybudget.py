@@ -0,0 +1,208 @@
+"""
+Query Budget module
+
+This module catches routes that run too many or too slow SQL queries
+    count_queries: context manager that records the SQL run inside it
+    QueryBudget: checks every request against a query count and time
+        budget, logging the offending statements with their EXPLAIN plan
+
+Set QUERY_BUDGET_ENABLED to check requests. QUERY_BUDGET_MAX_QUERIES
+and QUERY_BUDGET_MAX_SECONDS are the default budget and QUERY_BUDGETS
+overrides them per route, e.g. {'delete_all_items': {'max_queries': 1}}.
+With QUERY_BUDGET_STRICT a request over budget raises QueryBudgetExceeded,
+which is meant for tests.
+"""
+import time
+import logging
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+QueryRecord = namedtuple('QueryRecord', ['statement', 'parameters', 'seconds'])
+
+_local = threading.local()
+
+# The statements whose plan is logged, INSERT ... VALUES has no plan worth reading
+EXPLAINED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def session_holds_connection(session):
+    """ Returns True if a session has a connection checked out for its transaction """
+    transaction = session.transaction
+    return transaction is not None and bool(transaction._connections)
+
+
+class QueryBudgetExceeded(Exception):
+    """ Raised in strict mode when a request goes over its query budget """
+    pass
+
+
+class QueryLog(list):
+    """ The QueryRecords of the SQL run while it was active """
+
+    @property
+    def statements(self):
+        """ Returns the SQL text of every query """
+        return [record.statement for record in self]
+
+    @property
+    def seconds(self):
+        """ Returns the total time spent running the queries """
+        return sum(record.seconds for record in self)
+
+    def repeated(self):
+        """ Returns the statements that ran more than once, most repeated first """
+        counts = {}
+        for record in self:
+            counts[record.statement] = counts.get(record.statement, 0) + 1
+        return sorted([(count, statement) for statement, count in counts.items() if count > 1],
+                      reverse=True)
+
+
+def _active_logs():
+    if not hasattr(_local, 'logs'):
+        _local.logs = []
+    return _local.logs
+
+
+@contextmanager
+def count_queries():
+    """ Records every SQL query this thread runs inside the block
+
+        with count_queries() as queries:
+            Item.remove_all()
+        assert len(queries) == 1
+    """
+    log = QueryLog()
+    _active_logs().append(log)
+    try:
+        yield log
+    finally:
+        _active_logs().remove(log)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active_logs():
+        conn.info.setdefault('query_budget_started', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_budget_started')
+    if _active_logs() and started:
+        record = QueryRecord(statement, parameters, time.time() - started.pop())
+        for log in _active_logs():
+            log.append(record)
+
+
+class QueryBudget(object):
+    """ Checks the SQL run by every request against a budget """
+
+    def __init__(self, app=None, db=None):
+        self.app = app
+        self.db = db
+        self.violations = deque(maxlen=100)
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """ Registers the request hooks and the SQL query listeners """
+        self.app = app
+        self.db = db
+        app.config.setdefault('QUERY_BUDGET_ENABLED', False)
+        app.config.setdefault('QUERY_BUDGET_MAX_QUERIES', 10)
+        app.config.setdefault('QUERY_BUDGET_MAX_SECONDS', 0.25)
+        app.config.setdefault('QUERY_BUDGET_EXPLAIN', True)
+        app.config.setdefault('QUERY_BUDGET_STRICT', False)
+        app.config.setdefault('QUERY_BUDGETS', {})
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def budget(self, route):
+        """ Returns the (max_queries, max_seconds) budget of a route """
+        override = self.app.config['QUERY_BUDGETS'].get(route, {})
+        return (override.get('max_queries', self.app.config['QUERY_BUDGET_MAX_QUERIES']),
+                override.get('max_seconds', self.app.config['QUERY_BUDGET_MAX_SECONDS']))
+
+    def _before_request(self):
+        if not self.app.config['QUERY_BUDGET_ENABLED']:
+            return
+        g.query_log = QueryLog()
+        _active_logs().append(g.query_log)
+
+    def _after_request(self, response):
+        log = getattr(g, 'query_log', None)
+        if log is None:
+            return response
+        g.query_log = None
+        _active_logs().remove(log)
+        route = request.endpoint or 'unknown'
+        max_queries, max_seconds = self.budget(route)
+        if len(log) <= max_queries and log.seconds <= max_seconds:
+            return response
+
+        message = 'Route {} ran {} queries in {:.1f} ms, its budget is {} queries in {:.1f} ms'.format(
+            route, len(log), 1000 * log.seconds, max_queries, 1000 * max_seconds)
+        offenders = self._offenders(log, len(log) > max_queries)
+        violation = {'route': route, 'queries': len(log), 'seconds': log.seconds,
+                     'offenders': [record.statement for record in offenders]}
+        self.violations.append(violation)
+        logger.warning(message)
+        for record in offenders:
+            logger.warning('  %.1f ms: %s %s', 1000 * record.seconds, record.statement,
+                           record.parameters)
+            for row in self.explain(record):
+                logger.warning('    EXPLAIN %s', row)
+        if self.app.config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(message)
+        return response
+
+    @staticmethod
+    def _offenders(log, too_many):
+        """ Returns the repeated statements when there were too many, else the slowest """
+        if too_many and log.repeated():
+            repeated = set(statement for _, statement in log.repeated())
+            seen = set()
+            offenders = []
+            for record in log:
+                if record.statement in repeated and record.statement not in seen:
+                    seen.add(record.statement)
+                    offenders.append(record)
+            return offenders
+        return sorted(log, key=lambda record: record.seconds, reverse=True)[:3]
+
+    def explain(self, record):
+        """ Returns the query plan rows of a SELECT, UPDATE or DELETE, or nothing for others
+
+        The plan is read on the connection of the request's session. When
+        the session has none and the pool has no idle one, nothing is
+        explained rather than waiting for one after the response is made.
+        """
+        if not self.app.config['QUERY_BUDGET_EXPLAIN'] or self.db is None:
+            return []
+        if not record.statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+            return []
+        try:
+            engine = self.db.get_engine(self.app)
+            session = self.db.session()
+            if isinstance(engine.pool, QueuePool) and engine.pool.checkedin() == 0 and \
+                    not session_holds_connection(session):
+                return ['not explained: no idle database connection']
+            prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+            # EXPLAIN plans a statement without running it, UPDATE and DELETE included
+            cursor = session.connection().connection.cursor()
+            try:
+                cursor.execute(prefix + record.statement, record.parameters)
+                return [tuple(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        except Exception as error:
+            return ['could not explain: {}'.format(error)]
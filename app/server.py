@@ -1,10 +1,28 @@
-import sys
+import base64
+import hashlib
 import logging
-from flask import Flask, Response, jsonify, request, json, url_for, make_response, abort
+from functools import wraps
+from flask import Flask, Response, jsonify, request, json, url_for, make_response, abort, \
+                  stream_with_context
 from flask_api import status    # HTTP Status Codes
+from werkzeug.http import quote_etag
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from flasgger import Swagger
 # from app.models import Item, DataValidationError
-from app import app
+from app import app, cache, metrics, query_budget, write_behind, inventory
+from app.dbpool import pool_status
+from app.metrics import timed, timed_rows
+from app.logs import async_logging
+from app.formats import get_body, body_response, wants_msgpack, pack, MSGPACK_MIMETYPE
+
+try:
+    import simplejson as fastjson
+except ImportError:
+    import json as fastjson
+
+# Compact encoder for Item lists, uses the simplejson speedups when installed
+JSON_ENCODER = fastjson.JSONEncoder(separators=(',', ':'))
 
 #####################################################################
 # Configure Swagger before initializing it
@@ -21,7 +39,28 @@ app.config['SWAGGER'] = {
         }
     ]
 }
-Swagger(app)
+
+
+def cache_response(view):
+    """ Builds the response of a view once per path and serves the same bytes after that
+
+    Flasgger parses the YAML docstring of every route each time the spec is
+    requested, so the spec and docs views are wrapped with this. The query
+    string is left out of the key, so the cache can't grow past the routes.
+    """
+    cached = {}
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.path
+        if key not in cached:
+            response = make_response(view(*args, **kwargs))
+            cached[key] = (response.get_data(), response.status_code, response.mimetype)
+        data, code, mimetype = cached[key]
+        return Response(data, status=code, mimetype=mimetype)
+    return wrapper
+
+Swagger(app, decorators=[cache_response])
 
 ######################################################################
 # Custom Exceptions
@@ -35,11 +74,13 @@ from app.models import *
 # Error Handlers
 ######################################################################
 @app.errorhandler(DataValidationError)
+@timed('error_handler')
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
     return bad_request(error)
 
 @app.errorhandler(400)
+@timed('error_handler')
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
     message = error.message or str(error)
@@ -47,6 +88,7 @@ def bad_request(error):
     return jsonify(status=400, error='Bad Request', message=message), 400
 
 @app.errorhandler(404)
+@timed('error_handler')
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
     message = error.message or str(error)
@@ -54,13 +96,51 @@ def not_found(error):
     return jsonify(status=404, error='Not Found', message=message), 404
 
 @app.errorhandler(405)
+@timed('error_handler')
 def method_not_supported(error):
     """ Handles unsuppoted HTTP methods with 405_METHOD_NOT_SUPPORTED """
     message = error.message or str(error)
     app.logger.info(message)
     return jsonify(status=405, error='Method not Allowed', message=message), 405
 
+@app.errorhandler(StaleDataError)
+@timed('error_handler')
+def stale_data_error(error):
+    """ Handles Items changed by another request while being updated """
+    db.session.rollback()
+    return conflict(error)
+
+@app.errorhandler(IntegrityError)
+@timed('error_handler')
+def integrity_error(error):
+    """ Handles an Item whose sku is already in the customer's cart """
+    db.session.rollback()
+    if not is_duplicate_sku(error):
+        message = 'The Item breaks a constraint of the data store'
+        app.logger.info('%s: %s', message, error.orig)
+        return jsonify(status=400, error='Bad Request', message=message), 400
+    message = 'An item with that sku is already in the cart, use items:add to add to it'
+    app.logger.info(message)
+    return jsonify(status=409, error='Conflict', message=message), 409
+
+@app.errorhandler(409)
+@timed('error_handler')
+def conflict(error):
+    """ Handles conflicting updates with 409_CONFLICT """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=409, error='Conflict', message=message), 409
+
+@app.errorhandler(412)
+@timed('error_handler')
+def precondition_failed(error):
+    """ Handles failed If-Match preconditions with 412_PRECONDITION_FAILED """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=412, error='Precondition Failed', message=message), 412
+
 @app.errorhandler(415)
+@timed('error_handler')
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
     message = error.message or str(error)
@@ -68,6 +148,7 @@ def mediatype_not_supported(error):
     return jsonify(status=415, error='Unsupported media type', message=message), 415
 
 @app.errorhandler(500)
+@timed('error_handler')
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
     message = error.message or str(error)
@@ -94,7 +175,8 @@ def index():
 # LIST ALL ITEMS
 ######################################################################
 @app.route('/shopcarts/items', methods=['GET'])
-def list_items():
+@app.route('/shopcarts/<int:customer_id>/items', methods=['GET'])
+def list_items(customer_id=None):
     """
     Returns all of the Items
     This endpoint will return all items unless a query parameter is specified
@@ -103,6 +185,11 @@ def list_items():
       - Items
     description: The Items endpoint allows you to query Items
     parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
       - name: sku
         in: query
         description: the sku of the item you are looking for
@@ -118,6 +205,59 @@ def list_items():
         description: the brand of the item you are looking for
         required: false
         type: string
+      - name: price
+        in: query
+        description: the highest price of the items you are looking for
+        required: false
+        type: number
+      - name: min_price
+        in: query
+        description: the lowest price of the items you are looking for
+        required: false
+        type: number
+      - name: max_price
+        in: query
+        description: the highest price of the items you are looking for
+        required: false
+        type: number
+      - name: is_available
+        in: query
+        description: true for available items, false for unavailable items
+        required: false
+        type: boolean
+      - name: limit
+        in: query
+        description: the maximum number of items to return in one page
+        required: false
+        type: integer
+      - name: after_id
+        in: query
+        description: only return items with an id greater than this cursor
+        required: false
+        type: integer
+      - name: sort
+        in: query
+        description: the order of the items, id (the default), price, name or count,
+          with a - in front for the reverse order, e.g. -price
+        required: false
+        type: string
+      - name: after
+        in: query
+        description: the X-Next-Cursor of the last page, when sorting by another field than id
+        required: false
+        type: string
+      - name: stream
+        in: query
+        description: stream the whole list as a chunked JSON array, which can't be
+          combined with limit, after_id or after
+        required: false
+        type: boolean
+      - name: format
+        in: query
+        description: rows (the default) for an array of Items, or columns for an
+          object with an array of values per field, which is never streamed
+        required: false
+        type: string
     definitions:
       Item:
         type: object
@@ -137,36 +277,177 @@ def list_items():
     responses:
       200:
         description: An array of Items
+        headers:
+          Link:
+            type: string
+            description: URL of the next page when limit is given and more items exist
+          X-Next-Cursor:
+            type: string
+            description: after_id value to request the next page with, or the after
+              value when the list is sorted by another field
+          ETag:
+            type: string
+            description: changes whenever any Item matching the filters changes, or for
+              a page whenever any Item on it does
         schema:
             type: array
             items:
                 schema:
                     $ref: '#/definitions/Item'
     """
-    items = []
-    sku = request.args.get('sku')
-    name = request.args.get('name')
-    price = request.args.get('price')
-    is_available = request.args.get('is_available')
-    brand_name = request.args.get('brand_name')
-    if sku:
-        items = Item.find_by_sku(sku)
-    elif name:
-        items = Item.find_by_name(name)
-    elif brand_name:
-        items = Item.find_by_brand(brand_name)
-    else:
-        items = Item.all()
+    query = Item.find_by_filters(**get_item_filters(customer_id))
+    limit = get_int_arg('limit')
+    after_id = get_int_arg('after_id')
+    sort = get_sort_arg()
+    after = get_cursor_arg('after', sort)
+    if sort == 'id' and after is not None or sort != 'id' and after_id is not None:
+        raise DataValidationError('Invalid cursor: use after_id when sorting by id '
+                                  'and after otherwise')
+
+    columns = get_list_format() == 'columns'
+    chunk_size = app.config['ITEMS_STREAM_CHUNK_SIZE']
+    stream = request.args.get('stream', '').lower() in ('true', '1') and not columns and \
+        not wants_msgpack()
+    if stream and (limit is not None or after_id is not None or after is not None):
+        raise DataValidationError('Invalid stream: a stream is the whole list, '
+                                  'it takes no limit, after_id or after')
+    if stream or limit is None and after_id is None and after is None:
+        etag = collection_etag(query)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        headers = {'ETag': quote_etag(etag), 'Vary': 'Accept'}
+
+    if stream:
+        rows = live_rows(Item.rows(query, chunk_size=chunk_size, sort=sort))
+        return Response(stream_with_context(generate_items_json(rows, chunk_size)),
+                        status=status.HTTP_200_OK, headers=headers, mimetype='application/json')
+
+    if limit is None and after_id is None and after is None:
+        rows = live_rows(timed_rows(Item.rows(query, chunk_size=chunk_size, sort=sort)))
+        with timed('serialize'):
+            body, mimetype = encode_items(rows, columns, chunk_size)
+        return Response(body, status=status.HTTP_200_OK, headers=headers, mimetype=mimetype)
+
+    max_page_size = app.config['ITEMS_MAX_PAGE_SIZE']
+    if limit is None or limit > max_page_size:
+        limit = max_page_size
+    if limit < 1:
+        raise DataValidationError('Invalid limit: must be a positive integer')
+
+    # Fetch one extra row to find out if there is a next page
+    rows = list(live_rows(Item.rows(query, after_id, limit + 1, sort=sort, after=after)))
+    # a page is tagged by its own rows, the whole list needs no aggregate
+    etag = page_etag(rows)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    headers = {'ETag': quote_etag(etag), 'Vary': 'Accept'}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        args = request.args.to_dict()
+        if sort == 'id':
+            next_cursor = rows[-1][0]
+            args['after_id'] = next_cursor
+        else:
+            field = Item.SERIALIZED_FIELDS.index(sort.lstrip('-'))
+            next_cursor = encode_cursor(rows[-1][field], rows[-1][0])
+            args['after'] = next_cursor
+        args['limit'] = limit
+        headers['Link'] = '<{}>; rel="next"'.format(url_for('list_items', _external=True,
+                                                            customer_id=customer_id, **args))
+        headers['X-Next-Cursor'] = str(next_cursor)
 
-    results = [item.serialize() for item in items]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    with timed('serialize'):
+        body, mimetype = encode_items(rows, columns, chunk_size)
+    return Response(body, status=status.HTTP_200_OK, headers=headers, mimetype=mimetype)
 
 
+######################################################################
+# SEARCH ITEMS
+######################################################################
+@app.route('/shopcarts/items/search', methods=['GET'])
+@app.route('/shopcarts/<int:customer_id>/items/search', methods=['GET'])
+def search_items(customer_id=None):
+    """
+    Searches the Items
+    This endpoint returns the Items whose name, brand or sku has a word
+    starting with every word of q, the best matches first. The filters of
+    the list can narrow the search down. At most ITEMS_SEARCH_MAX_RESULTS
+    matches are ranked, a more specific q finds the others.
+    ---
+    tags:
+      - Items
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to search, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
+      - name: q
+        in: query
+        description: the words to search for, e.g. "nik run" finds Nike running shoes
+        required: true
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of items to return in one page
+        required: false
+        type: integer
+      - name: offset
+        in: query
+        description: the number of best matches to skip
+        required: false
+        type: integer
+      - name: format
+        in: query
+        description: rows (the default) for an array of Items, or columns for an
+          object with an array of values per field
+        required: false
+        type: string
+    responses:
+      200:
+        description: An array of Items, the best match first
+        headers:
+          Link:
+            type: string
+            description: URL of the next page when more items match
+        schema:
+            type: array
+            items:
+                schema:
+                    $ref: '#/definitions/Item'
+      400:
+        description: q has no words to search for
+    """
+    query = Item.find_by_filters(**get_item_filters(customer_id))
+    limit = get_int_arg('limit') or app.config['ITEMS_SEARCH_PAGE_SIZE']
+    offset = get_int_arg('offset') or 0
+    if limit < 1 or offset < 0:
+        raise DataValidationError('Invalid page: limit must be positive and offset not negative')
+    limit = min(limit, app.config['ITEMS_MAX_PAGE_SIZE'])
+    columns = get_list_format() == 'columns'
+    headers = {'Vary': 'Accept'}
+
+    # Fetch one extra row to find out if there is a next page
+    rows = Item.search(request.args.get('q'), query, limit + 1, offset,
+                       app.config['ITEMS_SEARCH_MAX_RESULTS'])
+    if len(rows) > limit:
+        rows = rows[:limit]
+        args = request.args.to_dict()
+        args['offset'] = offset + limit
+        args['limit'] = limit
+        headers['Link'] = '<{}>; rel="next"'.format(url_for('search_items', _external=True,
+                                                            customer_id=customer_id, **args))
+
+    with timed('serialize'):
+        body, mimetype = encode_items(live_rows(rows), columns)
+    return Response(body, status=status.HTTP_200_OK, headers=headers, mimetype=mimetype)
+
 ######################################################################
 # RETRIEVE A ITEM
 ######################################################################
 @app.route('/shopcarts/items/<int:item_id>', methods=['GET'])
-def get_items(item_id):
+@app.route('/shopcarts/<int:customer_id>/items/<int:item_id>', methods=['GET'])
+def get_items(item_id, customer_id=None):
     """
     Retrieve a single Item
     This endpoint will return an Item based on its id
@@ -176,29 +457,54 @@ def get_items(item_id):
     produces:
       - application/json
     parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
       - name: item_id
         in: path
         description: ID of item to retrieve
         type: integer
         required: true
+      - name: If-None-Match
+        in: header
+        description: ETag of the copy the client already has
+        type: string
+        required: false
     responses:
       200:
         description: Item returned
+        headers:
+          ETag:
+            type: string
+            description: the version of the Item
         schema:
           $ref: '#/definitions/Item'
+      304:
+        description: Item has not changed since the ETag in If-None-Match
       404:
         description: Item not found
     """
-    item = Item.find(item_id)
-    if not item:
+    version, item = Item.find_versioned(item_id)
+    if not item or not in_cart(item['customer_id'], customer_id):
         abort(status.HTTP_404_NOT_FOUND, "Item with id '{}' was not found.".format(item_id))
-    return make_response(jsonify(item.serialize()), status.HTTP_200_OK)
+    pending = write_behind.pending(item_id)
+    if pending:
+        item['count'] = max((item['count'] or 0) + pending, 0)
+    stock = inventory.digest if inventory.annotate(item) else None
+    etag = item_etag(item_id, version, pending, stock)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    with timed('serialize'):
+        return body_response(item, status.HTTP_200_OK, {'ETag': quote_etag(etag)})
 
 ######################################################################
 # ADD A NEW ITEM
 ######################################################################
 @app.route('/shopcarts/items', methods=['POST'])
-def create_items():
+@app.route('/shopcarts/<int:customer_id>/items', methods=['POST'])
+def create_items(customer_id=None):
     """
     Creates an Item
     This endpoint will create an Item based on the data in the body that is
@@ -211,6 +517,11 @@ def create_items():
     produces:
         - application/json
     parameters:
+        - name: customer_id
+          in: path
+          description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+          type: integer
+          required: false
         - in: body
           name: body
           required: true
@@ -278,19 +589,63 @@ def create_items():
     data = {}
     # Check for form submission data
     app.logger.info('Processing JSON data')
-    data = request.get_json()
+    data = get_body()
     item = Item()
     item.deserialize(data)
+    item.customer_id = customer_id
     item.save()
     message = item.serialize()
-    return make_response(jsonify(message), status.HTTP_201_CREATED,
-                         {'Location': url_for('get_items', item_id=item.id, _external=True)})
+    location = url_for('get_items', item_id=item.id, customer_id=customer_id, _external=True)
+    return body_response(message, status.HTTP_201_CREATED, {'Location': location})
+
+######################################################################
+# ADD AN ITEM TO A CUSTOMER'S CART
+######################################################################
+@app.route('/shopcarts/<int:customer_id>/items:add', methods=['POST'])
+def add_items(customer_id):
+    """
+    Add an Item to a cart
+    This endpoint will add the posted Item to the customer's cart. If an
+    Item with the same sku is already in the cart its count is increased
+    instead, in a single atomic statement.
+    ---
+    tags:
+      - Items
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to add to
+        type: integer
+        required: true
+      - in: body
+        name: body
+        required: true
+        schema:
+          $ref: '#/definitions/data'
+    responses:
+      200:
+        description: The Item in the cart after the count was added
+        schema:
+          $ref: '#/definitions/Item'
+      400:
+        description: Bad Request (the Item was not valid or its count was not positive)
+    """
+    item = Item.add_to_cart(customer_id, get_body())
+    return body_response(item.serialize(), status.HTTP_200_OK,
+                         {'ETag': quote_etag(item_etag(item.id, item.version)),
+                          'Location': url_for('get_items', item_id=item.id,
+                                              customer_id=customer_id, _external=True)})
 
 ######################################################################
 # UPDATE AN EXISTING ITEM
 ######################################################################
 @app.route('/shopcarts/items/<int:item_id>', methods=['PUT'])
-def update_items(item_id):
+@app.route('/shopcarts/<int:customer_id>/items/<int:item_id>', methods=['PUT'])
+def update_items(item_id, customer_id=None):
     """
     Update an Item
     This endpoint will update an Item based on the data in the body that is
@@ -303,6 +658,11 @@ def update_items(item_id):
     produces:
       - application/json
     parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
       - name: item_id
         in: path
         description: ID of the item to retrieve
@@ -342,6 +702,11 @@ def update_items(item_id):
             link:
               type: string
               description: URL of item
+      - name: If-Match
+        in: header
+        description: only update the Item if it still has this ETag
+        type: string
+        required: false
     responses:
       200:
         description: Item updated
@@ -349,21 +714,115 @@ def update_items(item_id):
           $ref: '#/definitions/Item'
       400:
         description: Bad Request (the posted data was not valid)
+      409:
+        description: Conflict (the Item was changed by another request at the same time,
+          or its new sku is already in the cart)
+      412:
+        description: Precondition Failed (the Item no longer has the If-Match ETag)
     """
     item = Item.find_or_404(item_id)
-    if not item:
-        raise NotFound("Item with ID '{}' was not found.".format(id))
-    item.deserialize(request.get_json())
+    if not in_cart(item.customer_id, customer_id):
+        abort(status.HTTP_404_NOT_FOUND, "Item with id '{}' was not found.".format(item_id))
+    version = get_expected_version(item_id)
+    if version is not None and item.version != version:
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              "Item with id '{}' has changed since it was read.".format(item_id))
+    item.deserialize(get_body())
     item.id = item_id
     item.save()
-    return make_response(jsonify(item.serialize()), status.HTTP_200_OK)
+    return body_response(item.serialize(), status.HTTP_200_OK,
+                         {'ETag': quote_etag(item_etag(item.id, item.version))})
+
+
+######################################################################
+# CHANGE THE COUNT OF AN EXISTING ITEM
+######################################################################
+@app.route('/shopcarts/items/<int:item_id>', methods=['PATCH'])
+@app.route('/shopcarts/<int:customer_id>/items/<int:item_id>', methods=['PATCH'])
+def increment_items(item_id, customer_id=None):
+    """
+    Change the count of an Item
+    This endpoint will add delta to the count of an Item in a single atomic
+    update, so concurrent changes are never lost. With WRITE_BEHIND_ENABLED
+    the delta is written a moment later together with the other deltas for
+    the Item, unless If-Match is given.
+    ---
+    tags:
+      - Items
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
+      - name: item_id
+        in: path
+        description: ID of the item to change
+        type: integer
+        required: true
+      - name: If-Match
+        in: header
+        description: only change the Item if it still has this ETag
+        type: string
+        required: false
+      - in: body
+        name: body
+        required: true
+        schema:
+          required:
+            - delta
+          properties:
+            delta:
+              type: integer
+              description: amount to add to the count, negative to take away
+    responses:
+      200:
+        description: Item changed
+        schema:
+          $ref: '#/definitions/Item'
+      400:
+        description: Bad Request (delta was not an integer)
+      404:
+        description: Item not found
+      409:
+        description: Conflict (the count would go below zero)
+      412:
+        description: Precondition Failed (the Item no longer has the If-Match ETag)
+    """
+    data = get_body()
+    delta = data.get('delta') if isinstance(data, dict) else None
+    if not isinstance(delta, (int, long)) or isinstance(delta, bool):
+        raise DataValidationError('Invalid request: delta must be an integer')
+    version = get_expected_version(item_id)
+    if version is None and write_behind.enabled:
+        response = buffer_count_delta(item_id, delta, customer_id)
+        if response is not None:
+            return response
+        write_behind.flush()
+    if not Item.increment_count(item_id, delta, version, customer_id):
+        item = Item.find_or_404(item_id)
+        if not in_cart(item.customer_id, customer_id):
+            abort(status.HTTP_404_NOT_FOUND, "Item with id '{}' was not found.".format(item_id))
+        if version is not None and item.version != version:
+            abort(status.HTTP_412_PRECONDITION_FAILED,
+                  "Item with id '{}' has changed since it was read.".format(item_id))
+        abort(status.HTTP_409_CONFLICT,
+              "Count of item with id '{}' cannot go below zero.".format(item_id))
+    version, item = Item.find_versioned(item_id)
+    return body_response(item, status.HTTP_200_OK,
+                         {'ETag': quote_etag(item_etag(item_id, version))})
 
 
 ######################################################################
 # DELETE A ITEM
 ######################################################################
 @app.route('/shopcarts/items/<int:item_id>', methods=['DELETE'])
-def delete_items(item_id):
+@app.route('/shopcarts/<int:customer_id>/items/<int:item_id>', methods=['DELETE'])
+def delete_items(item_id, customer_id=None):
     """
     Delete an Item
     This endpoint will delete an Item based on the id specified in the path
@@ -374,6 +833,11 @@ def delete_items(item_id):
       - application/json
     description: Deletes an Item from the database
     parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
       - name: item_id
         in: path
         description: ID of item to delete
@@ -384,33 +848,368 @@ def delete_items(item_id):
         description:    Item deleted
     """
     item = Item.find(item_id)
-    if item:
+    if item and in_cart(item.customer_id, customer_id):
         item.delete()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# ADD A BATCH OF NEW ITEMS
+######################################################################
+@app.route('/shopcarts/items:batch', methods=['POST'])
+@app.route('/shopcarts/<int:customer_id>/items:batch', methods=['POST'])
+def create_items_batch(customer_id=None):
+    """
+    Creates a batch of Items
+    This endpoint will create every Item in the posted array in a single
+    transaction. If any Item is invalid nothing is created.
+    ---
+    tags:
+      - Items
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/data'
+    responses:
+      201:
+        description: Items created, with one result per posted Item
+      400:
+        description: Bad Request (nothing was created, results list the invalid Items)
+    """
+    rows = get_batch_data()
+    items = []
+    errors = []
+    for index, data in enumerate(rows):
+        try:
+            item = Item().deserialize(data)
+            item.customer_id = customer_id
+            items.append(item)
+        except DataValidationError as error:
+            errors.append(batch_result(index, status.HTTP_400_BAD_REQUEST, error=str(error)))
+    if errors:
+        return batch_error_response(errors, len(rows))
+
+    Item.save_all(items)
+    results = [batch_result(index, status.HTTP_201_CREATED, item=item.serialize())
+               for index, item in enumerate(items)]
+    return body_response({'results': results}, status.HTTP_201_CREATED)
+
+######################################################################
+# UPDATE A BATCH OF EXISTING ITEMS
+######################################################################
+@app.route('/shopcarts/items:batch', methods=['PUT'])
+@app.route('/shopcarts/<int:customer_id>/items:batch', methods=['PUT'])
+def update_items_batch(customer_id=None):
+    """
+    Update a batch of Items
+    This endpoint will update every Item in the posted array in a single
+    transaction. Each Item must carry its id, once. If any Item is invalid
+    or missing nothing is updated.
+    ---
+    tags:
+      - Items
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/Item'
+    responses:
+      200:
+        description: Items updated, with one result per posted Item
+      400:
+        description: Bad Request (nothing was updated, results list the failed Items)
+    """
+    rows = get_batch_data()
+    item_ids = [data.get('id') for data in rows if isinstance(data, dict)]
+    found = Item.find_many([item_id for item_id in item_ids if is_item_id(item_id)],
+                           customer_id)
+    items = []
+    errors = []
+    seen = set()
+    for index, data in enumerate(rows):
+        item_id = data.get('id') if isinstance(data, dict) else None
+        if not is_item_id(item_id):
+            errors.append(batch_result(index, status.HTTP_400_BAD_REQUEST,
+                                       error='Invalid item: missing id'))
+            continue
+        if item_id in seen:
+            errors.append(batch_result(index, status.HTTP_400_BAD_REQUEST,
+                                       error="Invalid item: id '{}' is in the batch twice"
+                                       .format(item_id)))
+            continue
+        seen.add(item_id)
+        stored = found.get(item_id)
+        if not stored:
+            errors.append(batch_result(index, status.HTTP_404_NOT_FOUND,
+                                       error="Item with id '{}' was not found.".format(item_id)))
+            continue
+        try:
+            # a detached copy, so the stored Items are never flushed by the ORM
+            item = Item().deserialize(data)
+        except DataValidationError as error:
+            errors.append(batch_result(index, status.HTTP_400_BAD_REQUEST, error=str(error)))
+            continue
+        item.id, item.version, item.customer_id = item_id, stored.version, stored.customer_id
+        items.append(item)
+    if errors:
+        return batch_error_response(errors, len(rows))
+
+    Item.update_all(items)
+    results = [batch_result(index, status.HTTP_200_OK, item=item.serialize())
+               for index, item in enumerate(items)]
+    return body_response({'results': results}, status.HTTP_200_OK)
+
+######################################################################
+# DELETE A BATCH OF ITEMS
+######################################################################
+@app.route('/shopcarts/items:batch', methods=['DELETE'])
+@app.route('/shopcarts/<int:customer_id>/items:batch', methods=['DELETE'])
+def delete_items_batch(customer_id=None):
+    """
+    Delete a batch of Items
+    This endpoint will delete every Item whose id is in the posted array
+    with a single statement
+    ---
+    tags:
+      - Items
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: integer
+    responses:
+      200:
+        description: Items deleted, with one result per id (404 if it did not exist)
+      400:
+        description: Bad Request (the ids were not unique integers)
+    """
+    item_ids = get_batch_data()
+    if not all(is_item_id(item_id) for item_id in item_ids):
+        raise DataValidationError('Invalid batch: ids must be integers')
+    if len(set(item_ids)) != len(item_ids):
+        raise DataValidationError('Invalid batch: ids must be unique')
+    found = Item.find_many(item_ids, customer_id)
+    Item.delete_many(list(found))
+    results = [batch_result(index, status.HTTP_204_NO_CONTENT if item_id in found
+                            else status.HTTP_404_NOT_FOUND, id=item_id)
+               for index, item_id in enumerate(item_ids)]
+    return body_response({'results': results}, status.HTTP_200_OK)
+
 ######################################################################
 # (ACTION) DELETE ALL ITEMS
 ######################################################################
 @app.route('/shopcarts/clear', methods=['DELETE'])
-def delete_all_items():
+@app.route('/shopcarts/<int:customer_id>/clear', methods=['DELETE'])
+def delete_all_items(customer_id=None):
     """
     Delete all items
 
-    This is an action endpoint which clears the shopcart
+    This is an action endpoint which clears the shopcart. The same filters
+    as the item list can be given to clear only the matching Items. Under
+    /shopcarts/{customer_id} only that customer's cart is cleared.
     ---
     tags:
      - Items
     description: Deletes all Item from the database
+    parameters:
+     - name: customer_id
+       in: path
+       description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+       type: integer
+       required: false
+     - name: brand_name
+       in: query
+       description: only delete items of this brand
+       required: false
+       type: string
+     - name: is_available
+       in: query
+       description: only delete available (true) or unavailable (false) items
+       required: false
+       type: boolean
     responses:
      204:
        description: Deleted all Items
+       headers:
+         X-Deleted-Count:
+           type: integer
+           description: the number of Items that were deleted
     """
+    count = Item.remove_all(**get_item_filters(customer_id))
+    return make_response('', status.HTTP_204_NO_CONTENT, {'X-Deleted-Count': str(count)})
 
-    items = Item.all()
-    for i in items:
-        i.delete()
+######################################################################
+# (ACTION) COUNT THE ITEMS
+######################################################################
+@app.route('/shopcarts/count', methods=['GET'])
+@app.route('/shopcarts/<int:customer_id>/count', methods=['GET'])
+def count_items(customer_id=None):
+    """
+    Count the items
 
-    return make_response('', status.HTTP_204_NO_CONTENT)
+    This is an action endpoint which returns the number of Items and their
+    total quantity with one aggregate query. It takes the same filters as
+    the item list.
+    ---
+    tags:
+     - Items
+    produces:
+     - application/json
+    parameters:
+     - name: customer_id
+       in: path
+       description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+       type: integer
+       required: false
+    responses:
+     200:
+       description: The number of Items and the sum of their counts
+       schema:
+         properties:
+           items:
+             type: integer
+           quantity:
+             type: integer
+    """
+    items, quantity = Item.totals(Item.find_by_filters(**get_item_filters(customer_id)))
+    return make_response(jsonify(items=items, quantity=quantity), status.HTTP_200_OK)
+
+######################################################################
+# SUMMARIZE THE ITEMS
+######################################################################
+@app.route('/shopcarts/summary', methods=['GET'])
+@app.route('/shopcarts/<int:customer_id>/summary', methods=['GET'])
+def summarize_items(customer_id=None):
+    """
+    Summarize the Items
+    This endpoint returns the totals a checkout page needs, computed by the
+    database with one aggregate query. It takes the same filters as the
+    item list.
+    ---
+    tags:
+      - Items
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the customer whose cart to use, only in the /shopcarts/{customer_id} routes
+        type: integer
+        required: false
+      - name: brand_name
+        in: query
+        description: only summarize items of this brand
+        required: false
+        type: string
+      - name: is_available
+        in: query
+        description: only summarize available (true) or unavailable (false) items
+        required: false
+        type: boolean
+      - name: min_price
+        in: query
+        description: only summarize items that cost at least this much
+        required: false
+        type: number
+      - name: max_price
+        in: query
+        description: only summarize items that cost at most this much
+        required: false
+        type: number
+    responses:
+      200:
+        description: The number of Items, their quantity and subtotal, in total,
+          per brand and per availability
+    """
+    summary = Item.summarize(Item.find_by_filters(**get_item_filters(customer_id)))
+    return make_response(jsonify(summary), status.HTTP_200_OK)
+
+######################################################################
+# SERVICE STATISTICS
+######################################################################
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    Returns the service statistics
+    This endpoint reports the Item cache counters, the database
+    connection pool usage used to size them, the recent requests
+    that went over their query budget, the log records dropped or
+    left out by sampling, the count deltas waiting to be written and
+    the inventory snapshot
+    ---
+    tags:
+      - Service
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Cache, connection pool, query budget, logging, write behind and
+          inventory statistics
+    """
+    return make_response(jsonify(cache=cache.stats(), pool=pool_status(db.engine.pool),
+                                 query_budget=list(query_budget.violations),
+                                 logging=async_logging.stats(),
+                                 write_behind=write_behind.stats(),
+                                 inventory=inventory.stats()),
+                         status.HTTP_200_OK)
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns the request metrics
+    This endpoint reports per route histograms of request time, SQL
+    queries and serialization time in the Prometheus text format. They
+    are only recorded when METRICS_ENABLED is set.
+    ---
+    tags:
+      - Service
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Histograms in the Prometheus text format
+    """
+    return Response(metrics.registry.render(), status=status.HTTP_200_OK,
+                    mimetype='text/plain; version=0.0.4')
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -420,23 +1219,282 @@ def init_db():
     """ Initialies the SQLAlchemy app """
     Item.init_db()
 
+def get_int_arg(name):
+    """ Returns an integer query parameter or None if it was not given """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise DataValidationError('Invalid {}: {} is not an integer'.format(name, value))
+
+def get_float_arg(name):
+    """ Returns a float query parameter or None if it was not given """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise DataValidationError('Invalid {}: {} is not a number'.format(name, value))
+
+def get_bool_arg(name):
+    """ Returns a boolean query parameter or None if it was not given """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise DataValidationError('Invalid {}: {} is not a boolean'.format(name, value))
+
+def get_item_filters(customer_id=None):
+    """ Collects the Item filters from the query string into a dictionary
+
+    Args:
+        customer_id(int): also match only the Items in this customer's cart
+    """
+    filters = {
+        'customer_id': customer_id,
+        'sku': request.args.get('sku') or None,
+        'name': request.args.get('name') or None,
+        'brand_name': request.args.get('brand_name') or None,
+        'price': get_float_arg('price'),
+        'min_price': get_float_arg('min_price'),
+        'max_price': get_float_arg('max_price'),
+        'is_available': get_bool_arg('is_available')
+    }
+    return dict((key, value) for key, value in filters.items() if value is not None)
+
+def get_sort_arg():
+    """ Returns the sort order asked for, id by default """
+    sort = request.args.get('sort') or 'id'
+    if sort not in Item.SORTS:
+        raise DataValidationError('Invalid sort: {} is not one of {}'.format(
+            sort, ', '.join(Item.SORTS)))
+    return sort
+
+def encode_cursor(value, item_id):
+    """ Returns the opaque cursor of the row with this sort value and id """
+    # without the = padding, which would have to be escaped in a URL
+    return base64.urlsafe_b64encode(json.dumps([value, item_id], separators=(',', ':'))) \
+        .rstrip('=')
+
+# The JSON types of the sort value in a cursor, which may also be null
+CURSOR_VALUE_TYPES = {'price': (int, long, float), 'count': (int, long), 'name': basestring}
+
+def get_cursor_arg(name, sort='id'):
+    """ Returns the (value, id) of a cursor query parameter or None if it was not given
+
+    The value must have the type of the sort field, a cursor that was
+    tampered with is a bad request rather than a failed query.
+    """
+    cursor = request.args.get(name)
+    if not cursor:
+        return None
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii') + padding))
+    except (ValueError, TypeError, UnicodeError):
+        raise DataValidationError('Invalid {}: {} is not a cursor'.format(name, cursor))
+    field = sort.lstrip('-')
+    if not is_item_id(item_id):
+        raise DataValidationError('Invalid {}: {} is not a cursor'.format(name, cursor))
+    if field in CURSOR_VALUE_TYPES and value is not None and \
+            (isinstance(value, bool) or not isinstance(value, CURSOR_VALUE_TYPES[field])):
+        raise DataValidationError('Invalid {}: {} is not a cursor of {}'.format(name, cursor,
+                                                                               field))
+    return value, item_id
+
+def get_list_format():
+    """ Returns the shape of Item list asked for, rows (the default) or columns """
+    value = request.args.get('format') or 'rows'
+    if value not in ('rows', 'columns'):
+        raise DataValidationError('Invalid format: {} is not rows or columns'.format(value))
+    return value
+
+def is_item_id(value):
+    """ Returns True if a value decoded from JSON is an integer id, not true or false """
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def in_cart(owner_id, customer_id):
+    """ Returns True if an Item owned by owner_id can be used under customer_id
+
+    The /shopcarts/items routes (customer_id None) can use every Item.
+    """
+    return customer_id is None or owner_id == customer_id
+
+def item_etag(item_id, version, pending=0, stock=None):
+    """ Returns the strong ETag of one version of an Item
+
+    A count delta that is not written yet is added after a dot, it has no
+    version of its own until it is, and so is the digest of the inventory
+    snapshot that is_available was taken from.
+    """
+    etag = '{}-{}'.format(item_id, version)
+    if pending:
+        etag += '.{}'.format(pending)
+    if stock is not None:
+        etag += '.s{}'.format(stock)
+    return etag
+
+def collection_etag(query):
+    """ Returns the ETag of a list of Items without loading any of them """
+    summary = Item.collection_version(query)
+    # pending count deltas change the list before its rows do
+    pending = write_behind.changes() if write_behind.has_pending() else ''
+    key = '{}?{}|{}|{}|{}|{}'.format(request.path, request.query_string, wants_msgpack(),
+                                     '|'.join(str(value) for value in summary), pending,
+                                     inventory.version())
+    return hashlib.md5(key).hexdigest()
+
+def page_etag(rows):
+    """ Returns the ETag of a page of Items from the rows it is made of """
+    key = '{}?{}|{}|{!r}'.format(request.path, request.query_string, wants_msgpack(), rows)
+    return hashlib.md5(key).hexdigest()
+
+def get_expected_version(item_id):
+    """ Returns the Item version the If-Match header requires
+
+    Returns None when the header is missing or is *, so any version will do.
+    Aborts with 412_PRECONDITION_FAILED when no ETag in it is for this Item.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    # compressed responses carry the weak form of the same ETag
+    for etag in request.if_match.as_set(include_weak=True):
+        prefix, _, version = etag.partition('-')
+        version, _, pending = version.partition('.')
+        if prefix != str(item_id) or not version.isdigit():
+            continue
+        # the pending deltas have been written by now, with the next version
+        pending = pending.partition('.')[0]
+        if pending.lstrip('-').isdigit():
+            return write_behind.written_version(item_id, int(version), int(pending)) or \
+                int(version)
+        return int(version)
+    abort(status.HTTP_412_PRECONDITION_FAILED,
+          "If-Match does not name a version of item with id '{}'.".format(item_id))
+
+def live_rows(rows):
+    """ Returns Item rows with the unwritten count deltas and the inventory's availability """
+    fields = Item.SERIALIZED_FIELDS
+    rows = write_behind.overlay(rows, fields.index('count'))
+    return inventory.annotate_rows(rows, fields.index('sku'), fields.index('is_available'))
+
+def buffer_count_delta(item_id, delta, customer_id=None):
+    """ Buffers a count delta and returns the changed Item as a response
+
+    Returns None when the delta has to be written now, and then that
+    write finds out whether the Item exists or its count would go below zero.
+    """
+    if delta < 0:
+        # the cached count may be behind, a decrement is checked on the stored one
+        stored = Item.find(item_id)
+        version, item = (stored.version, stored.serialize()) if stored else (None, None)
+    else:
+        version, item = Item.find_versioned(item_id)
+    if not item or not in_cart(item['customer_id'], customer_id):
+        return None
+    pending = write_behind.add(item_id, delta, item['count'] or 0, version)
+    if pending is None:
+        return None
+    item['count'] = max((item['count'] or 0) + pending, 0)
+    return body_response(item, status.HTTP_200_OK,
+                         {'ETag': quote_etag(item_etag(item_id, version, pending))})
+
+def is_duplicate_sku(error):
+    """ Returns True if an IntegrityError broke the unique index on customer_id and sku """
+    # MySQL and PostgreSQL name the index, SQLite its columns
+    message = str(error.orig)
+    return 'ix_item_customer_id_sku' in message or \
+        'item.customer_id, item.sku' in message
+
+def not_modified(etag):
+    """ Tells the client that its copy identified by etag is still current """
+    return make_response('', status.HTTP_304_NOT_MODIFIED, {'ETag': quote_etag(etag)})
+
+def get_batch_data():
+    """ Returns the array of Items posted to a batch endpoint """
+    rows = get_body()
+    if not isinstance(rows, list):
+        raise DataValidationError('Invalid batch: body of request must be an array')
+    if len(rows) > app.config['ITEMS_MAX_BATCH_SIZE']:
+        raise DataValidationError('Invalid batch: at most {} items are allowed'.format(
+            app.config['ITEMS_MAX_BATCH_SIZE']))
+    return rows
+
+def batch_result(index, code, **fields):
+    """ Builds the result reported for one row of a batch """
+    result = {'index': index, 'status': code}
+    result.update(fields)
+    return result
+
+def batch_error_response(errors, total):
+    """ Rejects a whole batch, reporting the rows that failed """
+    message = 'Nothing was changed: {} of {} items failed'.format(len(errors), total)
+    app.logger.info(message)
+    return make_response(jsonify(status=400, error='Bad Request', message=message,
+                                 results=errors), status.HTTP_400_BAD_REQUEST)
+
+def generate_items_json(rows, chunk_size=500):
+    """ Yields a JSON array of Item rows in chunks so the list is never held in memory
+
+    Args:
+        rows: row tuples in the order of Item.SERIALIZED_FIELDS
+        chunk_size(int): the number of rows encoded and written at a time
+    """
+    yield '['
+    first = True
+    fields = Item.SERIALIZED_FIELDS
+    chunk = []
+    for row in rows:
+        chunk.append(dict(zip(fields, row)))
+        if len(chunk) >= chunk_size:
+            # encoding the chunk as one list keeps the loop in the C encoder
+            yield ('' if first else ',') + JSON_ENCODER.encode(chunk)[1:-1]
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + JSON_ENCODER.encode(chunk)[1:-1]
+    yield ']'
+
+def columns_dict(rows):
+    """ Returns Item rows as a dictionary with a list of values per field """
+    columns = zip(*rows) or [()] * len(Item.SERIALIZED_FIELDS)
+    return dict(zip(Item.SERIALIZED_FIELDS, [list(column) for column in columns]))
+
+def columns_json(rows):
+    """ Returns Item rows as a JSON object with an array of values per field """
+    return JSON_ENCODER.encode(columns_dict(rows))
+
+def encode_items(rows, columns=False, chunk_size=500):
+    """ Returns Item rows encoded in the format the client asked for, and its mimetype
+
+    Args:
+        rows: row tuples in the order of Item.SERIALIZED_FIELDS
+        columns(bool): a list of values per field instead of an object per Item
+        chunk_size(int): the number of rows encoded at a time
+    """
+    if wants_msgpack():
+        fields = Item.SERIALIZED_FIELDS
+        data = columns_dict(rows) if columns else [dict(zip(fields, row)) for row in rows]
+        return pack(data), MSGPACK_MIMETYPE
+    if columns:
+        return columns_json(rows), 'application/json'
+    return ''.join(generate_items_json(rows, chunk_size)), 'application/json'
+
 #@app.before_first_request
 def initialize_logging(log_level=logging.INFO):
-    """ Initialized the default logging to STDOUT """
+    """ Initialized the default logging to STDOUT
+
+    Records are written by a background thread so requests only queue
+    them, see app.logs for the format, sampling and request ids.
+    """
     if not app.debug:
         print 'Setting up logging...'
-        # Set up default logging for submodules to use STDOUT
-        # datefmt='%m/%d/%Y %I:%M:%S %p'
-        fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-        logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
-        # Make a new log handler that uses STDOUT
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter(fmt))
-        handler.setLevel(log_level)
-        # Remove the Flask default handlers and use our own
-        handler_list = list(app.logger.handlers)
-        for log_handler in handler_list:
-            app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
-        app.logger.setLevel(log_level)
+        # Remove the Flask default handlers and log through the queue instead
+        async_logging.configure(app, log_level)
         app.logger.info('Logging handler established')
@@ -2,7 +2,7 @@
 VCAP Services module
 
 This module initializes the database connection String
-from VCAP_SERVICES in Bluemix if Found
+and connection pool settings from VCAP_SERVICES in Bluemix if Found
 """
 import os
 import json
@@ -12,6 +12,11 @@ def get_database_uri():
     """
         Initialized MySQL database connection
     """
+    # An explicit URI always wins
+    if 'DATABASE_URI' in os.environ:
+        logging.info("Using DATABASE_URI...")
+        return os.environ['DATABASE_URI']
+
     # Get the credentials from the Bluemix environment
     if 'VCAP_SERVICES' in os.environ:
         logging.info("Using VCAP_SERVICES...")
@@ -45,7 +50,27 @@ def get_database_uri():
         return connect_string.format(username, hostname, port, name)
     else:
         connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
-        returning_connect_string = connect_string.format(username, password, hostname, port, name)
-        logging.info("DB URI %s", returning_connect_string)
-        #return connect_string.format(username, password, hostname, port, name)
-        return returning_connect_string
+        return connect_string.format(username, password, hostname, port, name)
+
+def get_pool_options():
+    """
+        Returns the database connection pool settings
+
+        ClearDB on Bluemix allows only a few connections per database and
+        closes idle ones after a minute, so the defaults are smaller there.
+        Every setting can be overridden with an environment variable.
+    """
+    if 'VCAP_SERVICES' in os.environ:
+        pool_size, max_overflow, recycle, timeout = 2, 0, 50, 10
+    else:
+        pool_size, max_overflow, recycle, timeout = 5, 10, 3600, 30
+
+    options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', pool_size)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', max_overflow)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', recycle)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', timeout)),
+        'pre_ping': os.getenv('DB_POOL_PRE_PING', 'True') == 'True'
+    }
+    logging.info("Database pool options %s", options)
+    return options
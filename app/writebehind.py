@@ -0,0 +1,234 @@
+"""
+Write Behind module
+
+This module coalesces the count changes of Items
+    WriteBehind: collects the count deltas of PATCH requests per Item in
+        memory and writes them from a background thread, one UPDATE per
+        Item for all of the deltas it got since the last flush
+
+Set WRITE_BEHIND_ENABLED to turn it on. WRITE_BEHIND_INTERVAL is how many
+seconds deltas are collected before they are written and
+WRITE_BEHIND_MAX_STALENESS the most seconds a delta may wait: when the
+writes fall that far behind, requests write their deltas themselves.
+WRITE_BEHIND_MAX_ITEMS bounds the Items with pending deltas.
+
+Reads of Items in this process see the pending deltas, the count and
+summary write them first. Other processes see them once they are
+written, at most WRITE_BEHIND_MAX_STALENESS later. Every other change to
+Items, and every PATCH with an If-Match header, writes the pending deltas
+of this process first so it is applied in order. The deltas still
+pending when the process exits are written before it does.
+
+The ETag of an Item with pending deltas names the version they were
+buffered on and their sum. Once written, the Item has the next version,
+and an If-Match with that ETag is taken for it in the process that
+buffered the deltas; other processes answer 412 and the client reads the
+Item again. A change sent to another process is not ordered against the
+deltas buffered here: a PUT there may land before them, and they are
+then added to the count it set.
+"""
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from flask import request
+from app.background import Worker
+
+logger = logging.getLogger(__name__)
+
+# The reads that add up counts in the database, so the deltas are written first
+FLUSHED_READS = ('count_items', 'summarize_items')
+
+
+class WriteBehind(object):
+    """ Buffers the count deltas of the app when WRITE_BEHIND_ENABLED is set """
+
+    def __init__(self, app=None, db=None):
+        self.app = app
+        self.db = db
+        self.flushes = 0
+        self.flushed_deltas = 0
+        self.failures = 0
+        self._pending = {}
+        self._writing = {}
+        self._bases = {}
+        self._written = OrderedDict()
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker = Worker('write-behind', self._run,
+                              lambda: self.app.config['WRITE_BEHIND_INTERVAL'])
+        self._changes = 0
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """ Registers the request hook and the flush on exit """
+        self.app = app
+        self.db = db
+        app.config.setdefault('WRITE_BEHIND_ENABLED', False)
+        app.config.setdefault('WRITE_BEHIND_INTERVAL', 0.1)
+        app.config.setdefault('WRITE_BEHIND_MAX_STALENESS', 1.0)
+        app.config.setdefault('WRITE_BEHIND_MAX_ITEMS', 10000)
+        app.before_request(self._before_request)
+        atexit.register(self.stop)
+
+    @property
+    def enabled(self):
+        """ True if count deltas are buffered """
+        return self.app.config['WRITE_BEHIND_ENABLED']
+
+    def add(self, item_id, delta, count=0, version=None):
+        """ Buffers a count delta for an Item whose stored count is count
+
+        version is the stored version of the Item, which the ETag of the
+        Item names until its deltas are written.
+
+        Returns the delta now pending for the Item. Returns None without
+        buffering anything when the count would go below zero, the buffer
+        is full or its oldest delta is older than WRITE_BEHIND_MAX_STALENESS,
+        then the caller has to flush and write the delta itself.
+        """
+        self._worker.start()
+        now = time.time()
+        with self._lock:
+            if self._oldest is not None and \
+                    now - self._oldest > self.app.config['WRITE_BEHIND_MAX_STALENESS']:
+                return None
+            if item_id not in self._pending and \
+                    len(self._pending) >= self.app.config['WRITE_BEHIND_MAX_ITEMS']:
+                return None
+            pending = self._pending.get(item_id, 0) + self._writing.get(item_id, 0) + delta
+            if count + pending < 0:
+                return None
+            self._pending[item_id] = self._pending.get(item_id, 0) + delta
+            self._bases.setdefault(item_id, version)
+            if self._oldest is None:
+                self._oldest = now
+            self._changes += 1
+        return pending
+
+    def pending(self, item_id):
+        """ Returns the count delta of an Item that is not in the database yet """
+        if not self.has_pending():
+            return 0
+        with self._lock:
+            return self._pending.get(item_id, 0) + self._writing.get(item_id, 0)
+
+    def written_version(self, item_id, version, pending):
+        """ Returns the version the deltas named by an ETag were written as
+
+        Returns None unless the last flush wrote exactly pending on top of
+        version for this Item, which then has the version after it.
+        """
+        if (version, pending) != self._written.get(item_id):
+            return None
+        return version + 1
+
+    def has_pending(self):
+        """ Returns True if any delta is not in the database yet """
+        return bool(self._pending or self._writing)
+
+    def changes(self):
+        """ Returns a number that changes whenever a delta is buffered or written """
+        return self._changes
+
+    def overlay(self, rows, count_index):
+        """ Returns Item row tuples with their pending deltas added to the count
+
+        Args:
+            rows: row tuples starting with the id of the Item
+            count_index(int): the position of the count in a row
+        """
+        if not self.has_pending():
+            return rows
+        return (self._overlay_row(row, count_index) for row in rows)
+
+    def _overlay_row(self, row, count_index):
+        delta = self.pending(row[0])
+        if not delta:
+            return row
+        return row[:count_index] + (max((row[count_index] or 0) + delta, 0),) + \
+            row[count_index + 1:]
+
+    def flush(self):
+        """ Writes every pending delta in one transaction, one UPDATE per Item
+
+        Returns the number of Items written. Deltas that fail to write are
+        put back and written with the next flush.
+        """
+        from app.models import Item
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._writing, self._pending = self._pending, {}
+                bases, self._bases = self._bases, {}
+                oldest, self._oldest = self._oldest, None
+            deltas = self._writing
+            try:
+                Item.apply_count_deltas(deltas)
+            except Exception:
+                self.db.session.rollback()
+                with self._lock:
+                    for item_id, delta in deltas.items():
+                        self._pending[item_id] = self._pending.get(item_id, 0) + delta
+                    bases.update(self._bases)
+                    self._bases = bases
+                    self._writing = {}
+                    self._oldest = min(oldest, self._oldest or oldest)
+                self.failures += 1
+                raise
+            with self._lock:
+                self._writing = {}
+                self._changes += 1
+                # remembered for the ETags handed out while they were pending
+                for item_id, delta in deltas.items():
+                    self._written.pop(item_id, None)
+                    if bases.get(item_id) is not None:
+                        self._written[item_id] = (bases[item_id], delta)
+                while len(self._written) > self.app.config['WRITE_BEHIND_MAX_ITEMS']:
+                    self._written.popitem(last=False)
+            self.flushes += 1
+            self.flushed_deltas += len(deltas)
+            return len(deltas)
+
+    def stop(self):
+        """ Stops the flusher thread and writes the deltas still pending """
+        self._worker.stop()
+        if self._pending and self.app is not None:
+            with self.app.app_context():
+                try:
+                    self.flush()
+                finally:
+                    self.db.session.remove()
+
+    def stats(self):
+        """ Returns the pending deltas and what the flushes wrote so far """
+        return {'enabled': self.enabled, 'pending_items': len(self._pending),
+                'flushes': self.flushes, 'flushed_items': self.flushed_deltas,
+                'failures': self.failures}
+
+    def _run(self):
+        if not self._pending:
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing the pending count deltas failed, retrying')
+            finally:
+                self.db.session.remove()
+
+    def _before_request(self):
+        # Other changes must not overtake the deltas written before them,
+        # and the totals are added up by the database
+        if not self.has_pending():
+            return
+        if request.method in ('GET', 'HEAD', 'OPTIONS') and \
+                request.endpoint not in FLUSHED_READS:
+            return
+        if request.endpoint == 'increment_items' and not request.if_match:
+            return
+        self.flush()
@@ -0,0 +1,77 @@
+"""
+Benchmarks module
+
+This module contains benchmarks for the shopcart service. They run
+against the Flask app in process, using a temporary SQLite file unless
+the DATABASE_URI environment variable points at another database.
+"""
+import os
+import tempfile
+from app import app, db
+from app.models import Item
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+def setup_database():
+    """ Points the app at the benchmark database and creates fresh tables
+
+    Returns the path of the temporary SQLite file, or None when
+    DATABASE_URI is used, so the caller can remove it afterwards.
+    """
+    path = None
+    if DATABASE_URI:
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+    else:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='shopcarts-bench-')
+        os.close(handle)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.debug = False
+    db.drop_all()
+    db.create_all()
+    return path
+
+
+def teardown_database(path):
+    """ Drops the benchmark tables and removes the temporary SQLite file """
+    db.session.remove()
+    db.drop_all()
+    db.get_engine(app).dispose()
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def percentile(values, fraction):
+    """ Returns the value below which fraction of the sorted values fall """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def latency_summary(seconds):
+    """ Summarizes a list of request latencies in milliseconds """
+    values = sorted(1000.0 * value for value in seconds)
+    return {'count': len(values),
+            'mean_ms': sum(values) / len(values) if values else 0.0,
+            'p50_ms': percentile(values, 0.50),
+            'p95_ms': percentile(values, 0.95),
+            'p99_ms': percentile(values, 0.99),
+            'max_ms': values[-1] if values else 0.0}
+
+
+def make_item_data(index):
+    """ Returns the dictionary for a sample Item """
+    return {'sku': 'SKU{:07d}'.format(index), 'count': index % 10 + 1,
+            'price': float(index % 500) + 0.99, 'name': 'item{}'.format(index),
+            'link': 'example.com/{}'.format(index), 'brand_name': 'brand{}'.format(index % 20),
+            'is_available': index % 3 != 0}
+
+
+def seed_items(total, chunk_size=1000, start=0):
+    """ Inserts the sample Items numbered start up to total through the Item model """
+    for first in range(start, total, chunk_size):
+        items = [Item().deserialize(make_item_data(index))
+                 for index in range(first, min(first + chunk_size, total))]
+        Item.save_all(items)
+    db.session.remove()
@@ -0,0 +1,75 @@
+"""
+Batch Benchmark
+
+Compares creating, updating and deleting Items one request at a time
+against the single-transaction /shopcarts/items:batch endpoints.
+
+Usage:
+    python -m benchmarks.batch [--items 50] [--rounds 5]
+"""
+import argparse
+import json
+import time
+from app import app
+from benchmarks import setup_database, teardown_database, make_item_data
+
+HEADERS = {'Content-Type': 'application/json'}
+
+
+def per_item(client, rows):
+    """ Creates, updates and deletes every row with its own request """
+    started = time.time()
+    created = []
+    for data in rows:
+        resp = client.post('/shopcarts/items', data=json.dumps(data), headers=HEADERS)
+        created.append(json.loads(resp.data))
+    for item in created:
+        item['count'] += 1
+        client.put('/shopcarts/items/{}'.format(item['id']), data=json.dumps(item),
+                   headers=HEADERS)
+    for item in created:
+        client.delete('/shopcarts/items/{}'.format(item['id']))
+    return time.time() - started
+
+
+def batched(client, rows):
+    """ Creates, updates and deletes every row with one request each """
+    started = time.time()
+    resp = client.post('/shopcarts/items:batch', data=json.dumps(rows), headers=HEADERS)
+    created = [result['item'] for result in json.loads(resp.data)['results']]
+    for item in created:
+        item['count'] += 1
+    client.put('/shopcarts/items:batch', data=json.dumps(created), headers=HEADERS)
+    client.delete('/shopcarts/items:batch', data=json.dumps([item['id'] for item in created]),
+                  headers=HEADERS)
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-item vs batch write benchmark')
+    parser.add_argument('--items', type=int, default=50, help='items per round')
+    parser.add_argument('--rounds', type=int, default=5, help='number of rounds')
+    args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        client = app.test_client()
+        rows = [make_item_data(index) for index in range(args.items)]
+        timings = {'per_item': [], 'batch': []}
+        for _ in range(args.rounds):
+            timings['per_item'].append(per_item(client, rows))
+            timings['batch'].append(batched(client, rows))
+    finally:
+        teardown_database(path)
+
+    report = {'benchmark': 'batch', 'items': args.items, 'rounds': args.rounds}
+    for name, values in timings.items():
+        report[name] = {'best_seconds': min(values),
+                        'mean_seconds': sum(values) / len(values),
+                        'requests_per_round': 3 * args.items if name == 'per_item' else 3}
+    report['speedup'] = report['per_item']['best_seconds'] / report['batch']['best_seconds']
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
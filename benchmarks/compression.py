@@ -0,0 +1,80 @@
+"""
+Compression Benchmark
+
+Measures the bytes on the wire and the CPU time to encode and compress
+an Item list for each list shape and content coding: the pretty printed
+jsonify output the service used to send, compact rows, and columns, each
+uncompressed and with every coding the service offers.
+
+Usage:
+    python -m benchmarks.compression [--items 10000] [--rounds 5] [--level 6]
+"""
+import json
+import time
+import argparse
+from flask import jsonify
+from app import app
+from app.models import Item
+from app.server import generate_items_json, columns_json
+from app.compression import Compression, compress
+from benchmarks import setup_database, teardown_database, seed_items
+
+
+def pretty_json(rows):
+    """ Encodes the rows the way jsonify did before compact output """
+    fields = Item.SERIALIZED_FIELDS
+    with app.test_request_context():
+        app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+        try:
+            return jsonify([dict(zip(fields, row)) for row in rows]).get_data()
+        finally:
+            app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+
+
+def best_cpu(function, rounds):
+    """ Returns the result of function and the least CPU time it took over rounds """
+    times = []
+    for _ in range(rounds):
+        started = time.clock()
+        result = function()
+        times.append(time.clock() - started)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List encoding and compression benchmark')
+    parser.add_argument('--items', type=int, default=10000, help='items in the list')
+    parser.add_argument('--rounds', type=int, default=5, help='times to repeat each step')
+    parser.add_argument('--level', type=int, default=6, help='compression level')
+    args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        seed_items(args.items)
+        rows = Item.rows()
+    finally:
+        teardown_database(path)
+
+    shapes = [('pretty', lambda: pretty_json(rows)),
+              ('rows', lambda: ''.join(generate_items_json(rows, 500))),
+              ('columns', lambda: columns_json(rows))]
+    results = {}
+    for shape, encode in shapes:
+        body, encode_seconds = best_cpu(encode, args.rounds)
+        result = {'identity': {'bytes': len(body), 'encode_ms': 1000 * encode_seconds,
+                               'compress_ms': 0.0}}
+        for encoding in Compression.encodings():
+            data, compress_seconds = best_cpu(lambda: compress(body, encoding, args.level),
+                                              args.rounds)
+            result[encoding] = {'bytes': len(data), 'encode_ms': 1000 * encode_seconds,
+                                'compress_ms': 1000 * compress_seconds,
+                                'ratio': float(len(body)) / len(data)}
+        results[shape] = result
+
+    report = {'benchmark': 'compression', 'items': args.items, 'level': args.level,
+              'shapes': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
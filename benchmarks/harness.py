@@ -0,0 +1,231 @@
+"""
+API Benchmark Harness
+
+Seeds Items and drives the list, get, create, update, patch, delete and
+clear routes from concurrent clients, then reports latency percentiles,
+throughput and memory for each as JSON so regressions can be tracked.
+
+Usage:
+    python -m benchmarks.harness [--items 1000] [--requests 500] [--concurrency 8]
+                                 [--scenarios list,get,...] [--url URL] [--output FILE]
+
+Without --url the app runs in process against a temporary SQLite file,
+or the database in DATABASE_URI. With --url an already running service
+is driven over HTTP instead.
+"""
+import json
+import time
+import socket
+import random
+import urllib2
+import argparse
+import resource
+import threading
+from app import app
+from benchmarks import setup_database, teardown_database, seed_items, make_item_data, \
+                       latency_summary
+
+HEADERS = {'Content-Type': 'application/json'}
+
+
+class InProcessClient(object):
+    """ Sends requests to the app through the Flask test client """
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        """ Sends a request and returns the status code and body """
+        data = json.dumps(body) if body is not None else None
+        resp = self.client.open(path, method=method, data=data, headers=HEADERS)
+        return resp.status_code, resp.data
+
+
+class HttpClient(object):
+    """ Sends requests to a running service over HTTP """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        """ Sends a request and returns the status code and body """
+        data = json.dumps(body) if body is not None else None
+        request = urllib2.Request(self.base_url + path, data, HEADERS)
+        request.get_method = lambda: method
+        try:
+            resp = urllib2.urlopen(request)
+            return resp.getcode(), resp.read()
+        except urllib2.HTTPError as error:
+            return error.code, error.read()
+
+
+def peak_rss_kb():
+    """ Returns the peak resident memory of this process in kilobytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_concurrently(make_client, send, total, concurrency):
+    """ Calls send(client, index) total times from concurrency threads
+
+    send returns the status code of the request it made. Responses of
+    400 and above, and exceptions, are counted as errors.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        client = make_client()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            started = time.time()
+            try:
+                code = send(client, index)
+            except (urllib2.URLError, socket.error) as error:
+                code = str(error)
+            elapsed = time.time() - started
+            with lock:
+                if isinstance(code, int) and code < 400:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(code)
+
+    rss_before = peak_rss_kb()
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    result = latency_summary(latencies)
+    result.update({'errors': len(errors),
+                   'seconds': elapsed,
+                   'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+                   'peak_rss_kb': peak_rss_kb(),
+                   'peak_rss_growth_kb': peak_rss_kb() - rss_before})
+    return result
+
+
+def item_ids(client):
+    """ Returns the ids of every Item by paging through the list """
+    ids = []
+    after_id = 0
+    while True:
+        code, data = client.request('GET', '/shopcarts/items?limit=1000&after_id={}'.format(after_id))
+        page = json.loads(data)
+        if not page:
+            return ids
+        ids.extend(item['id'] for item in page)
+        after_id = ids[-1]
+
+
+def build_scenarios(ids, items):
+    """ Returns the send functions for each scenario by name """
+    def get_list(client, index):
+        return client.request('GET', '/shopcarts/items?limit=50')[0]
+
+    def get_list_all(client, index):
+        return client.request('GET', '/shopcarts/items')[0]
+
+    def get_one(client, index):
+        return client.request('GET', '/shopcarts/items/{}'.format(random.choice(ids)))[0]
+
+    def create(client, index):
+        return client.request('POST', '/shopcarts/items', make_item_data(items + index))[0]
+
+    def update(client, index):
+        item_id = ids[index % len(ids)]
+        data = dict(make_item_data(index), id=item_id)
+        return client.request('PUT', '/shopcarts/items/{}'.format(item_id), data)[0]
+
+    def patch(client, index):
+        item_id = ids[index % len(ids)]
+        return client.request('PATCH', '/shopcarts/items/{}'.format(item_id), {'delta': 1})[0]
+
+    def delete(client, index):
+        return client.request('DELETE', '/shopcarts/items/{}'.format(ids[index % len(ids)]))[0]
+
+    return [('list', get_list), ('list_all', get_list_all), ('get', get_one),
+            ('create', create), ('update', update), ('patch', patch), ('delete', delete)]
+
+
+def seed(client, total, in_process):
+    """ Empties the shopcart and creates total Items """
+    client.request('DELETE', '/shopcarts/clear')
+    if in_process:
+        seed_items(total)
+    else:
+        for start in range(0, total, 1000):
+            rows = [make_item_data(index) for index in range(start, min(start + 1000, total))]
+            client.request('POST', '/shopcarts/items:batch', rows)
+
+
+def run_clear(client, total, rounds, in_process):
+    """ Times DELETE /shopcarts/clear against a cart of total Items """
+    latencies = []
+    for _ in range(rounds):
+        seed(client, total, in_process)
+        started = time.time()
+        client.request('DELETE', '/shopcarts/clear')
+        latencies.append(time.time() - started)
+    result = latency_summary(latencies)
+    result.update({'errors': 0, 'seconds': sum(latencies),
+                   'requests_per_second': len(latencies) / sum(latencies),
+                   'peak_rss_kb': peak_rss_kb()})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shopcart API benchmark harness')
+    parser.add_argument('--items', type=int, default=1000, help='items to seed')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--scenarios', default='list,list_all,get,create,update,patch,delete,clear',
+                        help='comma separated scenarios to run')
+    parser.add_argument('--clear-rounds', type=int, default=5, help='times to time clear')
+    parser.add_argument('--url', help='base URL of a running service')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    wanted = args.scenarios.split(',')
+    in_process = not args.url
+    path = setup_database() if in_process else None
+    if in_process:
+        make_client = InProcessClient
+    else:
+        make_client = lambda: HttpClient(args.url)
+
+    results = {}
+    try:
+        client = make_client()
+        seed(client, args.items, in_process)
+        ids = item_ids(client)
+        for name, send in build_scenarios(ids, args.items):
+            if name in wanted:
+                results[name] = run_concurrently(make_client, send, args.requests,
+                                                 args.concurrency)
+        if 'clear' in wanted:
+            results['clear'] = run_clear(client, args.items, args.clear_rounds, in_process)
+    finally:
+        if in_process:
+            teardown_database(path)
+
+    report = {'benchmark': 'harness',
+              'target': args.url or app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+              'items': args.items, 'requests': args.requests,
+              'concurrency': args.concurrency, 'timestamp': time.time(),
+              'scenarios': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Inventory Benchmark
+
+Measures what annotating Items with the inventory snapshot costs: the
+latency of list and get requests without an inventory and with a snapshot
+of every sku, the SQL statements each sends and the time a refresh of the
+snapshot takes. A customer's cart of --cart-items of those skus is
+summarized and filtered on is_available too, which is what
+INVENTORY_MAX_FILTER_SKUS is sized by.
+
+Usage:
+    python -m benchmarks.inventory [--items 10000] [--requests 200] [--cart-items 100]
+"""
+import os
+import json
+import time
+import tempfile
+import argparse
+from sqlalchemy import event
+from app import app, db, cache, inventory
+from app.inventory import FileSource
+from app.models import Item
+from benchmarks import setup_database, teardown_database, seed_items, make_item_data, \
+                       latency_summary
+
+
+def measure(client, url, requests):
+    """ Returns the latencies of requests GETs of url """
+    times = []
+    for _ in range(requests):
+        started = time.time()
+        client.get(url)
+        times.append(time.time() - started)
+    return latency_summary(times)
+
+
+def count_statements(client, url):
+    """ Returns the number of SQL statements one GET of url sends """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inventory snapshot benchmark')
+    parser.add_argument('--items', type=int, default=10000, help='items in the cart')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--cart-items', type=int, default=100,
+                        help='items in the cart that is summarized and filtered')
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix='.json', prefix='shopcarts-inventory-')
+    os.close(handle)
+    with open(path, 'w') as stock:
+        json.dump(dict((make_item_data(index)['sku'], index % 4)
+                       for index in range(args.items)), stock)
+    database = setup_database()
+    app.config['INVENTORY_REFRESH_INTERVAL'] = 3600
+    app.config['INVENTORY_MAX_STALENESS'] = 3600
+    try:
+        seed_items(args.items)
+        cart = []
+        for index in range(min(args.cart_items, args.items)):
+            item = Item().deserialize(make_item_data(index))
+            item.customer_id = 1
+            cart.append(item)
+        Item.save_all(cart)
+        db.session.remove()
+        client = app.test_client()
+        modes = {}
+        for mode in ('none', 'snapshot'):
+            inventory.source = FileSource(path) if mode == 'snapshot' else None
+            if inventory.source is not None:
+                started = time.time()
+                inventory.refresh()
+                refresh_ms = 1000 * (time.time() - started)
+            cache.clear()
+            inventory.reset_stats()
+            modes[mode] = {
+                'list': measure(client, '/shopcarts/items', max(args.requests // 20, 5)),
+                'get': measure(client, '/shopcarts/items/1', args.requests),
+                'list_statements': count_statements(client, '/shopcarts/items'),
+                'get_statements': count_statements(client, '/shopcarts/items/2'),
+                'cart_summary': measure(client, '/shopcarts/1/summary', args.requests),
+                'cart_filter': measure(client, '/shopcarts/1/items?is_available=true',
+                                       args.requests),
+            }
+            if mode == 'snapshot':
+                modes[mode]['refresh_ms'] = refresh_ms
+                modes[mode]['hit_ratio'] = inventory.stats()['hit_ratio']
+    finally:
+        inventory.stop()
+        inventory.source = None
+        teardown_database(database)
+        os.remove(path)
+
+    report = {'benchmark': 'inventory', 'items': args.items, 'requests': args.requests,
+              'cart_items': args.cart_items, 'modes': modes}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Load Benchmark
+
+Starts the service under gunicorn with different numbers of worker
+processes and worker classes, drives it over HTTP from concurrent
+clients and reports how throughput and latency scale.
+
+Usage:
+    python -m benchmarks.load [--workers 1,2,4] [--worker-classes sync]
+                              [--threads 1] [--concurrency 16]
+                              [--requests 2000] [--items 200] [--db-latency-ms 0]
+
+The service uses a temporary SQLite file unless DATABASE_URI is set.
+SQLite answers without any network wait, so --db-latency-ms adds a delay
+to every query to compare the blocking sync and gthread workers with the
+gevent worker the way they would behave against MySQL, e.g.
+
+    python -m benchmarks.load --workers 1 --worker-classes sync,gthread,gevent \
+                              --threads 4 --concurrency 200 --db-latency-ms 5
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import urllib2
+import argparse
+import tempfile
+import subprocess
+from benchmarks.harness import HttpClient, run_concurrently, seed, item_ids
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    """ Returns a TCP port nobody is listening on """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, workers, threads, database_uri, worker_class='', latency_ms=0):
+    """ Starts gunicorn and waits until it answers """
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS=str(threads), GUNICORN_ACCESS_LOG='',
+               GUNICORN_WORKER_CLASS=worker_class, DATABASE_URI=database_uri,
+               BENCH_DB_LATENCY_MS=str(latency_ms))
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    application = 'benchmarks.slowdb:app' if latency_ms else 'wsgi:app'
+    process = subprocess.Popen([gunicorn, '-c', 'gunicorn_config.py', application],
+                               cwd=ROOT, env=env,
+                               stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(100):
+        try:
+            urllib2.urlopen(base_url + '/shopcarts/items?limit=1').read()
+            return process, base_url
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def stop_server(process):
+    """ Shuts gunicorn down gracefully """
+    process.send_signal(signal.SIGTERM)
+    process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-worker load benchmark')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--worker-classes', default='sync',
+                        help='comma separated gunicorn worker classes (sync, gthread, gevent)')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gthread worker')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per run')
+    parser.add_argument('--items', type=int, default=200, help='items to seed')
+    parser.add_argument('--db-latency-ms', type=float, default=0,
+                        help='delay added to every SQL query')
+    args = parser.parse_args()
+
+    path = None
+    database_uri = os.getenv('DATABASE_URI')
+    if not database_uri:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='shopcarts-load-')
+        os.close(handle)
+        database_uri = 'sqlite:///' + path
+
+    runs = []
+    try:
+        for worker_class in args.worker_classes.split(','):
+            for workers in [int(value) for value in args.workers.split(',')]:
+                process, base_url = start_server(free_port(), workers, args.threads,
+                                                 database_uri, worker_class,
+                                                 args.db_latency_ms)
+                try:
+                    client = HttpClient(base_url)
+                    seed(client, args.items, in_process=False)
+                    paths = ['/shopcarts/items/{}'.format(item_id)
+                             for item_id in item_ids(client)]
+                    paths.append('/shopcarts/items?limit=50')
+                    send = lambda client, index: client.request(
+                        'GET', paths[index % len(paths)])[0]
+                    result = run_concurrently(lambda: HttpClient(base_url), send,
+                                              args.requests, args.concurrency)
+                finally:
+                    stop_server(process)
+                result.update({'workers': workers, 'worker_class': worker_class,
+                               'threads': args.threads if worker_class == 'gthread' else 1})
+                runs.append(result)
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    report = {'benchmark': 'load', 'concurrency': args.concurrency,
+              'requests': args.requests, 'items': args.items,
+              'db_latency_ms': args.db_latency_ms, 'runs': runs}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
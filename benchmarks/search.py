@@ -0,0 +1,94 @@
+"""
+Search Benchmark
+
+Seeds Items with names made of common words and times searches of
+different selectivity through Item.search, with the full text index of
+the database and with the LIKE fallback, reporting the latency of each
+and the query plan SQLite picks.
+
+Usage:
+    python -m benchmarks.search [--items 1000000] [--rounds 20]
+"""
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+from mock import patch
+from app import db
+from app.models import Item, SEARCH_TABLE, search_backend
+from benchmarks import setup_database, teardown_database, latency_summary
+
+COLORS = ['red', 'blue', 'green', 'black', 'white', 'grey', 'navy', 'olive', 'pink', 'teal']
+STYLES = ['running', 'walking', 'hiking', 'casual', 'formal', 'slim', 'classic', 'vintage']
+THINGS = ['shoes', 'shirt', 'jacket', 'socks', 'hat', 'scarf', 'jeans', 'boots', 'gloves',
+          'sweater', 'shorts', 'belt']
+BRANDS = ['brand{}'.format(index) for index in range(200)]
+
+# From a word in most names to one sku
+SEARCHES = ['shoes', 'red run', 'nav vint boo', 'brand17', 'brand17 teal hat', 'SKU0000042']
+
+
+def make_row(index, rng):
+    """ Returns the columns of a sample Item with a searchable name """
+    return {'sku': 'SKU{:07d}'.format(index), 'count': 1, 'price': 9.99,
+            'name': '{} {} {}'.format(rng.choice(COLORS), rng.choice(STYLES), rng.choice(THINGS)),
+            'link': 'example.com', 'brand_name': rng.choice(BRANDS), 'is_available': True,
+            'version': 1, 'updated': datetime.utcnow()}
+
+
+def seed(total, chunk_size=10000):
+    """ Inserts the sample Items with bulk INSERTs, the index triggers still fire """
+    rng = random.Random(42)
+    for first in range(0, total, chunk_size):
+        db.session.execute(Item.__table__.insert(),
+                           [make_row(index, rng) for index in range(first, min(first + chunk_size,
+                                                                               total))])
+        db.session.commit()
+
+
+def time_search(phrase, rounds, limit):
+    """ Returns the number of rows found and the latency summary of a search """
+    times = []
+    rows = []
+    for _ in range(rounds):
+        started = time.time()
+        rows = Item.search(phrase, limit=limit)
+        times.append(time.time() - started)
+    return len(rows), latency_summary(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Item search benchmark')
+    parser.add_argument('--items', type=int, default=1000000, help='items to search')
+    parser.add_argument('--rounds', type=int, default=20, help='times to run each search')
+    parser.add_argument('--limit', type=int, default=20, help='page size of the searches')
+    args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        started = time.time()
+        seed(args.items)
+        seed_seconds = time.time() - started
+        dialect = db.session.get_bind().dialect.name
+        results = {}
+        for phrase in SEARCHES:
+            found, index = time_search(phrase, args.rounds, args.limit)
+            with patch('app.models.SQLITE_FTS5', False):
+                _, like = time_search(phrase, max(1, args.rounds // 10), args.limit)
+            results[phrase] = {'rows': found, search_backend(dialect): index, 'like': like}
+        plan = None
+        if dialect == 'sqlite' and search_backend(dialect) == 'fts5':
+            plan = [tuple(row) for row in db.session.execute(
+                "EXPLAIN QUERY PLAN SELECT rowid FROM {0} WHERE {0} MATCH 'red* run*' "
+                "ORDER BY rank LIMIT 20".format(SEARCH_TABLE))]
+    finally:
+        teardown_database(path)
+
+    report = {'benchmark': 'search', 'items': args.items, 'dialect': dialect,
+              'seed_seconds': seed_seconds, 'searches': results, 'plan': plan}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Serialization Benchmark
+
+Compares building the Item list from ORM objects (Item.serialize and
+jsonify) against the row tuple path (Item.rows and the chunked JSON
+encoder) that list_items uses, reporting CPU time per row and the peak
+memory each path needs.
+
+Usage:
+    python -m benchmarks.serialization [--rows 10000,100000] [--chunk-size 500]
+
+Each measurement runs in a forked child so its peak memory is its own.
+"""
+import os
+import json
+import time
+import argparse
+import resource
+from flask import jsonify
+from app import app, db
+from app.models import Item
+from app.server import generate_items_json
+from benchmarks import setup_database, teardown_database, seed_items
+
+
+def orm_path(chunk_size):
+    """ Builds the list the way list_items did before the row path """
+    items = Item.query.all()
+    with app.test_request_context():
+        return len(jsonify([item.serialize() for item in items]).data)
+
+
+def rows_path(chunk_size):
+    """ Builds the list from row tuples in chunks """
+    rows = Item.rows(chunk_size=chunk_size)
+    return len(''.join(generate_items_json(rows, chunk_size)))
+
+
+def measure(path, chunk_size):
+    """ Runs path in a forked child and returns its CPU, wall time and memory """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        db.get_engine(app).dispose()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_before = time.clock()
+        started = time.time()
+        size = path(chunk_size)
+        result = {'cpu_seconds': time.clock() - cpu_before,
+                  'seconds': time.time() - started,
+                  'bytes': size,
+                  'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                                        rss_before}
+        os.write(write_fd, json.dumps(result))
+        os._exit(0)
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ORM vs row tuple list serialization')
+    parser.add_argument('--rows', default='10000,100000',
+                        help='comma separated numbers of rows, e.g. 10000,100000,1000000')
+    parser.add_argument('--chunk-size', type=int, default=500, help='rows encoded at a time')
+    args = parser.parse_args()
+
+    path = setup_database()
+    results = {}
+    try:
+        seeded = 0
+        for total in sorted(int(value) for value in args.rows.split(',')):
+            seed_items(total, start=seeded)
+            seeded = total
+            result = {}
+            for name, run in (('orm', orm_path), ('rows', rows_path)):
+                result[name] = measure(run, args.chunk_size)
+                result[name]['cpu_us_per_row'] = 1e6 * result[name]['cpu_seconds'] / total
+            result['cpu_speedup'] = result['orm']['cpu_seconds'] / result['rows']['cpu_seconds']
+            results[str(total)] = result
+    finally:
+        teardown_database(path)
+
+    report = {'benchmark': 'serialization', 'chunk_size': args.chunk_size, 'rows': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
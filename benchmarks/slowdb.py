@@ -0,0 +1,23 @@
+"""
+Slow Database App
+
+The service with a fixed delay added to every SQL query. It stands in
+for the network round trip to MySQL when the load benchmark runs against
+SQLite, so blocking and non-blocking workers can be compared.
+
+Serve it with gunicorn as benchmarks.slowdb:app and set
+BENCH_DB_LATENCY_MS to the delay in milliseconds (5).
+"""
+import os
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from wsgi import app
+
+LATENCY = float(os.getenv('BENCH_DB_LATENCY_MS', '5')) / 1000
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def delay_query(conn, cursor, statement, parameters, context, executemany):
+    """ Waits like a query to a remote database would """
+    time.sleep(LATENCY)
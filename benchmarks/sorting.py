@@ -0,0 +1,109 @@
+"""
+Sorted Listing Benchmark
+
+Pages through the Item list in every sort order and reports, per sort,
+the query plan the database picks and the latency of the first page, of
+a page deep in the list read with the keyset cursor and of the same page
+read with an OFFSET. Each sort is then measured again without its index
+to show the sort the index saves.
+
+Usage:
+    python -m benchmarks.sorting [--items 1000000] [--limit 50] [--rounds 20]
+"""
+import json
+import time
+import argparse
+from app import db
+from app.models import Item
+from app.querybudget import count_queries
+from benchmarks import setup_database, teardown_database, seed_items, latency_summary
+
+# The index each sort is read through
+SORT_INDEXES = {'price': 'ix_item_price_id', 'name': 'ix_item_name_id',
+                'count': 'ix_item_count_id'}
+
+
+def explain(function):
+    """ Returns the query plan of the statement function runs """
+    with count_queries() as queries:
+        function()
+    record = queries[-1]
+    dialect = db.session.get_bind().dialect.name
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    connection = db.session.get_bind().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + record.statement, record.parameters)
+        return [' '.join(str(value) for value in row) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def timed_runs(function, rounds):
+    """ Returns the latency summary of running function rounds times """
+    times = []
+    for _ in range(rounds):
+        started = time.time()
+        function()
+        times.append(time.time() - started)
+    return latency_summary(times)
+
+
+def measure(sort, depth, limit, rounds):
+    """ Returns the plans and latencies of the first and a deep page of a sort """
+    field = Item.SERIALIZED_FIELDS.index(sort.lstrip('-'))
+    # the row just before the deep page, found once with an OFFSET
+    before = Item.rows(sort=sort, limit=depth)[-1]
+    after = (before[field], before[0])
+
+    def first_page():
+        return Item.rows(limit=limit, sort=sort)
+
+    def keyset_page():
+        if sort == 'id':
+            return Item.rows(after_id=before[0], limit=limit)
+        return Item.rows(limit=limit, sort=sort, after=after)
+
+    def offset_page():
+        return Item.rows(sort=sort, limit=depth + limit)[depth:]
+
+    assert keyset_page() == offset_page()
+    return {'plan': explain(keyset_page),
+            'first_page': timed_runs(first_page, rounds),
+            'keyset_page': timed_runs(keyset_page, rounds),
+            'offset_page': timed_runs(offset_page, max(1, rounds // 10))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sorted listing benchmark')
+    parser.add_argument('--items', type=int, default=1000000, help='items in the list')
+    parser.add_argument('--limit', type=int, default=50, help='page size')
+    parser.add_argument('--rounds', type=int, default=20, help='times to read each page')
+    args = parser.parse_args()
+    depth = args.items // 2
+
+    path = setup_database()
+    try:
+        seed_items(args.items, chunk_size=10000)
+        results = {}
+        for sort in Item.SORTS:
+            results[sort] = {'indexed': measure(sort, depth, args.limit, args.rounds)}
+            index = SORT_INDEXES.get(sort.lstrip('-'))
+            if index is None:
+                continue
+            db.session.execute('DROP INDEX {}'.format(index))
+            results[sort]['unindexed'] = measure(sort, depth, args.limit,
+                                                 max(1, args.rounds // 10))
+            db.session.execute('CREATE INDEX {} ON {} ({}, id)'.format(
+                index, Item.__tablename__, sort.lstrip('-')))
+            db.session.commit()
+    finally:
+        teardown_database(path)
+
+    report = {'benchmark': 'sorting', 'items': args.items, 'limit': args.limit,
+              'depth': depth, 'sorts': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Startup Benchmark
+
+Measures how long a fresh process takes from importing the app to its
+first responses: the import itself, creating the tables, the first Item
+list, the first /v1/spec and a second, cached, /v1/spec.
+
+Usage:
+    python -m benchmarks.startup [--runs 5]
+
+Every run is a new Python process using a temporary SQLite file unless
+DATABASE_URI is set.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from benchmarks import percentile
+
+# Runs in the child process and prints the timings as JSON
+CHILD = """
+import json, time
+started = time.time()
+from app import app, server
+timings = {'import': time.time() - started}
+mark = time.time()
+server.init_db()
+timings['init_db'] = time.time() - mark
+client = app.test_client()
+for name, path in (('first_list', '/shopcarts/items'), ('first_spec', '/v1/spec'),
+                   ('cached_spec', '/v1/spec')):
+    mark = time.time()
+    assert client.get(path).status_code == 200
+    timings[name] = time.time() - mark
+timings['import_to_first_response'] = timings['import'] + timings['init_db'] + \\
+                                      timings['first_list']
+print(json.dumps(timings))
+"""
+
+
+def run_once(env):
+    """ Starts a new interpreter and returns its startup timings """
+    output = subprocess.check_output([sys.executable, '-c', CHILD], env=env,
+                                     stderr=open(os.devnull, 'w'))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import to first response benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes to start')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    path = None
+    if 'DATABASE_URI' not in env:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='shopcarts-bench-')
+        os.close(handle)
+        env['DATABASE_URI'] = 'sqlite:///' + path
+    try:
+        runs = [run_once(env) for _ in range(args.runs)]
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    report = {'benchmark': 'startup', 'runs': args.runs}
+    for name in runs[0]:
+        values = sorted(1000.0 * run[name] for run in runs)
+        report[name] = {'min_ms': values[0], 'p50_ms': percentile(values, 0.5),
+                        'max_ms': values[-1]}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Wire Format Benchmark
+
+Compares JSON and MessagePack bodies for the item APIs: the bytes on
+the wire of a list, uncompressed and gzipped, and the round-trip latency
+of list, get, create and batch create requests through the app, from
+encoding the request to decoding the response.
+
+Usage:
+    python -m benchmarks.wire [--items 10000] [--requests 200]
+"""
+import json
+import time
+import argparse
+from app import app, cache
+from app.formats import pack, unpack, msgpack, MSGPACK_MIMETYPE
+from app.compression import compress
+from benchmarks import setup_database, teardown_database, seed_items, percentile
+
+FORMATS = {
+    'json': {'mimetype': 'application/json', 'encode': json.dumps, 'decode': json.loads},
+    'msgpack': {'mimetype': MSGPACK_MIMETYPE, 'encode': pack, 'decode': unpack},
+}
+
+
+def new_item(sku):
+    """ Returns the body of a new Item """
+    return {'sku': sku, 'count': 1, 'price': 9.99, 'name': 'wire item',
+            'link': 'https://example.com/wire', 'brand_name': 'wire', 'is_available': True}
+
+
+def round_trip(client, wire, method, url, body=None):
+    """ Sends one request in the wire format and decodes the answer """
+    data = None if body is None else wire['encode'](body)
+    resp = client.open(url, method=method, data=data, content_type=wire['mimetype'],
+                       headers={'Accept': wire['mimetype']})
+    return wire['decode'](resp.data)
+
+
+def measure(client, wire, method, url, requests, body=None):
+    """ Returns the latency percentiles in ms of requests round trips """
+    times = []
+    for index in range(requests):
+        request_body = body(index) if callable(body) else body
+        started = time.time()
+        round_trip(client, wire, method, url, request_body)
+        times.append(time.time() - started)
+    times.sort()
+    return {'p50_ms': 1000 * percentile(times, 0.50), 'p95_ms': 1000 * percentile(times, 0.95)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON and MessagePack wire format benchmark')
+    parser.add_argument('--items', type=int, default=10000, help='items in the cart')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    args = parser.parse_args()
+    if msgpack is None:
+        parser.error('the msgpack package is not installed')
+
+    path = setup_database()
+    try:
+        seed_items(args.items)
+        client = app.test_client()
+        results = {}
+        for name in sorted(FORMATS):
+            wire = FORMATS[name]
+            cache.clear()
+            body = client.get('/shopcarts/items', headers={'Accept': wire['mimetype']}).data
+            batch = lambda index: [new_item('{}-batch-{}-{}'.format(name, index, row))
+                                   for row in range(50)]
+            results[name] = {
+                'list_bytes': len(body),
+                'list_gzip_bytes': len(compress(body, 'gzip', 6)),
+                'list': measure(client, wire, 'GET', '/shopcarts/items', 10),
+                'get': measure(client, wire, 'GET', '/shopcarts/items/1', args.requests),
+                'create': measure(client, wire, 'POST', '/shopcarts/items', args.requests,
+                                  lambda index: new_item('{}-{}'.format(name, index))),
+                'batch_create': measure(client, wire, 'POST', '/shopcarts/items:batch',
+                                        args.requests // 10, batch),
+            }
+    finally:
+        teardown_database(path)
+
+    report = {'benchmark': 'wire', 'items': args.items, 'requests': args.requests,
+              'formats': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
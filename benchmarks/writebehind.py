@@ -0,0 +1,122 @@
+"""
+Write Behind Benchmark
+
+Hammers a few hot Items with PATCH count changes from several threads,
+first writing every delta at once and then with WRITE_BEHIND_ENABLED, and
+reports the database commits, the request rate and latency of each, and
+whether the final counts came out the same.
+
+Usage:
+    python -m benchmarks.writebehind [--items 10] [--requests 2000] [--threads 8]
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from sqlalchemy import event
+from app import app, db, cache, write_behind
+from app.models import Item
+from benchmarks import setup_database, teardown_database, seed_items, latency_summary
+
+
+class CommitCounter(object):
+    """ Counts the transactions committed by the database engine """
+
+    def __init__(self, engine):
+        self.commits = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'commit', self._commit)
+
+    def _commit(self, conn):
+        with self._lock:
+            self.commits += 1
+
+
+def hammer(items, requests, threads, seed):
+    """ Sends requests PATCH deltas to the Items from threads at once
+
+    Returns the latencies and the sum of the deltas sent per Item.
+    """
+    latencies = []
+    sent = dict((item_id, 0) for item_id in items)
+    lock = threading.Lock()
+
+    def worker(number):
+        client = app.test_client()
+        rand = random.Random(seed + number)
+        for _ in range(requests // threads):
+            item_id = rand.choice(items)
+            delta = rand.choice((1, 1, 2, -1))
+            started = time.time()
+            resp = client.patch('/shopcarts/items/{}'.format(item_id),
+                                data=json.dumps({'delta': delta}),
+                                content_type='application/json')
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if resp.status_code == 200:
+                    sent[item_id] += delta
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, sent
+
+
+def run(mode, items, requests, threads, counter):
+    """ Runs one round of PATCH requests and returns its report """
+    app.config['WRITE_BEHIND_ENABLED'] = mode == 'write_behind'
+    cache.clear()
+    before = dict(db.session.query(Item.id, Item.count).filter(Item.id.in_(items)).all())
+    db.session.remove()
+    commits = counter.commits
+    started = time.time()
+    latencies, sent = hammer(items, requests, threads, seed=7)
+    elapsed = time.time() - started
+    write_behind.stop()
+    commits = counter.commits - commits
+    after = dict(db.session.query(Item.id, Item.count).filter(Item.id.in_(items)).all())
+    db.session.remove()
+    return {'requests': len(latencies), 'commits': commits,
+            'commits_per_request': float(commits) / len(latencies),
+            'requests_per_second': len(latencies) / elapsed,
+            'latency': latency_summary(latencies),
+            'counts_match': all(after[item_id] == before[item_id] + sent[item_id]
+                                for item_id in items)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write behind count delta benchmark')
+    parser.add_argument('--items', type=int, default=10, help='hot items to change')
+    parser.add_argument('--requests', type=int, default=2000, help='PATCH requests per mode')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--interval', type=float, default=0.1,
+                        help='seconds deltas are collected for')
+    args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        seed_items(args.items)
+        items = [item_id for (item_id,) in db.session.query(Item.id).all()]
+        db.session.remove()
+        app.config['WRITE_BEHIND_INTERVAL'] = args.interval
+        counter = CommitCounter(db.engine)
+        modes = {}
+        for mode in ('direct', 'write_behind'):
+            modes[mode] = run(mode, items, args.requests, args.threads, counter)
+    finally:
+        app.config['WRITE_BEHIND_ENABLED'] = False
+        teardown_database(path)
+
+    report = {'benchmark': 'writebehind', 'items': args.items, 'threads': args.threads,
+              'interval': args.interval, 'modes': modes,
+              'commit_reduction': float(modes['direct']['commits']) /
+                                  max(modes['write_behind']['commits'], 1)}
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
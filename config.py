@@ -1,6 +1,6 @@
 import os
 import logging
-from app.vcap_services import get_database_uri
+from app.vcap_services import get_database_uri, get_pool_options
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -12,5 +12,86 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = get_database_uri()
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool settings (ignored for SQLite)
+POOL_OPTIONS = get_pool_options()
+SQLALCHEMY_POOL_SIZE = POOL_OPTIONS['pool_size']
+SQLALCHEMY_MAX_OVERFLOW = POOL_OPTIONS['max_overflow']
+SQLALCHEMY_POOL_RECYCLE = POOL_OPTIONS['pool_recycle']
+SQLALCHEMY_POOL_TIMEOUT = POOL_OPTIONS['pool_timeout']
+SQLALCHEMY_POOL_PRE_PING = POOL_OPTIONS['pre_ping']
+
 SECRET_KEY = 'secret-for-dev-only'
 LOGGING_LEVEL = logging.INFO
+
+# Logging: json or text records, written by a background thread unless LOG_ASYNC is False
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_ASYNC = os.getenv('LOG_ASYNC', 'True') == 'True'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Share of the chatty INFO messages kept, and the most kept per call site every second
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '10'))
+LOG_SAMPLED_LOGGERS = ('app.models',)
+
+# Compact JSON, pretty printing only bloats what goes over the wire
+JSONIFY_PRETTYPRINT_REGULAR = False
+
+# Paging and streaming of Item lists
+ITEMS_MAX_PAGE_SIZE = int(os.getenv('ITEMS_MAX_PAGE_SIZE', '1000'))
+ITEMS_STREAM_CHUNK_SIZE = int(os.getenv('ITEMS_STREAM_CHUNK_SIZE', '500'))
+# Page size of searches that don't give a limit, and the most matches a search ranks
+ITEMS_SEARCH_PAGE_SIZE = int(os.getenv('ITEMS_SEARCH_PAGE_SIZE', '20'))
+ITEMS_SEARCH_MAX_RESULTS = int(os.getenv('ITEMS_SEARCH_MAX_RESULTS', '1000'))
+
+# Largest number of Items accepted by the batch endpoints
+ITEMS_MAX_BATCH_SIZE = int(os.getenv('ITEMS_MAX_BATCH_SIZE', '1000'))
+
+# Item cache: memory, memcached, local or none
+ITEM_CACHE_BACKEND = os.getenv('ITEM_CACHE_BACKEND', 'memory')
+ITEM_CACHE_SIZE = int(os.getenv('ITEM_CACHE_SIZE', '1024'))
+# Seconds an Item stays cached, by default 1 in memory, where the other workers
+# don't see the invalidation of a write, and 30 in a shared cache, where they do
+ITEM_CACHE_TTL = int(os.getenv('ITEM_CACHE_TTL')) if os.getenv('ITEM_CACHE_TTL') else None
+# Seconds an invalidated key refuses to be filled by reads that may have started before
+ITEM_CACHE_HOLD = int(os.getenv('ITEM_CACHE_HOLD', '2'))
+ITEM_CACHE_SERVERS = os.getenv('ITEM_CACHE_SERVERS', '127.0.0.1:11211')
+
+# Request metrics served on /metrics, and the share of requests to profile
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False') == 'True'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp')
+
+# Query budget: log requests that run more or slower SQL than their route allows
+QUERY_BUDGET_ENABLED = os.getenv('QUERY_BUDGET_ENABLED', 'False') == 'True'
+QUERY_BUDGET_MAX_QUERIES = int(os.getenv('QUERY_BUDGET_MAX_QUERIES', '10'))
+QUERY_BUDGET_MAX_SECONDS = float(os.getenv('QUERY_BUDGET_MAX_SECONDS', '0.25'))
+QUERY_BUDGET_EXPLAIN = os.getenv('QUERY_BUDGET_EXPLAIN', 'True') == 'True'
+QUERY_BUDGET_STRICT = os.getenv('QUERY_BUDGET_STRICT', 'False') == 'True'
+QUERY_BUDGETS = {
+    'get_items': {'max_queries': 1},
+    'delete_items': {'max_queries': 2},
+    'delete_all_items': {'max_queries': 1},
+    'delete_items_batch': {'max_queries': 2},
+    'add_items': {'max_queries': 2},
+    'count_items': {'max_queries': 1},
+    'summarize_items': {'max_queries': 1},
+    'search_items': {'max_queries': 1},
+}
+
+# Response compression for clients that send Accept-Encoding
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'True') == 'True'
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))
+
+# Write behind: collect count deltas in memory and write them in batches
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'False') == 'True'
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '0.1'))
+WRITE_BEHIND_MAX_STALENESS = float(os.getenv('WRITE_BEHIND_MAX_STALENESS', '1.0'))
+WRITE_BEHIND_MAX_ITEMS = int(os.getenv('WRITE_BEHIND_MAX_ITEMS', '10000'))
+
+# Inventory: where the availability of every sku is read from (none, file or sqlite)
+INVENTORY_SOURCE = os.getenv('INVENTORY_SOURCE', 'none')
+INVENTORY_PATH = os.getenv('INVENTORY_PATH')
+INVENTORY_TABLE = os.getenv('INVENTORY_TABLE', 'inventory')
+INVENTORY_REFRESH_INTERVAL = float(os.getenv('INVENTORY_REFRESH_INTERVAL', '30'))
+INVENTORY_MAX_STALENESS = float(os.getenv('INVENTORY_MAX_STALENESS', '300'))
+INVENTORY_MAX_FILTER_SKUS = int(os.getenv('INVENTORY_MAX_FILTER_SKUS', '100'))
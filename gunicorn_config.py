@@ -0,0 +1,67 @@
+"""
+Gunicorn configuration for the Shopcart Service
+
+Every setting can be changed with an environment variable:
+    PORT: the port to listen on (5000)
+    WEB_CONCURRENCY: the number of worker processes (2)
+    GUNICORN_THREADS: the number of threads per worker (4)
+    GUNICORN_WORKER_CLASS: sync, gthread or gevent (gthread when there
+        are several threads, sync otherwise)
+    GUNICORN_WORKER_CONNECTIONS: requests a gevent worker handles at once (1000)
+    GUNICORN_TIMEOUT: seconds before a silent worker is restarted (30)
+    GUNICORN_GRACEFUL_TIMEOUT: seconds workers get to finish on shutdown (20)
+    GUNICORN_PRELOAD: load the app in the master before forking (True)
+    GUNICORN_ACCESS_LOG: where to write the access log, empty for none (-)
+"""
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS') or ('gthread' if threads > 1 else 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '20'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True') == 'True'
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-') or None
+errorlog = '-'
+
+if worker_class == 'gevent':
+    # Patch the standard library before the app is preloaded, so PyMySQL's
+    # sockets and the pool's locks yield to other requests instead of
+    # blocking the worker for the whole round trip to MySQL
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError('GUNICORN_WORKER_CLASS=gevent needs gevent, '
+                           'install it with pip install -r requirements.txt')
+    monkey.patch_all()
+
+
+def on_starting(server):
+    """ Creates the database tables once, in the master process """
+    from app import db
+    from app.models import Item
+    Item.init_db()
+    # don't let the workers inherit the master's connections
+    db.session.remove()
+    db.engine.dispose()
+
+
+def post_fork(server, worker):
+    """ Gives every worker its own database connection pool and log writer """
+    from app import db
+    from app.logs import async_logging
+    db.engine.dispose()
+    async_logging.after_fork()
+    server.log.info('Worker %s has a fresh database pool', worker.pid)
+
+
+def worker_exit(server, worker):
+    """ Writes the worker's pending count deltas and last logs and closes its connections """
+    from app import db, write_behind
+    from app.logs import async_logging
+    write_behind.stop()
+    db.session.remove()
+    db.engine.dispose()
+    async_logging.stop()
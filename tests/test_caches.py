@@ -0,0 +1,139 @@
+import unittest
+from app.caches import LRUCache, SharedCache, LocalClient, NullCache, make_cache
+
+
+class FakeClock(object):
+    """ Clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCaches(unittest.TestCase):
+    """ Test Cases for the Item caches """
+
+    def test_lru_get_and_set(self):
+        """ Store and read back values in the LRU cache """
+        cache = LRUCache(maxsize=2, ttl=10)
+        self.assertEqual(cache.get('1'), None)
+        cache.set('1', {'sku': 'ID111'})
+        self.assertEqual(cache.get('1'), {'sku': 'ID111'})
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_lru_eviction(self):
+        """ Evict the least recently used key when the LRU cache is full """
+        cache = LRUCache(maxsize=2, ttl=10)
+        cache.set('1', 'one')
+        cache.set('2', 'two')
+        cache.get('1')
+        cache.set('3', 'three')
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.get('1'), 'one')
+        self.assertEqual(cache.get('3'), 'three')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lru_ttl(self):
+        """ Expire keys in the LRU cache after their time to live """
+        clock = FakeClock()
+        cache = LRUCache(maxsize=2, ttl=10, clock=clock)
+        cache.set('1', 'one')
+        clock.now += 5
+        self.assertEqual(cache.get('1'), 'one')
+        clock.now += 10
+        self.assertEqual(cache.get('1'), None)
+        self.assertEqual(cache.size(), 0)
+
+    def test_lru_delete_and_clear(self):
+        """ Invalidate keys in the LRU cache """
+        cache = LRUCache()
+        cache.set('1', 'one')
+        cache.set('2', 'two')
+        cache.delete('1')
+        self.assertEqual(cache.get('1'), None)
+        cache.clear()
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.size(), 0)
+
+    def test_lru_add_after_delete(self):
+        """ Refuse to add a key to the LRU cache while it is held after a delete """
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, hold=2, clock=clock)
+        self.assertTrue(cache.add('1', 'one'))
+        self.assertFalse(cache.add('1', 'uno'))
+        self.assertEqual(cache.get('1'), 'one')
+        cache.delete('1')
+        self.assertEqual(cache.get('1'), None)
+        self.assertFalse(cache.add('1', 'stale'))
+        clock.now += 3
+        self.assertTrue(cache.add('1', 'fresh'))
+        self.assertEqual(cache.get('1'), 'fresh')
+        # set is unconditional
+        cache.delete('1')
+        cache.set('1', 'one')
+        self.assertEqual(cache.get('1'), 'one')
+
+    def test_shared_add_after_delete(self):
+        """ Refuse to add a key to the shared cache while it is held after a delete """
+        clock = FakeClock()
+        cache = SharedCache(LocalClient(clock=clock), ttl=10, hold=2)
+        self.assertTrue(cache.add('1', {'sku': 'ID111'}))
+        self.assertFalse(cache.add('1', {'sku': 'ID222'}))
+        cache.delete('1')
+        self.assertEqual(cache.get('1'), None)
+        self.assertFalse(cache.add('1', {'sku': 'stale'}))
+        clock.now += 3
+        self.assertTrue(cache.add('1', {'sku': 'fresh'}))
+        self.assertEqual(cache.get('1'), {'sku': 'fresh'})
+        self.assertFalse(NullCache().add('1', 'one'))
+
+    def test_shared_cache(self):
+        """ Store, invalidate and clear values in the shared cache """
+        clock = FakeClock()
+        cache = SharedCache(LocalClient(clock=clock), ttl=10)
+        cache.set('1', {'sku': 'ID111'})
+        cache.set('2', {'sku': 'ID222'})
+        self.assertEqual(cache.get('1'), {'sku': 'ID111'})
+        cache.delete('1')
+        self.assertEqual(cache.get('1'), None)
+        cache.clear()
+        self.assertEqual(cache.get('2'), None)
+        cache.set('2', {'sku': 'ID222'})
+        clock.now += 11
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_null_cache(self):
+        """ Never store anything in the null cache """
+        cache = NullCache()
+        cache.set('1', 'one')
+        self.assertEqual(cache.get('1'), None)
+
+    def test_make_cache(self):
+        """ Create the cache named in the configuration """
+        self.assertIsInstance(make_cache({}), LRUCache)
+        self.assertIsInstance(make_cache({'ITEM_CACHE_BACKEND': 'none'}), NullCache)
+        self.assertIsInstance(make_cache({'ITEM_CACHE_BACKEND': 'local'}), SharedCache)
+        # other workers don't see the invalidations of a memory cache
+        self.assertEqual(make_cache({}).ttl, 1)
+        self.assertEqual(make_cache({'ITEM_CACHE_BACKEND': 'local'}).ttl, 30)
+        cache = make_cache({'ITEM_CACHE_SIZE': 5, 'ITEM_CACHE_TTL': 2})
+        self.assertEqual(cache.maxsize, 5)
+        self.assertEqual(cache.ttl, 2)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
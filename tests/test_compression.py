@@ -0,0 +1,104 @@
+import os
+import json
+import zlib
+import gzip
+import unittest
+from StringIO import StringIO
+from app.models import Item
+from app.compression import compress_stream
+from app import server, db, cache
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+def gunzip(data):
+    """ Returns the gzip compressed data uncompressed """
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """ Test Cases for the response compression """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        cache.clear()
+        Item.save_all([Item(sku="ID{}".format(index), count=index, price=2.00, name="test_item",
+                            link="test.com", brand_name="gucci", is_available=True)
+                       for index in range(50)])
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['COMPRESSION_ENABLED'] = True
+        db.session.remove()
+        db.drop_all()
+
+    def test_gzip_list(self):
+        """ Compress a large list with gzip when the client accepts it """
+        plain = self.app.get('/shopcarts/items')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        resp = self.app.get('/shopcarts/items', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(len(resp.data) < len(plain.data))
+        self.assertEqual(gunzip(resp.data), plain.data)
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+
+    def test_deflate_list(self):
+        """ Compress with deflate when the client prefers it """
+        resp = self.app.get('/shopcarts/items', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(len(json.loads(zlib.decompress(resp.data))), 50)
+
+    def test_small_response_not_compressed(self):
+        """ Leave responses under the size threshold alone """
+        resp = self.app.get('/shopcarts/items/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(json.loads(resp.data)['sku'], 'ID0')
+
+    def test_streamed_list(self):
+        """ Compress a streamed list chunk by chunk """
+        resp = self.app.get('/shopcarts/items', query_string='stream=true',
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gunzip(resp.data))), 50)
+        chunks = list(compress_stream(['[1,', '2]'], 'deflate', 6))
+        self.assertEqual(zlib.decompress(''.join(chunks)), '[1,2]')
+
+    def test_compressed_etag(self):
+        """ Weaken the ETag of a compressed response and still answer 304 for it """
+        resp = self.app.get('/shopcarts/items', headers={'Accept-Encoding': 'gzip'})
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        resp = self.app.get('/shopcarts/items', headers={'Accept-Encoding': 'gzip',
+                                                         'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_compression_disabled(self):
+        """ Send every response uncompressed when compression is disabled """
+        server.app.config['COMPRESSION_ENABLED'] = False
+        resp = self.app.get('/shopcarts/items', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_columns_format(self):
+        """ List the Items as an array of values per field """
+        resp = self.app.get('/shopcarts/items', query_string='format=columns&limit=3')
+        data = json.loads(resp.data)
+        self.assertEqual(data['sku'], ['ID0', 'ID1', 'ID2'])
+        self.assertEqual(data['count'], [0, 1, 2])
+        self.assertEqual(sorted(data), sorted(Item.SERIALIZED_FIELDS))
+        resp = self.app.get('/shopcarts/items', query_string='format=columns&sku=none')
+        self.assertEqual(json.loads(resp.data)['id'], [])
+        resp = self.app.get('/shopcarts/items', query_string='format=table')
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import unittest
+from mock import patch
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from app import app
+from app.dbpool import InstrumentedQueuePool, PooledSQLAlchemy, pool_status
+from app.vcap_services import get_pool_options
+
+
+def connect():
+    """ Creates a new DBAPI connection for the pool """
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDatabasePool(unittest.TestCase):
+    """ Test Cases for the database connection pool """
+
+    def test_checkout_stats(self):
+        """ Record checkouts and connections in use """
+        pool = InstrumentedQueuePool(connect, pool_size=2, max_overflow=0)
+        first = pool.connect()
+        second = pool.connect()
+        status = pool_status(pool)
+        self.assertEqual(status['class'], 'InstrumentedQueuePool')
+        self.assertEqual(status['in_use'], 2)
+        self.assertEqual(status['checkouts'], 2)
+        self.assertEqual(status['waits'], 0)
+        first.close()
+        second.close()
+        self.assertEqual(pool_status(pool)['in_use'], 0)
+
+    def test_checkout_timeout(self):
+        """ Record checkouts that wait and time out """
+        pool = InstrumentedQueuePool(connect, pool_size=1, max_overflow=0, timeout=0.01)
+        connection = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        status = pool_status(pool)
+        self.assertEqual(status['waits'], 1)
+        self.assertEqual(status['timeouts'], 1)
+        connection.close()
+
+    def test_pre_ping(self):
+        """ Replace connections the server has closed """
+        created = []
+        def creator():
+            created.append(connect())
+            return created[-1]
+        pool = InstrumentedQueuePool(creator, pool_size=1, max_overflow=0, pre_ping=True)
+        pool.connect().close()
+        # the server closes the idle connection
+        created[0].close()
+        connection = pool.connect()
+        self.assertEqual(len(created), 2)
+        self.assertEqual(connection.cursor().execute('SELECT 1').fetchone()[0], 1)
+        self.assertEqual(pool.stats.disconnects, 1)
+        connection.close()
+        # a recreated pool keeps pinging and shares the statistics
+        new_pool = pool.recreate()
+        self.assertTrue(new_pool.pre_ping)
+        self.assertIs(new_pool.stats, pool.stats)
+
+    def test_pool_options(self):
+        """ Use the instrumented pool for MySQL but not for SQLite """
+        sqla = PooledSQLAlchemy()
+        options = {'pool_size': 3, 'max_overflow': 1, 'pool_timeout': 5, 'pre_ping': True}
+        sqla.apply_driver_hacks(app, make_url('mysql+pymysql://root@localhost/test'), options)
+        self.assertEqual(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        options = {'pool_size': 3, 'max_overflow': 1, 'pool_timeout': 5, 'pre_ping': True}
+        sqla.apply_driver_hacks(app, make_url('sqlite://'), options)
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('pre_ping', options)
+        self.assertNotEqual(options['poolclass'], InstrumentedQueuePool)
+
+    @patch.dict(os.environ, {'VCAP_SERVICES': '{}', 'DB_POOL_SIZE': '7'})
+    def test_get_pool_options(self):
+        """ Read the pool settings for Bluemix from the environment """
+        options = get_pool_options()
+        self.assertEqual(options['pool_size'], 7)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pre_ping'])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import json
+import unittest
+from app.models import Item
+from app.formats import pack, unpack, MSGPACK_MIMETYPE
+from app import server, db, cache
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+MSGPACK_HEADERS = {'Accept': MSGPACK_MIMETYPE}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestFormats(unittest.TestCase):
+    """ Test Cases for the MessagePack wire format """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        cache.clear()
+        Item(sku="ID111", count=3, price=2.00, name="test_item",
+             link="test.com", brand_name="gucci", is_available=True).save()
+        Item(sku="ID222", count=5, price=10.50, name="test_item_2",
+             link="test2.com", brand_name="prada", is_available=False).save()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_json_by_default(self):
+        """ Answer with JSON unless the client asks for MessagePack """
+        resp = self.app.get('/shopcarts/items', headers={'Accept': '*/*'})
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertIn('Accept', resp.headers['Vary'])
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_list_items(self):
+        """ List the Items as MessagePack """
+        plain = self.app.get('/shopcarts/items')
+        resp = self.app.get('/shopcarts/items', headers=MSGPACK_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, MSGPACK_MIMETYPE)
+        self.assertEqual(unpack(resp.data), json.loads(plain.data))
+        # each representation has its own ETag
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+
+    def test_list_columns(self):
+        """ List the Items as MessagePack columns """
+        resp = self.app.get('/shopcarts/items?format=columns', headers=MSGPACK_HEADERS)
+        data = unpack(resp.data)
+        self.assertEqual(data['sku'], ['ID111', 'ID222'])
+        self.assertEqual(data['price'], [2.00, 10.50])
+
+    def test_get_item(self):
+        """ Get an Item as MessagePack """
+        resp = self.app.get('/shopcarts/items/1', headers=MSGPACK_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+        data = unpack(resp.data)
+        self.assertEqual(data['sku'], 'ID111')
+        self.assertEqual(data['count'], 3)
+
+    def test_create_item(self):
+        """ Create an Item from a MessagePack body """
+        body = pack({'sku': 'ID333', 'count': 2, 'price': 4.25, 'name': 'test_item_3',
+                     'link': 'test3.com', 'brand_name': 'dior', 'is_available': True})
+        resp = self.app.post('/shopcarts/items', data=body, headers=MSGPACK_HEADERS,
+                             content_type=MSGPACK_MIMETYPE)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.mimetype, MSGPACK_MIMETYPE)
+        self.assertEqual(unpack(resp.data)['sku'], 'ID333')
+        self.assertEqual(Item.find_by_sku('ID333')[0].count, 2)
+
+    def test_create_item_validated(self):
+        """ Validate MessagePack bodies like JSON ones """
+        resp = self.app.post('/shopcarts/items', data=pack({'sku': 'ID333'}),
+                             content_type=MSGPACK_MIMETYPE)
+        self.assertEqual(resp.status_code, 400)
+        resp = self.app.post('/shopcarts/items', data='\xc1 not msgpack',
+                             content_type=MSGPACK_MIMETYPE)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_update_item(self):
+        """ Update an Item from a MessagePack body """
+        body = pack({'sku': 'ID111', 'count': 7, 'price': 2.00, 'name': 'test_item',
+                     'link': 'test.com', 'brand_name': 'gucci', 'is_available': True})
+        resp = self.app.put('/shopcarts/items/1', data=body, headers=MSGPACK_HEADERS,
+                            content_type=MSGPACK_MIMETYPE)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(unpack(resp.data)['count'], 7)
+
+    def test_batch_create(self):
+        """ Create Items in bulk from a MessagePack body """
+        body = pack([{'sku': 'ID{}'.format(index), 'count': 1, 'price': 1.00,
+                      'name': 'batch', 'link': 'test.com', 'brand_name': 'gucci',
+                      'is_available': True} for index in range(400, 403)])
+        resp = self.app.post('/shopcarts/items:batch', data=body, headers=MSGPACK_HEADERS,
+                             content_type=MSGPACK_MIMETYPE)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(len(unpack(resp.data)['results']), 3)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
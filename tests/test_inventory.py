@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import unittest
+from flask_api import status    # HTTP Status Codes
+from app.inventory import Inventory, FileSource, SQLiteSource, NullSource, in_stock
+from app.models import Item
+from app.querybudget import count_queries
+from app import server, db, cache, inventory
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+class BrokenSource(NullSource):
+    """ An inventory that can't be read """
+
+    def load(self):
+        raise IOError('inventory is down')
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestInventory(unittest.TestCase):
+    """ Test Cases for the inventory availability snapshot """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        cache.clear()
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.writes = 0
+        self.write({'ID111': 0, 'ID222': 5})
+        server.app.config['INVENTORY_REFRESH_INTERVAL'] = 3600
+        server.app.config['INVENTORY_MAX_STALENESS'] = 3600
+        inventory.source = FileSource(self.path)
+        inventory.refresh()
+        inventory.reset_stats()
+        Item(sku="ID111", count=3, price=2.00, name="first", link="test.com",
+             brand_name="gucci", is_available=True).save()
+        Item(sku="ID222", count=1, price=9.00, name="second", link="test.com",
+             brand_name="prada", is_available=False).save()
+        Item(sku="ID333", count=1, price=5.00, name="third", link="test.com",
+             brand_name="prada", is_available=True).save()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        inventory.stop()
+        inventory.source = None
+        inventory.snapshot = {}
+        inventory.digest = None
+        inventory.loaded = None
+        os.remove(self.path)
+        db.session.remove()
+        db.drop_all()
+
+    def write(self, data):
+        """ Writes the inventory file with a new modification time """
+        with open(self.path, 'w') as handle:
+            json.dump(data, handle)
+        # a second apart, so every write is seen as a change
+        self.writes += 1
+        mtime = time.time() + self.writes
+        os.utime(self.path, (mtime, mtime))
+
+    def test_in_stock(self):
+        """ Read flags and quantities on hand as availability """
+        self.assertTrue(in_stock(True))
+        self.assertTrue(in_stock(2))
+        self.assertFalse(in_stock(0))
+        self.assertFalse(in_stock(None))
+
+    def test_file_source(self):
+        """ Read the inventory file only when it changed """
+        source = FileSource(self.path)
+        self.assertEqual(source.load(), {'ID111': False, 'ID222': True})
+        self.assertEqual(source.load(), None)
+        self.write({'ID111': True})
+        self.assertEqual(source.load(), {'ID111': True})
+
+    def test_sqlite_source(self):
+        """ Read the inventory table of a SQLite file """
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        try:
+            conn = sqlite3.connect(path)
+            conn.execute('CREATE TABLE stock (sku TEXT PRIMARY KEY, quantity INTEGER)')
+            conn.executemany('INSERT INTO stock VALUES (?, ?)', [('A1', 3), ('B2', 0)])
+            conn.commit()
+            conn.close()
+            self.assertEqual(SQLiteSource(path, 'stock').load(), {'A1': True, 'B2': False})
+        finally:
+            os.remove(path)
+
+    def test_refresh(self):
+        """ Replace the snapshot only when the inventory changed """
+        generation = inventory.generation
+        self.assertFalse(inventory.refresh())
+        self.write({'ID111': 0, 'ID222': 5})
+        self.assertFalse(inventory.refresh())
+        self.write({'ID111': 1})
+        self.assertTrue(inventory.refresh())
+        self.assertEqual(inventory.generation, generation + 1)
+        self.assertEqual(inventory.snapshot, {'ID111': True})
+
+    def test_failed_refresh_keeps_snapshot(self):
+        """ Keep the last snapshot until it is too stale to use """
+        inventory.source = BrokenSource()
+        self.assertFalse(inventory.refresh())
+        self.assertTrue(inventory.failures >= 1)
+        self.assertEqual(inventory.current(), {'ID111': False, 'ID222': True})
+        server.app.config['INVENTORY_MAX_STALENESS'] = 0
+        inventory.loaded -= 1
+        self.assertEqual(inventory.current(), None)
+        resp = self.app.get('/shopcarts/items')
+        data = json.loads(resp.data)
+        self.assertEqual([item['is_available'] for item in data], [True, False, True])
+
+    def test_list_is_annotated(self):
+        """ Take is_available of the Items listed from the snapshot """
+        resp = self.app.get('/shopcarts/items')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['is_available'] for item in data], [False, True, True])
+        stats = json.loads(self.app.get('/stats').data)['inventory']
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['skus'], 2)
+        resp = self.app.get('/shopcarts/items?stream=true')
+        data = json.loads(resp.data)
+        self.assertEqual([item['is_available'] for item in data], [False, True, True])
+
+    def test_get_is_annotated(self):
+        """ Take is_available of an Item from the snapshot and tag its ETag """
+        resp = self.app.get('/shopcarts/items/1')
+        self.assertEqual(json.loads(resp.data)['is_available'], False)
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"1-1.s{}"'.format(inventory.digest))
+        resp = self.app.get('/shopcarts/items/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.write({'ID111': 1})
+        inventory.refresh()
+        resp = self.app.get('/shopcarts/items/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['is_available'], True)
+        # the availability comes from the inventory, not the stored version
+        resp = self.app.patch('/shopcarts/items/1', data=json.dumps({'delta': 1}),
+                              content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_list_etag_follows_snapshot(self):
+        """ Change the list ETag when the snapshot changes """
+        etag = self.app.get('/shopcarts/items').headers['ETag']
+        self.write({'ID333': 0})
+        inventory.refresh()
+        resp = self.app.get('/shopcarts/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_digest(self):
+        """ Derive the ETag suffix from the snapshot, not from when it was loaded """
+        digest = inventory.digest
+        self.assertEqual(inventory.version(), digest)
+        watcher = Inventory(server.app, FileSource(self.path))
+        watcher.refresh()
+        self.assertEqual(watcher.digest, digest)
+        self.write({'ID111': 1})
+        inventory.refresh()
+        self.assertNotEqual(inventory.digest, digest)
+        self.write({'ID111': 0, 'ID222': 5})
+        inventory.refresh()
+        self.assertEqual(inventory.digest, digest)
+
+    def test_filter_is_annotated(self):
+        """ Filter on the availability the Items are listed with """
+        resp = self.app.get('/shopcarts/items?is_available=false')
+        data = json.loads(resp.data)
+        self.assertEqual([item['sku'] for item in data], ['ID111'])
+        with count_queries() as queries:
+            resp = self.app.get('/shopcarts/items?is_available=true')
+        data = json.loads(resp.data)
+        self.assertEqual([item['sku'] for item in data], ['ID222', 'ID333'])
+        # only the skus of the listed Items are sent, not the whole snapshot
+        inventory.snapshot = dict(inventory.snapshot, **dict(
+            ('OTHER{}'.format(index), True) for index in range(50)))
+        with count_queries() as more:
+            self.app.get('/shopcarts/items?is_available=true')
+        self.assertEqual([len(query.parameters) for query in more],
+                         [len(query.parameters) for query in queries])
+        self.assertEqual([item.sku for item in Item.find_by_availability(False)], ['ID111'])
+        # more known skus in the list than allowed, the stored column is used
+        server.app.config['INVENTORY_MAX_FILTER_SKUS'] = 1
+        try:
+            resp = self.app.get('/shopcarts/items?is_available=false')
+            data = json.loads(resp.data)
+            self.assertEqual([item['sku'] for item in data], ['ID222'])
+        finally:
+            server.app.config['INVENTORY_MAX_FILTER_SKUS'] = 100
+
+    def test_summary_is_annotated(self):
+        """ Total the availability the Items are listed with """
+        resp = self.app.get('/shopcarts/summary')
+        availability = json.loads(resp.data)['availability']
+        self.assertEqual(availability['available']['items'], 2)
+        self.assertEqual(availability['available']['quantity'], 2)
+        self.assertEqual(availability['unavailable']['items'], 1)
+        self.assertEqual(availability['unavailable']['quantity'], 3)
+        # one query, whose parameters don't grow with the snapshot
+        with count_queries() as queries:
+            self.app.get('/shopcarts/summary')
+        inventory.snapshot = dict(inventory.snapshot, **dict(
+            ('OTHER{}'.format(index), True) for index in range(50)))
+        with count_queries() as more:
+            self.app.get('/shopcarts/summary')
+        self.assertEqual(len(more), 1)
+        self.assertEqual(len(more[0].parameters), len(queries[0].parameters))
+
+    def test_background_refresh(self):
+        """ Load the snapshot from a background thread """
+        watcher = Inventory(server.app, FileSource(self.path))
+        server.app.config['INVENTORY_REFRESH_INTERVAL'] = 0.01
+        try:
+            watcher.current()
+            self.write({'ID111': 1})
+            deadline = time.time() + 2
+            while watcher.snapshot != {'ID111': True} and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(watcher.snapshot, {'ID111': True})
+        finally:
+            watcher.stop()
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
 import os
+from mock import patch
 from app.models import Item, DataValidationError
-from app import app,db
+from app.querybudget import count_queries
+from sqlalchemy.orm.exc import StaleDataError
+from app import app, db, cache
 
 DATABASE_URI = os.getenv('DATABASE_URI', None)
 
@@ -26,6 +29,7 @@ class TestItems(unittest.TestCase):
     def setUp(self):
         db.drop_all()    # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -101,6 +105,73 @@ class TestItems(unittest.TestCase):
         self.assertEqual(len(Item.all()), 0)
 
 
+    def test_save_and_delete_many_items(self):
+        """ Save and delete several Items at once """
+        items = [Item(sku="ID{}".format(i), count=1, price=1.00, name="item",
+                      link="test.com", brand_name="gucci", is_available=True)
+                 for i in range(3)]
+        Item.save_all(items)
+        self.assertEqual(len(Item.all()), 3)
+        self.assertEqual([Item.find(item.id).sku for item in items], ["ID0", "ID1", "ID2"])
+        items[1].count = 4
+        Item.update_all(items[1:2])
+        self.assertEqual((Item.find(items[1].id).count, items[1].version), (4, 2))
+        items[1].version = 1
+        self.assertRaises(StaleDataError, Item.update_all, items[1:2])
+        found = Item.find_many([items[0].id, items[2].id, 0])
+        self.assertEqual(sorted(found), [items[0].id, items[2].id])
+        self.assertEqual(Item.delete_many([items[0].id, items[2].id, 0]), 2)
+        self.assertEqual([item.sku for item in Item.all()], ["ID1"])
+        self.assertEqual(Item.delete_many([]), 0)
+
+    def test_remove_all_items(self):
+        """ Remove all Items matching a filter """
+        Item(sku="ID111", count=3, price=2.00, name="test_item",
+             link="test.com", brand_name="gucci", is_available=True).save()
+        Item(sku="ID222", count=5, price=10.00, name="some_item",
+             link="link.com", brand_name="nike", is_available=False).save()
+        self.assertEqual(Item.remove_all(brand_name="nike"), 1)
+        self.assertEqual([item.sku for item in Item.all()], ["ID111"])
+        self.assertEqual(Item.remove_all(), 1)
+        self.assertEqual(len(Item.all()), 0)
+
+    def test_add_to_cart(self):
+        """ Add the count of an Item to the Item with its sku already in the cart """
+        data = {'sku': "ID111", 'count': 2, 'price': 2.00, 'name': "test_item",
+                'link': "test.com", 'brand_name': "gucci", 'is_available': True}
+        item = Item.add_to_cart(1, data)
+        self.assertEqual((item.count, item.version, item.customer_id), (2, 1, 1))
+        with count_queries() as queries:
+            item = Item.add_to_cart(1, dict(data, count=3, name="renamed"))
+        self.assertEqual(len(queries), 2)
+        self.assertEqual((item.count, item.version, item.name), (5, 2, "test_item"))
+        # without an upsert statement the count is updated, then inserted
+        with patch('sqlite3.sqlite_version_info', (3, 8, 0)):
+            item = Item.add_to_cart(1, dict(data, count=1))
+            self.assertEqual(item.count, 6)
+            other = Item.add_to_cart(2, data)
+        self.assertNotEqual(other.id, item.id)
+        self.assertEqual(len(Item.all()), 2)
+        self.assertRaises(DataValidationError, Item.add_to_cart, 1, dict(data, count=-1))
+        self.assertRaises(DataValidationError, Item.add_to_cart, 1, dict(data, sku=None))
+
+    def test_customer_carts(self):
+        """ Keep the Items of each customer apart """
+        for customer_id, sku, count in ((1, "ID111", 3), (1, "ID222", 4), (2, "ID111", 5)):
+            Item(sku=sku, count=count, price=2.00, name="test_item", link="test.com",
+                 brand_name="gucci", is_available=True, customer_id=customer_id).save()
+        items = Item.find_by_filters(customer_id=1, sku="ID111").all()
+        self.assertEqual([item.count for item in items], [3])
+        self.assertEqual(Item.totals(Item.find_by_filters(customer_id=1)), (2, 7))
+        self.assertEqual(Item.totals(), (3, 12))
+        self.assertEqual(len(Item.find_many([1, 2, 3], customer_id=2)), 1)
+        self.assertEqual(Item.increment_count(1, 1, customer_id=2), 0)
+        self.assertEqual(Item.remove_all(customer_id=1), 2)
+        self.assertEqual([item.customer_id for item in Item.all()], [2])
+        index_columns = [[column.name for column in index.columns]
+                         for index in Item.__table__.indexes]
+        self.assertIn(['customer_id', 'sku'], index_columns)
+
     def test_serialize_an_item(self):
         """ Test serialization of an Item """
         item = Item(sku="ID111", count=3, price=2.00, name="test_item",
@@ -156,6 +227,99 @@ class TestItems(unittest.TestCase):
         self.assertEqual(item.link, "link.com")
         self.assertEqual(item.is_available, False)
 
+    def test_find_versioned(self):
+        """ Find the version and serialized Item through the cache """
+        item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                    link="test.com", brand_name="gucci", is_available=True)
+        item.save()
+        self.assertEqual(Item.find_versioned(0), (None, None))
+        version, data = Item.find_versioned(item.id)
+        self.assertEqual(data, item.serialize())
+        self.assertEqual(cache.get(str(item.id)), [1, data])
+        # saving the Item invalidates the cached copy
+        item.count = 4
+        item.save()
+        self.assertEqual(cache.get(str(item.id)), None)
+        self.assertEqual(Item.find_versioned(item.id)[1]['count'], 4)
+        # and so does deleting it
+        item_id = item.id
+        item.delete()
+        self.assertEqual(Item.find_versioned(item_id), (None, None))
+
+    def test_version_bumped_on_save(self):
+        """ Bump the version of an Item every time it is saved """
+        item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                    link="test.com", brand_name="gucci", is_available=True)
+        item.save()
+        self.assertEqual(item.version, 1)
+        self.assertIsNotNone(item.updated)
+        item.count = 4
+        item.save()
+        self.assertEqual(item.version, 2)
+        self.assertEqual(Item.find_versioned(item.id)[0], 2)
+
+    def test_find_versioned_race(self):
+        """ Keep a copy read before a change out of the cache """
+        item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                    link="test.com", brand_name="gucci", is_available=True)
+        item.save()
+        find = Item.find
+
+        def find_then_change(item_id):
+            # another request changes the Item after this one read it
+            stale = Item(sku="ID111", count=3, price=2.00, name="test_item", link="test.com",
+                         brand_name="gucci", is_available=True)
+            stale.id, stale.version = item_id, 1
+            changed = find(item_id)
+            changed.count = 9
+            changed.save()
+            return stale
+
+        with patch.object(Item, 'find', side_effect=find_then_change):
+            self.assertEqual(Item.find_versioned(item.id)[0], 1)
+        self.assertEqual(cache.get(str(item.id)), None)
+        self.assertEqual(Item.find_versioned(item.id), (2, Item.find(item.id).serialize()))
+
+    def test_collection_version(self):
+        """ Summarize a list of Items so that any change is noticed """
+        self.assertEqual(Item.collection_version()[0], 0)
+        item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                    link="test.com", brand_name="gucci", is_available=True)
+        item.save()
+        before = Item.collection_version()
+        self.assertEqual(before[0], 1)
+        item.count = 4
+        item.save()
+        after = Item.collection_version()
+        self.assertNotEqual(before, after)
+        self.assertEqual(Item.collection_version(Item.find_by_brand("nike"))[0], 0)
+
+    def test_increment_count(self):
+        """ Change the count of an Item with a single update """
+        item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                    link="test.com", brand_name="gucci", is_available=True)
+        item.save()
+        self.assertEqual(Item.increment_count(item.id, 2), 1)
+        item = Item.find(item.id)
+        self.assertEqual(item.count, 5)
+        self.assertEqual(item.version, 2)
+        self.assertEqual(Item.increment_count(item.id, -6), 0)
+        self.assertEqual(Item.increment_count(item.id, -1, version=1), 0)
+        self.assertEqual(Item.increment_count(item.id, -1, version=2), 1)
+        self.assertEqual(Item.find(item.id).count, 4)
+        self.assertEqual(Item.increment_count(0, 1), 0)
+
+    def test_stale_update(self):
+        """ Refuse to save an Item that was changed by someone else """
+        item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                    link="test.com", brand_name="gucci", is_available=True)
+        item.save()
+        # someone else updates the row behind this session's back
+        db.engine.execute(Item.__table__.update().where(Item.id == item.id).values(version=2))
+        item.count = 10
+        self.assertRaises(StaleDataError, item.save)
+        db.session.rollback()
+
     def test_find_or_404(self):
         """ Find an Item by ID """
         Item(sku="ID111", count=3, price=2.00, name="test_item",
@@ -172,6 +336,43 @@ class TestItems(unittest.TestCase):
         self.assertEqual(item.link, "link.com")
         self.assertEqual(item.is_available, False)
 
+    def test_item_rows(self):
+        """ Read the serialized columns of Items without building Items """
+        for i in range(5):
+            Item(sku="ID{}".format(i), count=1, price=1.00, name="item",
+                 link="test.com", brand_name="gucci", is_available=True).save()
+        rows = Item.rows()
+        self.assertEqual(len(rows), 5)
+        item = Item.find(rows[0][0])
+        self.assertEqual(dict(zip(Item.SERIALIZED_FIELDS, rows[0])), item.serialize())
+        rows = Item.rows(after_id=rows[1][0], limit=2)
+        self.assertEqual([row[1] for row in rows], ["ID2", "ID3"])
+        rows = Item.rows(Item.find_by_sku("ID4"), chunk_size=2)
+        self.assertEqual([row[1] for row in rows], ["ID4"])
+
+    def test_sorted_rows(self):
+        """ Page through Items sorted by a field with a keyset cursor """
+        prices = [5.00, None, 1.00, 5.00, 3.00, None, 2.00]
+        for i, price in enumerate(prices):
+            Item(sku="ID{}".format(i), count=i, price=price, name="item",
+                 link="test.com", brand_name="gucci", is_available=True).save()
+        for sort in ('price', '-price'):
+            expected = Item.rows(sort=sort)
+            pages = []
+            after = None
+            while True:
+                page = Item.rows(limit=2, sort=sort, after=after)
+                pages += page
+                if len(page) < 2:
+                    break
+                after = (page[-1][4], page[-1][0])
+            self.assertEqual(pages, expected)
+        skus = [row[1] for row in Item.rows(sort='-price')]
+        self.assertEqual(skus, ["ID3", "ID0", "ID4", "ID6", "ID2", "ID5", "ID1"])
+        skus = [row[1] for row in Item.rows(sort='price', limit=3)]
+        self.assertEqual(skus, ["ID1", "ID5", "ID2"])
+        self.assertRaises(DataValidationError, Item.rows, sort='link')
+
     def test_find_by_sku(self):
         """ Find Items by SKU """
         Item(sku="ID111", count=3, price=2.00, name="test_item",
@@ -232,6 +433,24 @@ class TestItems(unittest.TestCase):
         self.assertEqual(items[0].brand_name, "nike")
         self.assertEqual(items[0].is_available, False)
 
+    def test_find_by_filters(self):
+        """ Find Items by a combination of filters """
+        Item(sku="ID111", count=3, price=2.00, name="test_item",
+             link="test.com", brand_name="gucci", is_available=True).save()
+        Item(sku="ID222", count=5, price=10.00, name="some_item",
+             link="link.com", brand_name="nike", is_available=False).save()
+        Item(sku="ID333", count=1, price=20.00, name="other_item",
+             link="link.com", brand_name="nike", is_available=True).save()
+        items = Item.find_by_filters(brand_name="nike", is_available=True).all()
+        self.assertEqual([item.sku for item in items], ["ID333"])
+        items = Item.find_by_filters(brand_name="nike", price=10.00).all()
+        self.assertEqual([item.sku for item in items], ["ID222"])
+        items = Item.find_by_filters(min_price=5.00, max_price=15.00).all()
+        self.assertEqual([item.sku for item in items], ["ID222"])
+        items = Item.find_by_filters(is_available=False, name="test_item").all()
+        self.assertEqual(items, [])
+        self.assertEqual(Item.find_by_filters().count(), 3)
+
     def test_find_by_name(self):
         """ Find an Item by Name"""
         Item(sku="ID111", count=3, price=2.00, name="test_item",
@@ -247,6 +466,53 @@ class TestItems(unittest.TestCase):
         self.assertEqual(items[0].brand_name, "nike")
         self.assertEqual(items[0].is_available, False)
 
+    def test_search(self):
+        """ Search Items by the words of their name, brand and sku """
+        Item(sku="RS-100", count=1, price=80.00, name="Red running shoes",
+             link="test.com", brand_name="nike", is_available=True).save()
+        Item(sku="SH-200", count=1, price=20.00, name="Blue shirt",
+             link="test.com", brand_name="runwell", is_available=True).save()
+        Item(sku="RUN300", count=1, price=5.00, name="Socks",
+             link="test.com", brand_name="adidas", is_available=False).save()
+        rows = Item.search('run')
+        self.assertEqual(len(rows), 3)
+        # a match in the name ranks above one in the brand or the sku
+        self.assertEqual(rows[0][1], "RS-100")
+        self.assertEqual([row[1] for row in Item.search('NIK sho')], ["RS-100"])
+        self.assertEqual([row[1] for row in Item.search('rs-100')], ["RS-100"])
+        self.assertEqual(Item.search('running', Item.find_by_filters(is_available=False)), [])
+        self.assertEqual(len(Item.search('run', limit=2)), 2)
+        self.assertEqual([row[1] for row in Item.search('run', limit=2, offset=2)],
+                         [rows[2][1]])
+        # only the first matches are ranked
+        self.assertEqual(len(Item.search('run', max_results=2)), 2)
+        self.assertRaises(DataValidationError, Item.search, ' -- ')
+
+    def test_search_index_follows_changes(self):
+        """ Search the Items as they are after updates and deletes """
+        item = Item(sku="RS-100", count=1, price=80.00, name="Red running shoes",
+                    link="test.com", brand_name="nike", is_available=True)
+        item.save()
+        item.name = "Green hat"
+        item.save()
+        self.assertEqual(Item.search('running'), [])
+        self.assertEqual(len(Item.search('gre')), 1)
+        Item.increment_count(item.id, 2)
+        self.assertEqual(Item.search('gre')[0][5], 3)
+        Item.delete_many([item.id])
+        self.assertEqual(Item.search('gre'), [])
+
+    def test_search_like(self):
+        """ Search with LIKE on databases without a full text index """
+        Item(sku="SH-200", count=1, price=20.00, name="Blue shirt",
+             link="test.com", brand_name="runwell", is_available=True).save()
+        Item(sku="RS-100", count=1, price=80.00, name="Red running shoes",
+             link="test.com", brand_name="nike", is_available=True).save()
+        with patch('app.models.search_backend', return_value='like'):
+            self.assertEqual([row[1] for row in Item.search('run')], ["RS-100", "SH-200"])
+            self.assertEqual([row[1] for row in Item.search('nik sho')], ["RS-100"])
+            self.assertEqual(len(Item.search('run', max_results=1)), 1)
+
 ######################################################################
 #   M A I N
 ######################################################################
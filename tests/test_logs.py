@@ -0,0 +1,155 @@
+import os
+import json
+import Queue
+import logging
+import unittest
+from StringIO import StringIO
+from app.logs import QueueHandler, QueueListener, JSONFormatter, RequestIdFilter, \
+                     SamplingFilter, AsyncLogging
+from app import server, db
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+def make_logger(name, *handlers):
+    """ Returns a logger that only writes to the given handlers """
+    logger = logging.getLogger(name)
+    logger.handlers = list(handlers)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the asynchronous structured logging """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        self.stream = StringIO()
+        self.output = logging.StreamHandler(self.stream)
+        self.output.setFormatter(JSONFormatter())
+        self.output.addFilter(RequestIdFilter())
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def records(self):
+        """ Returns the JSON records written so far """
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_queue_listener(self):
+        """ Write queued records from the listener thread """
+        queue = Queue.Queue()
+        listener = QueueListener(queue, self.output)
+        logger = make_logger('test.queue', QueueHandler(queue))
+        listener.start()
+        try:
+            logger.info('Processing %s of %s', 'one', 2)
+            logger.warning('Careful')
+        finally:
+            listener.stop()
+        records = self.records()
+        self.assertEqual([record['message'] for record in records],
+                         ['Processing one of 2', 'Careful'])
+        self.assertEqual(records[1]['level'], 'WARNING')
+        self.assertEqual(records[0]['request_id'], '-')
+
+    def test_queue_full(self):
+        """ Drop and count the records that don't fit in the queue """
+        handler = QueueHandler(Queue.Queue(1))
+        logger = make_logger('test.full', handler)
+        logger.info('kept')
+        logger.info('dropped')
+        self.assertEqual(handler.dropped, 1)
+
+    def test_exception(self):
+        """ Format the exception before the record crosses threads """
+        queue = Queue.Queue()
+        logger = make_logger('test.exception', QueueHandler(queue))
+        try:
+            raise ValueError('bad value')
+        except ValueError:
+            logger.exception('Failed')
+        QueueListener(queue, self.output).handle(queue.get_nowait())
+        record = self.records()[0]
+        self.assertEqual(record['message'], 'Failed')
+        self.assertIn('ValueError: bad value', record['exception'])
+
+    def test_rate_limit(self):
+        """ Keep at most rate_limit messages per call site every second """
+        sampling = SamplingFilter(rate_limit=3)
+        logger = make_logger('test.rate', self.output)
+        logger.addFilter(sampling)
+        for index in range(10):
+            logger.info('Chatty %s', index)
+        for index in range(2):
+            logger.info('Other %s', index)
+        logger.warning('Always')
+        messages = [record['message'] for record in self.records()]
+        self.assertEqual(messages, ['Chatty 0', 'Chatty 1', 'Chatty 2', 'Other 0', 'Other 1',
+                                    'Always'])
+        self.assertEqual(sampling.suppressed, 7)
+
+    def test_sample_rate(self):
+        """ Keep none of the messages with a sample rate of 0 """
+        sampling = SamplingFilter(sample_rate=0.0)
+        logger = make_logger('test.sample', self.output)
+        logger.addFilter(sampling)
+        logger.info('Chatty')
+        logger.error('Failed')
+        self.assertEqual([record['message'] for record in self.records()], ['Failed'])
+        self.assertEqual(sampling.suppressed, 1)
+
+    def test_request_id(self):
+        """ Return the request id and tag the request's records with it """
+        resp = self.app.get('/shopcarts/items', headers={'X-Request-ID': 'abc123'})
+        self.assertEqual(resp.headers['X-Request-ID'], 'abc123')
+        resp = self.app.get('/shopcarts/items')
+        self.assertEqual(len(resp.headers['X-Request-ID']), 32)
+
+        logger = make_logger('test.request', self.output)
+        with server.app.test_request_context('/'):
+            server.app.preprocess_request()
+            logger.info('In a request')
+        self.assertEqual(len(self.records()[0]['request_id']), 32)
+
+    def test_configure(self):
+        """ Log the app and model records through the queue with sampling """
+        logs = AsyncLogging()
+        server.app.config['LOG_RATE_LIMIT'] = 1
+        handlers = logging.getLogger().handlers, server.app.logger.handlers
+        levels = logging.getLogger().level, server.app.logger.level
+        try:
+            logs.configure(server.app)
+            self.assertIsInstance(server.app.logger.handlers[0], QueueHandler)
+            for _ in range(3):
+                self.app.get('/shopcarts/items/0')
+            self.assertEqual(logs.stats()['suppressed'], 2)
+        finally:
+            logs.stop()
+            logging.getLogger('app.models').filters = []
+            logging.getLogger().handlers, server.app.logger.handlers = handlers
+            logging.getLogger().setLevel(levels[0])
+            server.app.logger.setLevel(levels[1])
+            server.app.config['LOG_RATE_LIMIT'] = 10
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from flask import g
+from app.metrics import Registry, DURATION_BUCKETS, timed, timed_rows
+from app.models import Item
+from app import server, db, metrics
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the request metrics """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        Item(sku="ID111", count=3, price=2.00, name="test_item",
+             link="test.com", brand_name="gucci", is_available=True).save()
+        server.app.config['METRICS_ENABLED'] = True
+        metrics.registry.clear()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['METRICS_ENABLED'] = False
+        server.app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        db.session.remove()
+        db.drop_all()
+
+    def test_render_histogram(self):
+        """ Render a histogram in the Prometheus text format """
+        registry = Registry()
+        registry.observe('test_seconds', 'A test', DURATION_BUCKETS, {'route': 'home'}, 0.003)
+        registry.observe('test_seconds', 'A test', DURATION_BUCKETS, {'route': 'home'}, 0.2)
+        text = registry.render()
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{route="home",le="0.0025"} 0', text)
+        self.assertIn('test_seconds_bucket{route="home",le="0.005"} 1', text)
+        self.assertIn('test_seconds_bucket{route="home",le="+Inf"} 2', text)
+        self.assertIn('test_seconds_count{route="home"} 2', text)
+
+    def test_request_metrics(self):
+        """ Record request, query and serialization times per route """
+        self.app.get('/shopcarts/items')
+        self.app.get('/shopcarts/items/0')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('text/plain', resp.headers['Content-Type'])
+        text = resp.data
+        self.assertIn('shopcarts_request_duration_seconds_count'
+                      '{method="GET",route="list_items",status="200"} 1', text)
+        self.assertIn('shopcarts_request_duration_seconds_count'
+                      '{method="GET",route="get_items",status="404"} 1', text)
+        self.assertIn('shopcarts_request_db_queries_bucket{route="list_items",le="1"} 0', text)
+        self.assertIn('shopcarts_request_split_duration_seconds_count'
+                      '{route="list_items",split="serialize"} 1', text)
+        self.assertIn('shopcarts_request_split_duration_seconds_count'
+                      '{route="list_items",split="fetch"} 1', text)
+        self.assertIn('shopcarts_request_split_duration_seconds_count'
+                      '{route="get_items",split="error_handler"} 1', text)
+
+    def test_timed_rows(self):
+        """ Count the rows of a lazy query as fetched, not serialized """
+        def slow_rows():
+            for row in range(3):
+                time.sleep(0.01)
+                yield row
+
+        with server.app.test_request_context('/'):
+            g.request_timings = {'splits': {}, 'active': set()}
+            with timed('serialize'):
+                self.assertEqual(list(timed_rows(slow_rows())), [0, 1, 2])
+            splits = g.request_timings['splits']
+        self.assertTrue(splits['fetch'] >= 0.03)
+        self.assertTrue(splits['serialize'] < 0.01)
+        self.assertEqual(list(timed_rows(iter([1, 2]))), [1, 2])
+
+    def test_metrics_disabled(self):
+        """ Record nothing unless metrics are enabled """
+        server.app.config['METRICS_ENABLED'] = False
+        self.app.get('/shopcarts/items')
+        self.assertEqual(self.app.get('/metrics').data.strip(), '')
+
+    def test_profile_sampling(self):
+        """ Write a cProfile dump for sampled requests """
+        profile_dir = tempfile.mkdtemp()
+        try:
+            server.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+            server.app.config['PROFILE_DIR'] = profile_dir
+            self.app.get('/shopcarts/items')
+            dumps = os.listdir(profile_dir)
+            self.assertEqual(len(dumps), 1)
+            self.assertTrue(dumps[0].startswith('shopcarts-list_items-'))
+        finally:
+            shutil.rmtree(profile_dir)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+import unittest
+from mock import patch
+from app.querybudget import count_queries, QueryBudgetExceeded, QueryRecord
+from app.models import Item
+from app import server, db, cache, query_budget
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+class LogCapture(logging.Handler):
+    """ Keeps the messages logged while it is attached """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueryBudget(unittest.TestCase):
+    """ Test Cases for the per route query budget """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        cache.clear()
+        for index in range(5):
+            Item(sku="ID{}".format(index), count=3, price=2.00, name="test_item",
+                 link="test.com", brand_name="gucci", is_available=True).save()
+        server.app.config['QUERY_BUDGET_ENABLED'] = True
+        query_budget.violations.clear()
+        self.log = LogCapture()
+        logging.getLogger('app.querybudget').addHandler(self.log)
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['QUERY_BUDGET_ENABLED'] = False
+        server.app.config['QUERY_BUDGET_STRICT'] = False
+        server.app.config['QUERY_BUDGETS'].pop('list_items', None)
+        logging.getLogger('app.querybudget').removeHandler(self.log)
+        db.session.remove()
+        db.drop_all()
+
+    def test_count_queries(self):
+        """ Record the SQL run inside the block """
+        with count_queries() as queries:
+            Item.find(1)
+            Item.find(2)
+        self.assertEqual(len(queries), 2)
+        self.assertTrue(queries.statements[0].startswith('SELECT'))
+        self.assertEqual(queries.repeated()[0][0], 2)
+        self.assertTrue(queries.seconds >= 0)
+        Item.find(3)
+        self.assertEqual(len(queries), 2)
+
+    def test_clear_is_one_query(self):
+        """ Clear the shopcart with a single DELETE """
+        with count_queries() as queries:
+            Item.remove_all()
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries.statements[0].startswith('DELETE'))
+
+    def test_routes_within_budget(self):
+        """ Stay within the budget of the configured routes """
+        self.app.get('/shopcarts/items/1')
+        self.app.delete('/shopcarts/items/2')
+        self.app.delete('/shopcarts/items:batch', data=json.dumps([3, 4]),
+                        content_type='application/json')
+        self.app.delete('/shopcarts/clear')
+        self.assertEqual(list(query_budget.violations), [])
+
+    def test_over_budget_is_logged(self):
+        """ Log a route over its budget with its repeated statements and plans """
+        server.app.config['QUERY_BUDGETS']['list_items'] = {'max_queries': 0}
+        resp = self.app.get('/shopcarts/items')
+        self.assertEqual(resp.status_code, 200)
+        violation = query_budget.violations[-1]
+        self.assertEqual(violation['route'], 'list_items')
+        self.assertTrue(violation['queries'] > 0)
+        self.assertTrue(violation['offenders'][0].startswith('SELECT'))
+        self.assertTrue(any('EXPLAIN' in message for message in self.log.messages))
+        resp = self.app.get('/stats')
+        data = json.loads(resp.data)
+        self.assertEqual(data['query_budget'][-1]['route'], 'list_items')
+
+    def test_explain_dml(self):
+        """ Explain UPDATE and DELETE statements without running them """
+        with server.app.app_context():
+            record = QueryRecord('DELETE FROM item WHERE item.id = ?', (1,), 0.5)
+            plan = query_budget.explain(record)
+            self.assertTrue(plan)
+            self.assertFalse(str(plan[0]).startswith('could not'))
+            self.assertEqual(Item.query.count(), 5)
+            insert = QueryRecord('INSERT INTO item (sku) VALUES (?)', ('x',), 0.5)
+            self.assertEqual(query_budget.explain(insert), [])
+
+    def test_explain_without_idle_connection(self):
+        """ Skip the plan instead of waiting for a connection from a full pool """
+        pool_class = type(db.engine.pool)
+        with server.app.app_context(), \
+                patch('app.querybudget.QueuePool', pool_class), \
+                patch.object(pool_class, 'checkedin', create=True, return_value=0), \
+                patch('app.querybudget.session_holds_connection', return_value=False):
+            record = QueryRecord('SELECT * FROM item', (), 0.5)
+            self.assertEqual(query_budget.explain(record),
+                             ['not explained: no idle database connection'])
+
+    def test_n_plus_one_offenders(self):
+        """ Report a statement repeated once per row """
+        with count_queries() as queries:
+            for item_id in range(1, 6):
+                Item.query.get(item_id)
+        offenders = query_budget._offenders(queries, True)
+        self.assertEqual(len(offenders), 1)
+        self.assertEqual(queries.repeated()[0][0], 5)
+
+    def test_strict_raises(self):
+        """ Raise when a route goes over its budget in strict mode """
+        server.app.config['QUERY_BUDGET_STRICT'] = True
+        server.app.config['QUERY_BUDGETS']['list_items'] = {'max_queries': 0}
+        server.app.testing = True
+        try:
+            self.assertRaises(QueryBudgetExceeded, self.app.get, '/shopcarts/items')
+        finally:
+            server.app.testing = False
+
+    def test_disabled(self):
+        """ Check nothing when the budget is disabled """
+        server.app.config['QUERY_BUDGET_ENABLED'] = False
+        server.app.config['QUERY_BUDGETS']['list_items'] = {'max_queries': 0}
+        self.app.get('/shopcarts/items')
+        self.assertEqual(list(query_budget.violations), [])
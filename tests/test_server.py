@@ -2,10 +2,14 @@ import unittest
 import os
 import json
 import logging
+import warnings
+from mock import patch
+from sqlalchemy.exc import IntegrityError
 from flask_api import status    # HTTP Status Codes
 
 from app.models import Item
-from app import server,db
+from app.querybudget import count_queries
+from app import server, db, cache
 
 DATABASE_URI = os.getenv('DATABASE_URI', None)
 
@@ -32,6 +36,8 @@ class TestItemServer(unittest.TestCase):
         server.init_db()
         db.drop_all()    # clean up the last tests
         db.create_all()  # create new tables
+        cache.clear()
+        cache.reset_stats()
         Item(sku="ID111", count=3, price=2.00, name="test_item",
              link="test.com", brand_name="gucci", is_available=True).save()
         Item(sku="ID222", count=5, price=10.00, name="some_item",
@@ -47,6 +53,20 @@ class TestItemServer(unittest.TestCase):
         resp = self.app.get('/')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_swagger_spec(self):
+        """ Build the Swagger spec once and serve it from the cache after that """
+        resp = self.app.get('/v1/spec')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        spec = json.loads(resp.data)
+        self.assertIn('/shopcarts/items', spec['paths'])
+        with patch('flasgger.base.APISpecsView.get') as get_spec:
+            resp = self.app.get('/v1/spec')
+            # another query string is the same spec, not another cache entry
+            self.app.get('/v1/spec?nocache=1')
+            self.assertFalse(get_spec.called)
+        self.assertEqual(json.loads(resp.data), spec)
+        self.assertEqual(resp.mimetype, 'application/json')
+
     def test_get_item_list(self):
         """ Get a list of Items """
         resp = self.app.get('/shopcarts/items')
@@ -64,6 +84,86 @@ class TestItemServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data['sku'], item.sku)
 
+    def test_get_item_cached(self):
+        """ Get a single Item through the cache """
+        item = Item.find_by_name('test_item')[0]
+        url = '/shopcarts/items/{}'.format(item.id)
+        self.app.get(url)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['count'], 3)
+        resp = self.app.get('/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('pool', json.loads(resp.data))
+        stats = json.loads(resp.data)['cache']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        # updates are seen right away
+        data = dict(item.serialize(), count=7)
+        self.app.put(url, data=json.dumps(data), content_type='application/json')
+        resp = self.app.get(url)
+        self.assertEqual(json.loads(resp.data)['count'], 7)
+        # and so are deletes
+        self.app.delete('/shopcarts/clear')
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_item_conditional(self):
+        """ Get a single Item only if it has changed """
+        item = Item.find_by_name('test_item')[0]
+        url = '/shopcarts/items/{}'.format(item.id)
+        resp = self.app.get(url)
+        etag = resp.headers.get('ETag')
+        self.assertEqual(etag, '"{}-1"'.format(item.id))
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        self.assertEqual(resp.headers.get('ETag'), etag)
+        # a change makes the old ETag stale
+        data = dict(item.serialize(), count=7)
+        resp = self.app.put(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(resp.headers.get('ETag'), '"{}-2"'.format(item.id))
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['count'], 7)
+
+    def test_get_item_list_conditional(self):
+        """ Get the list of Items only if it has changed """
+        resp = self.app.get('/shopcarts/items')
+        etag = resp.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        resp = self.app.get('/shopcarts/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # each filter has its own ETag
+        resp = self.app.get('/shopcarts/items', query_string='brand_name=nike',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # any change makes the old ETag stale
+        item = Item.find_by_sku('ID222')[0]
+        item.count = 6
+        item.save()
+        resp = self.app.get('/shopcarts/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers.get('ETag'), etag)
+
+    def test_get_item_page_conditional(self):
+        """ Tag a page of Items by its rows, without the aggregate of the list """
+        with count_queries() as queries:
+            resp = self.app.get('/shopcarts/items', query_string='limit=1')
+        self.assertEqual(len(queries), 1)
+        etag = resp.headers.get('ETag')
+        resp = self.app.get('/shopcarts/items', query_string='limit=1',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # a change on the page makes the old ETag stale
+        item = Item.find_by_sku('ID111')[0]
+        item.count = 6
+        item.save()
+        resp = self.app.get('/shopcarts/items', query_string='limit=1',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)[0]['count'], 6)
+
     def test_get_item_not_found(self):
         """ Get an Item that's not found """
         resp = self.app.get('/shopcarts/items/0')
@@ -104,6 +204,64 @@ class TestItemServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['brand_name'], 'reebok')
 
+    def test_update_item_if_match(self):
+        """ Update an Item only if it has not changed """
+        item = Item.find_by_sku('ID222')[0]
+        url = '/shopcarts/items/{}'.format(item.id)
+        etag = self.app.get(url).headers.get('ETag')
+        data = dict(item.serialize(), brand_name='reebok')
+        resp = self.app.put(url, data=json.dumps(data), content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # the old ETag is now stale so a second writer loses
+        data = dict(item.serialize(), brand_name='adidas')
+        resp = self.app.put(url, data=json.dumps(data), content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Item.find(item.id).brand_name, 'reebok')
+        # an ETag for another Item never matches
+        resp = self.app.put(url, data=json.dumps(data), content_type='application/json',
+                            headers={'If-Match': '"0-1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_increment_item_count(self):
+        """ Change the count of an Item atomically """
+        item = Item.find_by_sku('ID222')[0]
+        url = '/shopcarts/items/{}'.format(item.id)
+        resp = self.app.patch(url, data=json.dumps({'delta': 3}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['count'], 8)
+        self.assertEqual(resp.headers.get('ETag'), '"{}-2"'.format(item.id))
+        resp = self.app.patch(url, data=json.dumps({'delta': -8}), content_type='application/json')
+        self.assertEqual(json.loads(resp.data)['count'], 0)
+        # the count never goes below zero
+        resp = self.app.patch(url, data=json.dumps({'delta': -1}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Item.find(item.id).count, 0)
+
+    def test_increment_item_count_if_match(self):
+        """ Change the count of an Item only if it has not changed """
+        item = Item.find_by_sku('ID222')[0]
+        url = '/shopcarts/items/{}'.format(item.id)
+        etag = '"{}-1"'.format(item.id)
+        resp = self.app.patch(url, data=json.dumps({'delta': 1}), content_type='application/json',
+                              headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.patch(url, data=json.dumps({'delta': 1}), content_type='application/json',
+                              headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Item.find(item.id).count, 6)
+
+    def test_increment_item_count_bad_request(self):
+        """ Change the count of an Item with bad data """
+        item = Item.find_by_sku('ID222')[0]
+        url = '/shopcarts/items/{}'.format(item.id)
+        resp = self.app.patch(url, data=json.dumps({'delta': 'one'}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch('/shopcarts/items/0', data=json.dumps({'delta': 1}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_item(self):
         """ Delete an Item """
         item = Item.find_by_sku('ID111')[0]
@@ -121,6 +279,19 @@ class TestItemServer(unittest.TestCase):
         resp = self.app.delete('/shopcarts/clear', content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(len(resp.data), 0)
+        self.assertEqual(resp.headers.get('X-Deleted-Count'), '2')
+        self.assertEqual(self.get_item_count(), 0)
+
+    def test_delete_all_items_by_brand(self):
+        """ Delete all Items of one brand """
+        resp = self.app.delete('/shopcarts/clear', query_string='brand_name=nike')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.headers.get('X-Deleted-Count'), '1')
+        self.assertEqual(len(Item.find_by_brand('nike').all()), 0)
+        self.assertEqual(self.get_item_count(), 1)
+        resp = self.app.delete('/shopcarts/clear', query_string='is_available=false')
+        self.assertEqual(resp.headers.get('X-Deleted-Count'), '0')
+        self.assertEqual(self.get_item_count(), 1)
 
     def test_query_item_list_by_brand(self):
         """ Query Items by Brand """
@@ -155,6 +326,218 @@ class TestItemServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['sku'], 'ID111')
 
+    def test_create_items_batch(self):
+        """ Create a batch of Items """
+        item_count = self.get_item_count()
+        new_items = [{'sku': 'ID333', 'count': 1, 'price': 5.00, 'name': 'hat', 'link': 'hat.com',
+                      'brand_name': 'gap', 'is_available': True},
+                     {'sku': 'ID444', 'count': 2, 'price': 7.00, 'name': 'scarf', 'link': 'scarf.com',
+                      'brand_name': 'gap', 'is_available': False}]
+        with count_queries() as queries:
+            resp = self.app.post('/shopcarts/items:batch', data=json.dumps(new_items),
+                                 content_type='application/json')
+        # one multi-row INSERT, the response is built from what was posted
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        results = json.loads(resp.data)['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(results[1]['item']['sku'], 'ID444')
+        self.assertIsNotNone(results[1]['item']['id'])
+        self.assertEqual(self.get_item_count(), item_count + 2)
+        for result in results:
+            item = Item.find(result['item']['id'])
+            self.assertEqual(item.sku, result['item']['sku'])
+
+    def test_create_items_batch_invalid(self):
+        """ Create a batch of Items where one is invalid """
+        item_count = self.get_item_count()
+        new_items = [{'sku': 'ID333', 'count': 1, 'price': 5.00, 'name': 'hat', 'link': 'hat.com',
+                      'brand_name': 'gap', 'is_available': True},
+                     {'sku': 'ID444'}]
+        resp = self.app.post('/shopcarts/items:batch', data=json.dumps(new_items),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        results = json.loads(resp.data)['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['index'], 1)
+        self.assertEqual(self.get_item_count(), item_count)
+        # the body must be an array
+        resp = self.app.post('/shopcarts/items:batch', data=json.dumps(new_items[0]),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_items_batch(self):
+        """ Update a batch of Items """
+        items = [Item.find_by_sku('ID111')[0].serialize(), Item.find_by_sku('ID222')[0].serialize()]
+        for item in items:
+            item['count'] = 9
+        with count_queries() as queries:
+            resp = self.app.put('/shopcarts/items:batch', data=json.dumps(items),
+                                content_type='application/json')
+        # one SELECT of the stored Items and one UPDATE for all of them
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([result['item']['count'] for result in results], [9, 9])
+        self.assertEqual(Item.find(items[0]['id']).count, 9)
+        self.assertEqual(Item.find(items[0]['id']).version, 2)
+        resp = self.app.put('/shopcarts/items:batch', data=json.dumps([items[0], items[0]]),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(resp.data)['results'][0]['index'], 1)
+        resp = self.app.put('/shopcarts/items:batch', data=json.dumps([dict(items[0], id=True)]),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Item.find(items[0]['id']).version, 2)
+
+    def test_update_items_batch_not_found(self):
+        """ Update a batch of Items where one does not exist """
+        item = Item.find_by_sku('ID111')[0].serialize()
+        item['count'] = 9
+        missing = dict(item, id=0)
+        resp = self.app.put('/shopcarts/items:batch', data=json.dumps([item, missing]),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        results = json.loads(resp.data)['results']
+        self.assertEqual(results[0]['index'], 1)
+        self.assertEqual(results[0]['status'], status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Item.find(item['id']).count, 3)
+
+    def test_delete_items_batch(self):
+        """ Delete a batch of Items """
+        item = Item.find_by_sku('ID111')[0]
+        resp = self.app.delete('/shopcarts/items:batch', data=json.dumps([item.id, 0]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual(results[0]['status'], status.HTTP_204_NO_CONTENT)
+        self.assertEqual(results[1]['status'], status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.get_item_count(), 1)
+        resp = self.app.delete('/shopcarts/items:batch', data=json.dumps(['abc']),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete('/shopcarts/items:batch', data=json.dumps([0, 0]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # true is not the id 1
+        resp = self.app.delete('/shopcarts/items:batch', data=json.dumps([True]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_item_count(), 1)
+
+    def test_query_item_list_by_availability(self):
+        """ Query Items by Availability """
+        resp = self.app.get('/shopcarts/items', query_string='is_available=false')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID222')
+
+    def test_query_item_list_by_price(self):
+        """ Query Items by Price """
+        resp = self.app.get('/shopcarts/items', query_string='price=5')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID111')
+        resp = self.app.get('/shopcarts/items', query_string='min_price=5&max_price=20')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID222')
+
+    def test_query_item_list_by_many_filters(self):
+        """ Query Items by several filters at once """
+        resp = self.app.get('/shopcarts/items', query_string='brand_name=nike&is_available=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/shopcarts/items', query_string='name=some_item&brand_name=nike&price=10')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID222')
+
+    def test_query_item_list_bad_filters(self):
+        """ Query Items with filters that are not valid """
+        resp = self.app.get('/shopcarts/items', query_string='is_available=maybe')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/shopcarts/items', query_string='price=cheap')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_item_list_paginated(self):
+        """ Get a list of Items one page at a time """
+        resp = self.app.get('/shopcarts/items', query_string='limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID111')
+        cursor = resp.headers.get('X-Next-Cursor')
+        self.assertEqual(cursor, str(data[0]['id']))
+        self.assertIn('rel="next"', resp.headers.get('Link'))
+        # the last page has no next cursor
+        resp = self.app.get('/shopcarts/items', query_string='limit=1&after_id=' + cursor)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID222')
+        self.assertEqual(resp.headers.get('X-Next-Cursor'), None)
+        self.assertEqual(resp.headers.get('Link'), None)
+
+    def test_get_item_list_sorted(self):
+        """ Get a list of Items sorted by price one page at a time """
+        Item(sku="ID333", count=1, price=5.00, name="other_item",
+             link="test.com", brand_name="gucci", is_available=True).save()
+        resp = self.app.get('/shopcarts/items', query_string='sort=-price')
+        self.assertEqual([item['sku'] for item in json.loads(resp.data)],
+                         ['ID222', 'ID333', 'ID111'])
+        resp = self.app.get('/shopcarts/items', query_string='sort=name&min_price=3')
+        self.assertEqual([item['sku'] for item in json.loads(resp.data)], ['ID333', 'ID222'])
+        resp = self.app.get('/shopcarts/items', query_string='sort=price&limit=2')
+        self.assertEqual([item['sku'] for item in json.loads(resp.data)], ['ID111', 'ID333'])
+        cursor = resp.headers['X-Next-Cursor']
+        self.assertIn('after=' + cursor, resp.headers['Link'])
+        resp = self.app.get('/shopcarts/items', query_string='sort=price&limit=2&after=' + cursor)
+        self.assertEqual([item['sku'] for item in json.loads(resp.data)], ['ID222'])
+        self.assertNotIn('Link', resp.headers)
+        for bad in ('sort=link', 'sort=price&after_id=1', 'sort=price&after=nonsense',
+                    'after=' + cursor):
+            resp = self.app.get('/shopcarts/items', query_string=bad)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # a cursor whose value doesn't have the type of the sort field
+        for sort, value in (('price', {'a': 1}), ('-count', 'many'), ('count', 1.5),
+                            ('name', 3), ('price', True)):
+            tampered = server.encode_cursor(value, 1)
+            resp = self.app.get('/shopcarts/items',
+                                query_string='sort={}&limit=2&after={}'.format(sort, tampered))
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/shopcarts/items',
+                            query_string='sort=-name&after=' + server.encode_cursor(None, 1))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_item_list_bad_limit(self):
+        """ Get a list of Items with an invalid limit """
+        resp = self.app.get('/shopcarts/items', query_string='limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/shopcarts/items', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_item_list_streamed(self):
+        """ Stream the list of Items """
+        resp = self.app.get('/shopcarts/items', query_string='stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]['sku'], 'ID111')
+        self.assertEqual(data[1]['sku'], 'ID222')
+        # streaming honors filters
+        resp = self.app.get('/shopcarts/items', query_string='stream=true&brand_name=nike')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['sku'], 'ID222')
+        # but not paging, a stream is the whole list
+        for paged in ('limit=1', 'after_id=1', 'sort=price&after=' + server.encode_cursor(2.0, 1)):
+            resp = self.app.get('/shopcarts/items', query_string='stream=true&' + paged)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_item_not_found(self):
         """ Update an Item that doesn't exist """
         new_item = {"name": "jbkjb", "sku": "ID999"}
@@ -197,6 +580,173 @@ class TestItemServer(unittest.TestCase):
         resp = self.app.post('/shopcarts/items/1', data=data)
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_customer_cart(self):
+        """ Create, read and change Items in one customer's cart """
+        new_item = {'sku': "ID333", 'count': 2, 'price': 5.00, 'name': "cart_item",
+                    'link': "cart.com", 'brand_name': "gucci", 'is_available': True}
+        resp = self.app.post('/shopcarts/7/items', data=json.dumps(new_item),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item = json.loads(resp.data)
+        self.assertEqual(item['customer_id'], 7)
+        self.assertTrue(resp.headers['Location'].endswith(
+            '/shopcarts/7/items/{}'.format(item['id'])))
+        resp = self.app.get('/shopcarts/7/items')
+        self.assertEqual([row['sku'] for row in json.loads(resp.data)], ["ID333"])
+        # the global list still has every Item
+        self.assertEqual(self.get_item_count(), 3)
+        url = '/shopcarts/7/items/{}'.format(item['id'])
+        resp = self.app.patch(url, data=json.dumps({'delta': 1}), content_type='application/json')
+        self.assertEqual(json.loads(resp.data)['count'], 3)
+        resp = self.app.put(url, data=json.dumps(dict(item, count=9)),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['customer_id'], 7)
+        resp = self.app.get('/shopcarts/7/count')
+        self.assertEqual(json.loads(resp.data), {'items': 1, 'quantity': 9})
+
+    def test_other_customers_items(self):
+        """ Hide the Items of other customers """
+        item = Item(sku="ID333", count=2, price=5.00, name="cart_item", link="cart.com",
+                    brand_name="gucci", is_available=True, customer_id=7)
+        item.save()
+        url = '/shopcarts/8/items/{}'.format(item.id)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put(url, data=json.dumps(item.serialize()),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.patch(url, data=json.dumps({'delta': 1}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.app.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.delete('/shopcarts/8/items:batch', data=json.dumps([item.id]),
+                               content_type='application/json')
+        self.assertEqual(json.loads(resp.data)['results'][0]['status'], 404)
+        self.assertEqual(self.app.get('/shopcarts/8/items').data, '[]')
+        self.assertEqual(Item.find(item.id).count, 2)
+
+    def test_clear_customer_cart(self):
+        """ Clear one customer's cart and leave the others alone """
+        rows = [{'sku': "ID{}".format(index), 'count': 1, 'price': 1.00, 'name': "item",
+                 'link': "cart.com", 'brand_name': "gucci", 'is_available': True}
+                for index in range(3)]
+        resp = self.app.post('/shopcarts/7/items:batch', data=json.dumps(rows),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.delete('/shopcarts/7/clear')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.headers['X-Deleted-Count'], '3')
+        self.assertEqual(self.get_item_count(), 2)
+
+    def test_summarize_items(self):
+        """ Summarize the Items with one query """
+        Item(sku="ID333", count=2, price=1.50, name="other_item", link="test.com",
+             brand_name="gucci", is_available=False).save()
+        with count_queries() as queries, warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            resp = self.app.get('/shopcarts/summary')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 1)
+        # the subtotal is a float like the price, not a Decimal
+        self.assertEqual([str(warning.message) for warning in caught], [])
+        summary = json.loads(resp.data)
+        self.assertEqual(summary['items'], 3)
+        self.assertEqual(summary['quantity'], 10)
+        self.assertEqual(summary['subtotal'], 59.0)
+        self.assertEqual([brand['brand_name'] for brand in summary['brands']], ['gucci', 'nike'])
+        self.assertEqual(summary['brands'][0]['subtotal'], 9.0)
+        self.assertEqual(summary['availability']['available'],
+                         {'items': 1, 'quantity': 3, 'subtotal': 6.0})
+        self.assertEqual(summary['availability']['unavailable']['quantity'], 7)
+        resp = self.app.get('/shopcarts/summary', query_string='brand_name=nike')
+        self.assertEqual(json.loads(resp.data)['subtotal'], 50.0)
+        resp = self.app.get('/shopcarts/7/summary')
+        summary = json.loads(resp.data)
+        self.assertEqual((summary['items'], summary['subtotal'], summary['brands']), (0, 0.0, []))
+
+    def test_add_items_to_cart(self):
+        """ Merge Items with the same sku into one row when adding to a cart """
+        new_item = {'sku': "ID333", 'count': 2, 'price': 5.00, 'name': "cart_item",
+                    'link': "cart.com", 'brand_name': "gucci", 'is_available': True}
+        resp = self.app.post('/shopcarts/7/items:add', data=json.dumps(new_item),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        first = json.loads(resp.data)
+        self.assertEqual((first['count'], first['customer_id']), (2, 7))
+        resp = self.app.post('/shopcarts/7/items:add', data=json.dumps(dict(new_item, count=3)),
+                             content_type='application/json')
+        item = json.loads(resp.data)
+        self.assertEqual((item['id'], item['count']), (first['id'], 5))
+        self.assertNotEqual(resp.headers['ETag'], '"{}-1"'.format(item['id']))
+        resp = self.app.get('/shopcarts/7/items/{}'.format(item['id']))
+        self.assertEqual(json.loads(resp.data)['count'], 5)
+        # another customer gets their own row
+        resp = self.app.post('/shopcarts/8/items:add', data=json.dumps(new_item),
+                             content_type='application/json')
+        self.assertNotEqual(json.loads(resp.data)['id'], item['id'])
+        resp = self.app.post('/shopcarts/7/items:add', data=json.dumps(dict(new_item, count=0)),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_items_without_sku(self):
+        """ Refuse to add an Item without a sku to a cart """
+        new_item = {'sku': None, 'count': 2, 'price': 5.00, 'name': "cart_item",
+                    'link': "cart.com", 'brand_name': "gucci", 'is_available': True}
+        for sku in (None, None, '', '  '):
+            resp = self.app.post('/shopcarts/7/items:add',
+                                 data=json.dumps(dict(new_item, sku=sku)),
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(self.app.get('/shopcarts/7/count').data)['items'], 0)
+
+    def test_integrity_error(self):
+        """ Only report a broken unique sku index as a duplicate sku """
+        with server.app.test_request_context():
+            error = IntegrityError('INSERT', {},
+                                   Exception('NOT NULL constraint failed: item.version'))
+            resp, code = server.integrity_error(error)
+            self.assertEqual(code, status.HTTP_400_BAD_REQUEST)
+            self.assertNotIn('sku', json.loads(resp.data)['message'])
+            error = IntegrityError('INSERT', {},
+                                   Exception('UNIQUE constraint failed: item.customer_id, item.sku'))
+            resp, code = server.integrity_error(error)
+            self.assertEqual(code, status.HTTP_409_CONFLICT)
+
+    def test_create_duplicate_sku_in_cart(self):
+        """ Refuse to create a second Item with the same sku in a cart """
+        new_item = {'sku': "ID333", 'count': 2, 'price': 5.00, 'name': "cart_item",
+                    'link': "cart.com", 'brand_name': "gucci", 'is_available': True}
+        resp = self.app.post('/shopcarts/7/items', data=json.dumps(new_item),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.post('/shopcarts/7/items', data=json.dumps(new_item),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(json.loads(self.app.get('/shopcarts/7/count').data)['items'], 1)
+
+    def test_search_items(self):
+        """ Search the Items a page at a time """
+        for index in range(3):
+            Item(sku="RS{}".format(index), count=1, price=80.00, name="running shoes",
+                 link="test.com", brand_name="nike", is_available=True,
+                 customer_id=7 if index else None).save()
+        with count_queries() as queries:
+            resp = self.app.get('/shopcarts/items/search', query_string='q=runn&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 1)
+        first = json.loads(resp.data)
+        self.assertEqual(len(first), 2)
+        self.assertIn('offset=2', resp.headers['Link'])
+        resp = self.app.get('/shopcarts/items/search', query_string='q=runn&limit=2&offset=2')
+        self.assertNotIn('Link', resp.headers)
+        skus = [item['sku'] for item in first + json.loads(resp.data)]
+        self.assertEqual(sorted(skus), ['RS0', 'RS1', 'RS2'])
+        resp = self.app.get('/shopcarts/7/items/search', query_string='q=nike')
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        resp = self.app.get('/shopcarts/items/search', query_string='q=some')
+        self.assertEqual(json.loads(resp.data)[0]['sku'], 'ID222')
+        resp = self.app.get('/shopcarts/items/search')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
 ######################################################################
 # Utility functions
 ######################################################################
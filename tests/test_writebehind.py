@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import unittest
+from mock import patch
+from flask_api import status    # HTTP Status Codes
+from app.models import Item
+from app import server, db, cache, write_behind
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestWriteBehind(unittest.TestCase):
+    """ Test Cases for the buffered count changes """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        server.app.debug = False
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        """ Runs before each test """
+        server.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        cache.clear()
+        # the tests flush themselves, an in memory database is per thread
+        server.app.config['WRITE_BEHIND_ENABLED'] = True
+        server.app.config['WRITE_BEHIND_INTERVAL'] = 3600
+        server.app.config['WRITE_BEHIND_MAX_STALENESS'] = 3600
+        server.app.config['WRITE_BEHIND_MAX_ITEMS'] = 10000
+        self.item = Item(sku="ID111", count=3, price=2.00, name="test_item",
+                         link="test.com", brand_name="gucci", is_available=True)
+        self.item.save()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        write_behind.stop()
+        server.app.config['WRITE_BEHIND_ENABLED'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def patch(self, item_id, delta, **headers):
+        return self.app.patch('/shopcarts/items/{}'.format(item_id),
+                              data=json.dumps({'delta': delta}),
+                              content_type='application/json', headers=headers)
+
+    def stored_count(self, item_id):
+        """ Returns the count of an Item in the database, past the cache """
+        db.session.expire_all()
+        return Item.query.get(item_id).count
+
+    def test_deltas_are_buffered(self):
+        """ Buffer count deltas and write them with one version """
+        for delta in (2, 5, -1):
+            resp = self.patch(self.item.id, delta)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['count'], 9)
+        self.assertEqual(resp.headers['ETag'], '"{}-1.6"'.format(self.item.id))
+        self.assertEqual(self.stored_count(self.item.id), 3)
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(self.stored_count(self.item.id), 9)
+        self.assertEqual(Item.query.get(self.item.id).version, 2)
+        self.assertEqual(write_behind.pending(self.item.id), 0)
+
+    def test_reads_see_pending_deltas(self):
+        """ Add the pending deltas to the Items read """
+        self.patch(self.item.id, 4)
+        resp = self.app.get('/shopcarts/items/{}'.format(self.item.id))
+        self.assertEqual(json.loads(resp.data)['count'], 7)
+        self.assertEqual(resp.headers['ETag'], '"{}-1.4"'.format(self.item.id))
+        resp = self.app.get('/shopcarts/items')
+        self.assertEqual(json.loads(resp.data)[0]['count'], 7)
+        etag = resp.headers['ETag']
+        self.patch(self.item.id, 1)
+        resp = self.app.get('/shopcarts/items?limit=10', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)[0]['count'], 8)
+        # the totals are added up by the database, after the deltas are written
+        resp = self.app.get('/shopcarts/summary')
+        self.assertEqual(json.loads(resp.data)['quantity'], 8)
+        self.assertFalse(write_behind.has_pending())
+
+    def test_count_cannot_go_below_zero(self):
+        """ Refuse a buffered delta that takes the count below zero """
+        self.patch(self.item.id, -2)
+        resp = self.patch(self.item.id, -2)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.stored_count(self.item.id), 1)
+        resp = self.patch(0, 1)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_other_changes_flush_first(self):
+        """ Write the pending deltas before any other change """
+        self.patch(self.item.id, 2)
+        resp = self.app.put('/shopcarts/items/{}'.format(self.item.id),
+                            data=json.dumps({'sku': 'ID111', 'name': 'renamed', 'count': 1,
+                                             'brand_name': 'gucci', 'price': 2.0,
+                                             'is_available': True, 'link': 'test.com'}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stored_count(self.item.id), 1)
+        self.assertEqual(write_behind.pending(self.item.id), 0)
+
+    def test_flush_is_not_counted_in_budget(self):
+        """ Leave the pending deltas written before a change out of its query budget """
+        self.patch(self.item.id, 2)
+        server.app.config['QUERY_BUDGET_ENABLED'] = True
+        server.app.config['QUERY_BUDGET_STRICT'] = True
+        try:
+            resp = self.app.delete('/shopcarts/clear')
+        finally:
+            server.app.config['QUERY_BUDGET_ENABLED'] = False
+            server.app.config['QUERY_BUDGET_STRICT'] = False
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(write_behind.pending(self.item.id), 0)
+
+    def test_if_match_writes_now(self):
+        """ Apply a PATCH with If-Match after the pending deltas """
+        stale = self.patch(self.item.id, 2).headers['ETag']
+        etag = self.patch(self.item.id, 1).headers['ETag']
+        self.assertEqual(etag, '"{}-1.3"'.format(self.item.id))
+        # the ETag of the pending deltas still matches once they are written
+        resp = self.patch(self.item.id, 1, **{'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stored_count(self.item.id), 7)
+        self.assertEqual(resp.headers['ETag'], '"{}-3"'.format(self.item.id))
+        # one handed out before another delta was buffered does not
+        resp = self.patch(self.item.id, 1, **{'If-Match': stale})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        etag = self.app.get('/shopcarts/items/{}'.format(self.item.id)).headers['ETag']
+        resp = self.patch(self.item.id, 1, **{'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stored_count(self.item.id), 8)
+
+    def test_decrement_checks_stored_count(self):
+        """ Check a buffered decrement against the stored count, not the cached one """
+        self.app.get('/shopcarts/items/{}'.format(self.item.id))
+        # another process lowers the count, this one's cache still has 3
+        db.session.execute(Item.__table__.update().where(Item.id == self.item.id)
+                           .values(count=1))
+        db.session.commit()
+        resp = self.patch(self.item.id, -2)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(write_behind.has_pending())
+        self.assertEqual(self.stored_count(self.item.id), 1)
+
+    def test_clamped_deltas_are_logged(self):
+        """ Log the Items a written delta would take below zero """
+        with patch.object(Item.logger, 'warning') as warning:
+            Item.apply_count_deltas({self.item.id: -5})
+        self.assertEqual(self.stored_count(self.item.id), 0)
+        self.assertEqual(warning.call_args[0][1], [self.item.id])
+
+    def test_stale_buffer_writes_now(self):
+        """ Write deltas now when the buffer is older than the staleness allowed """
+        server.app.config['WRITE_BEHIND_MAX_STALENESS'] = 0.01
+        self.patch(self.item.id, 1)
+        time.sleep(0.02)
+        resp = self.patch(self.item.id, 1)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stored_count(self.item.id), 5)
+        self.assertFalse(write_behind.has_pending())
+
+    def test_full_buffer_writes_now(self):
+        """ Write deltas now when the buffer holds the most Items allowed """
+        server.app.config['WRITE_BEHIND_MAX_ITEMS'] = 1
+        other = Item(sku="ID222", count=1, name="other")
+        other.save()
+        self.patch(self.item.id, 1)
+        self.patch(other.id, 1)
+        self.assertEqual(self.stored_count(self.item.id), 4)
+        self.assertEqual(self.stored_count(other.id), 2)
+
+    def test_stop_flushes(self):
+        """ Write the pending deltas on shutdown """
+        self.patch(self.item.id, 5)
+        write_behind.stop()
+        self.assertEqual(self.stored_count(self.item.id), 8)
+        stats = json.loads(self.app.get('/stats').data)['write_behind']
+        self.assertEqual(stats['pending_items'], 0)
+        self.assertTrue(stats['flushed_items'] >= 1)
+
+    def test_disabled(self):
+        """ Write every delta at once when write behind is off """
+        server.app.config['WRITE_BEHIND_ENABLED'] = False
+        self.patch(self.item.id, 5)
+        self.assertEqual(self.stored_count(self.item.id), 8)
+        self.assertFalse(write_behind.has_pending())
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,13 @@
+"""
+Shopcart Service WSGI Entry Point
+
+Used by gunicorn to serve the app in production:
+
+    gunicorn -c gunicorn_config.py wsgi:app
+
+The database tables are created once by the gunicorn master process
+(see gunicorn_config.py), not by every worker.
+"""
+from app import app, server
+
+server.initialize_logging()